@@ -0,0 +1,134 @@
+from datetime import timedelta
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from ChaatsApp.fast_serializers import FastSerializer
+from ChaatsApp.models import Conversation, CustomUser, Message, UserProfile
+from ChaatsApp.serializers import CustomUserSerializer, MessageSerializer, UserProfileSerializer
+
+
+class MessageListTests(APITestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        for i in range(5):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f'ab{i}')
+        Message.objects.create(sender=self.carol, receiver=self.bob, content='cb')
+        self.conversation = Conversation.lookup_id(self.alice.id, self.bob.id)
+
+    def test_cursor_pages_through_a_conversation(self):
+        url = reverse('message-list')
+        response = self.client.get(url, {'conversation': self.conversation, 'page_size': 2})
+        self.assertEqual([m['content'] for m in response.data['data']], ['ab0', 'ab1'])
+
+        contents = []
+        cursor = response.data['next_cursor']
+        while cursor:
+            response = self.client.get(url, {'conversation': self.conversation, 'page_size': 2, 'after': cursor})
+            contents += [m['content'] for m in response.data['data']]
+            cursor = response.data['next_cursor']
+        self.assertEqual(contents, ['ab2', 'ab3', 'ab4'])
+
+    def test_time_range_and_sparse_fields(self):
+        Message.objects.filter(content='ab0').update(timestamp=timezone.now() - timedelta(days=2))
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+
+        response = self.client.get(reverse('message-list'), {'sender_id': self.alice.id, 'receiver_id': self.bob.id, 'since': since, 'fields': 'id,content'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['data']), 4)
+        self.assertEqual(set(response.data['data'][0]), {'id', 'content'})
+
+    def test_invalid_parameters_are_rejected(self):
+        url = reverse('message-list')
+        self.assertEqual(self.client.get(url, {'fields': 'id,password'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'after': 'garbage'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'since': 'yesterday'}).status_code, 400)
+
+
+class UserListTests(APITestCase):
+    def setUp(self):
+        for name in ('alice', 'bob', 'carol'):
+            user = CustomUser.objects.create(username=name, email=f'{name}@example.com', first_name=name.title())
+            UserProfile.objects.create(user=user)
+
+    def test_custom_users_are_paginated_by_id(self):
+        response = self.client.get(reverse('customuser-list'), {'page_size': 2, 'fields': 'username'})
+        self.assertEqual(response.data['data'], [{'username': 'alice'}, {'username': 'bob'}])
+
+        response = self.client.get(reverse('customuser-list'), {'after': response.data['next_cursor'], 'fields': 'username'})
+        self.assertEqual(response.data['data'], [{'username': 'carol'}])
+        self.assertIsNone(response.data['next_cursor'])
+
+    def test_user_profiles_include_user_details(self):
+        response = self.client.get(reverse('userprofile-list'), {'page_size': 1})
+        profile, = response.data['data']
+        self.assertEqual(profile['first_name'], 'Alice')
+        self.assertEqual(profile['email'], 'alice@example.com')
+        self.assertIsNone(profile['profile_picture'])
+
+
+class FastSerializerTests(APITestCase):
+    def setUp(self):
+        alice = CustomUser.objects.create(username='alice', email='alice@example.com', profile_picture='profile_pictures/alice.jpg')
+        bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        UserProfile.objects.create(user=alice)
+        UserProfile.objects.create(user=bob)
+        Message.objects.create(sender=alice, receiver=bob, content='hi')
+
+    def test_output_matches_drf_serializers(self):
+        for serializer_class, queryset in (
+            (CustomUserSerializer, CustomUser.objects.order_by('id')),
+            (UserProfileSerializer, UserProfile.objects.order_by('id')),
+            (MessageSerializer, Message.objects.order_by('id')),
+        ):
+            expected = [dict(row) for row in serializer_class(queryset, many=True).data]
+            self.assertEqual(FastSerializer(serializer_class).serialize(queryset), expected)
+
+            sparse = [dict(row) for row in serializer_class(queryset, many=True, fields=('id',)).data]
+            self.assertEqual(FastSerializer(serializer_class, ('id',)).serialize(queryset), sparse)
+
+
+class BulkEndpointTests(APITestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        UserProfile.objects.create(user=self.alice)
+
+    def test_ids_are_fetched_with_one_query_in_the_order_given(self):
+        ids = f'{self.bob.id},999,{self.alice.id},{self.bob.id}'
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('customuser-list'), {'ids': ids, 'fields': 'id,username'})
+        self.assertEqual(response.data['data'], [{'id': self.bob.id, 'username': 'bob'}, {'id': self.alice.id, 'username': 'alice'}])
+        self.assertEqual(response.data['missing'], [999])
+
+        response = self.client.get(reverse('userprofile-list'), {'ids': f'{self.alice.profile.id}', 'fields': 'email'})
+        self.assertEqual(response.data['data'], [{'email': 'alice@example.com'}])
+        self.assertEqual(self.client.get(reverse('message-list'), {'ids': '1,x'}).status_code, 400)
+
+    def test_batches_are_written_together_or_not_at_all(self):
+        url = reverse('message-list')
+        response = self.client.post(url, [
+            {'sender': self.alice.id, 'receiver': self.bob.id, 'content': 'one'},
+            {'sender': self.alice.id, 'receiver': 999, 'content': 'two'},
+            'three',
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['errors'][0], {})
+        self.assertEqual(list(response.data['errors'][1]), ['receiver'])
+        self.assertEqual(Message.objects.count(), 0)
+
+        batch = [{'sender': self.alice.id, 'receiver': self.bob.id, 'content': str(i)} for i in range(3)]
+        response = self.client.post(url, batch, format='json')
+        self.assertEqual([message['content'] for message in response.data['data']], ['0', '1', '2'])
+        self.assertEqual(list(Message.objects.values_list('id', flat=True)), [message['id'] for message in response.data['data']])
+        self.assertEqual(Conversation.objects.get().unread_for(self.bob.id), 3)
+
+        # The number of queries does not grow with the batch
+        with CaptureQueriesContext(connection) as small:
+            self.client.post(url, batch[:1], format='json')
+        with CaptureQueriesContext(connection) as large:
+            self.client.post(url, batch * 10, format='json')
+        self.assertEqual(len(small), len(large))
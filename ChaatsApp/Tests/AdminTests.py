@@ -0,0 +1,51 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+from ChaatsApp.models import CustomUser, Message
+
+
+User = get_user_model()
+
+
+class MessageAdminTests(TestCase):
+    def setUp(self):
+        admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(admin_user)
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.messages = [
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f'message number {i}')
+            for i in range(150)
+        ]
+        self.url = reverse('admin:ChaatsApp_message_changelist')
+
+    def test_pages_are_read_by_keyset(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        changelist = response.context['cl']
+        self.assertTrue(changelist.keyset)
+        self.assertEqual(changelist.result_list[0], self.messages[-1])
+        self.assertIn(f'after={self.messages[50].id}', changelist.next_page_url)
+
+        response = self.client.get(self.url, {'after': self.messages[50].id})
+        changelist = response.context['cl']
+        self.assertEqual(len(changelist.result_list), 50)
+        self.assertIsNone(changelist.next_page_url)
+        self.assertIsNotNone(changelist.first_page_url)
+
+    def test_senders_do_not_cost_a_query_per_row(self):
+        with self.assertNumQueries(4):
+            self.client.get(self.url)
+        Message.objects.create(sender=self.bob, receiver=self.alice, content='one more')
+        with self.assertNumQueries(4):
+            self.client.get(self.url)
+
+    def test_search_uses_prefixes_and_the_full_text_index(self):
+        Message.objects.create(sender=self.bob, receiver=self.alice, content='completely different')
+        carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        Message.objects.create(sender=carol, receiver=self.alice, content='hi')
+
+        response = self.client.get(self.url, {'q': 'different'})
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+        response = self.client.get(self.url, {'q': 'car'})
+        self.assertEqual(len(response.context['cl'].result_list), 1)
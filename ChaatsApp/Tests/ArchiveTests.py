@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from channels.testing import WebsocketCommunicator
+from django.core.management import call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITransactionTestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import Conversation, CustomUser, Message
+from ChaatsApp.partitions import add_months, month_start
+
+
+class MessageArchiveTests(APITransactionTestCase):
+    def setUp(self):
+        self.archive_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.archive_dir)
+        settings_override = override_settings(MESSAGE_ARCHIVE_DIR=self.archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        self.conversation = Conversation.for_users(self.alice.id, self.bob.id)
+        messages = Message.create_batch([
+            Message(conversation=self.conversation, sender=self.alice, receiver=self.bob, content=str(i))
+            for i in range(30)
+        ])
+        lonely = Message.objects.create(sender=self.carol, receiver=self.alice, content='old news')
+
+        # 25 messages spread over two months long gone, the rest recent
+        start = add_months(month_start(timezone.now()), -9)
+        for i, message in enumerate(messages[:25]):
+            Message.objects.filter(pk=message.pk).update(timestamp=start + timedelta(days=2 * i, hours=1))
+        Message.objects.filter(pk=lonely.pk).update(timestamp=start)
+
+        call_command('archive_messages', months=6, stdout=StringIO())
+
+    def test_old_months_move_to_archive_files(self):
+        self.assertEqual(len([name for name in os.listdir(self.archive_dir) if name.endswith('.arc')]), 2)
+        # The newest message of a conversation stays for the inbox
+        self.assertEqual(Message.objects.filter(conversation=self.conversation).count(), 5)
+        self.assertTrue(Message.objects.filter(content='old news').exists())
+
+        output = StringIO()
+        call_command('archive_messages', months=6, dry_run=True, stdout=output)
+        self.assertIn('0 messages would be archived', output.getvalue())
+        self.assertNotRegex(output.getvalue(), r': [1-9]\d* messages')
+
+    def test_rest_history_spans_both_tiers(self):
+        url = reverse('message-list')
+        contents, cursor = [], None
+        while True:
+            params = {'conversation': self.conversation.id, 'page_size': 7, 'fields': 'id,content,timestamp'}
+            response = self.client.get(url, {**params, 'after': cursor} if cursor else params)
+            contents += [message['content'] for message in response.data['data']]
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(contents, [str(i) for i in range(30)])
+
+        # Walking back from a stored message continues into the archive
+        response = self.client.get(url, {'sender_id': self.bob.id, 'receiver_id': self.alice.id, 'page_size': 27})
+        response = self.client.get(url, {'conversation': self.conversation.id, 'page_size': 8, 'before': response.data['next_cursor']})
+        self.assertEqual([message['content'] for message in response.data['data']], [str(i) for i in range(18, 26)])
+        self.assertEqual(response.data['data'][0]['sender'], self.alice.id)
+        self.assertEqual(response.data['data'][0]['conversation'], self.conversation.id)
+
+    async def test_websocket_history_spans_both_tiers(self):
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = self.alice
+        await communicator.connect()
+        try:
+            await communicator.send_json_to({'action': 'message_history', 'receiver_id': self.bob.id, 'page_size': 12})
+            newest = await communicator.receive_json_from()
+            await communicator.send_json_to({
+                'action': 'message_history', 'receiver_id': self.bob.id, 'page_size': 50, 'before': newest['next_cursor'],
+            })
+            oldest = await communicator.receive_json_from()
+        finally:
+            await communicator.disconnect()
+
+        self.assertEqual([message['content'] for message in newest['message_history']], [str(i) for i in range(18, 30)])
+        self.assertEqual([message['content'] for message in oldest['message_history']], [str(i) for i in range(18)])
+        self.assertFalse(oldest['has_more'])
@@ -0,0 +1,140 @@
+import shutil
+import tempfile
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import Attachment, CustomUser, Message
+
+
+class AttachmentDirMixin:
+    def setUp(self):
+        attachment_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, attachment_dir)
+        settings = override_settings(ATTACHMENT_DIR=attachment_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+
+
+class AttachmentUploadTests(AttachmentDirMixin, APITestCase):
+    content = b'0123456789'
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def upload(self, content_type='image/png'):
+        response = self.client.post(reverse('attachment-list'), {
+            'filename': '../photo.png', 'content_type': content_type, 'size': len(self.content),
+        }, format='json')
+        return response.data['data']['id']
+
+    def put_chunk(self, attachment_id, start, end):
+        return self.client.generic(
+            'PUT', reverse('attachment-detail', args=[attachment_id]), self.content[start:end + 1],
+            content_type='application/octet-stream', HTTP_CONTENT_RANGE=f'bytes {start}-{end}/{len(self.content)}',
+        )
+
+    def test_chunks_resume_from_the_stored_offset(self):
+        attachment_id = self.upload()
+        self.assertEqual(self.put_chunk(attachment_id, 0, 3).data['data']['received'], 4)
+
+        # A chunk sent again after a lost response is refused with the offset
+        response = self.put_chunk(attachment_id, 0, 3)
+        self.assertEqual((response.status_code, response.data['data']['received']), (409, 4))
+        self.assertEqual(self.put_chunk(attachment_id, 4, 12).status_code, 400)
+
+        response = self.put_chunk(attachment_id, 4, 9)
+        self.assertTrue(response.data['data']['complete'])
+        self.assertEqual(response.data['data']['filename'], 'photo.png')
+
+        response = self.client.get(reverse('attachment-content', args=[attachment_id]))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual((response['Content-Length'], response['Accept-Ranges']), ('10', 'bytes'))
+        self.assertTrue(response['Content-Disposition'].startswith('inline'))
+
+    def test_ranges_are_served_partially(self):
+        attachment_id = self.upload(content_type='text/html')
+        url = reverse('attachment-content', args=[attachment_id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.put_chunk(attachment_id, 0, 9)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual((response['Content-Range'], response['Content-Length']), ('bytes 2-5/10', '4'))
+        self.assertTrue(response['Content-Disposition'].startswith('attachment'))
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        # A stale If-Range gets the whole file
+        response = self.client.get(url, HTTP_RANGE='bytes=-3', HTTP_IF_RANGE='"other"')
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, self.content))
+
+        response = self.client.get(url, HTTP_RANGE='bytes=10-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */10'))
+
+    def test_only_the_conversation_can_read_sent_attachments(self):
+        attachment_id = self.upload()
+        self.put_chunk(attachment_id, 0, 9)
+        carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        url = reverse('attachment-content', args=[attachment_id])
+
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        message = Message.objects.create(sender=self.alice, receiver=self.bob, content='')
+        self.assertEqual(Attachment.attach(message, [attachment_id]), 1)
+        self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.put_chunk(attachment_id, 0, 9).status_code, 404)
+
+        self.client.force_authenticate(carol)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get(url).status_code, 401)
+
+    def test_token_users_upload_and_read(self):
+        # Through the real authentication rather than force_authenticate
+        self.client.force_authenticate(None)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.alice)}')
+        attachment_id = self.upload()
+        self.assertEqual(Attachment.objects.get(pk=attachment_id).uploader_id, self.alice.id)
+        self.assertTrue(self.put_chunk(attachment_id, 0, 9).data['data']['complete'])
+
+        Attachment.attach(Message.objects.create(sender=self.alice, receiver=self.bob, content=''), [attachment_id])
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.bob)}')
+        response = self.client.get(reverse('attachment-content', args=[attachment_id]))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(self.put_chunk(attachment_id, 0, 9).status_code, 404)
+
+
+class AttachmentMessageTests(AttachmentDirMixin, TransactionTestCase):
+    async def test_messages_carry_attachment_ids(self):
+        attachment = await Attachment.objects.acreate(uploader=self.alice, filename='a.png', size=0)
+        pending = await Attachment.objects.acreate(uploader=self.alice, filename='b.png', size=5)
+
+        sockets = {}
+        for user in (self.alice, self.bob):
+            sockets[user] = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+            sockets[user].scope['user'] = user
+            await sockets[user].connect()
+        try:
+            await sockets[self.alice].send_json_to({'action': 'direct_message', 'receiver_id': self.bob.id, 'attachment_ids': [pending.id]})
+            self.assertEqual((await sockets[self.alice].receive_json_from())['error'], 'Invalid attachments')
+
+            await sockets[self.alice].send_json_to({'action': 'direct_message', 'receiver_id': self.bob.id, 'attachment_ids': [attachment.id]})
+            received = await sockets[self.bob].receive_json_from()
+
+            await sockets[self.bob].send_json_to({'action': 'message_history', 'receiver_id': self.alice.id})
+            history = await sockets[self.bob].receive_json_from()
+        finally:
+            for communicator in sockets.values():
+                await communicator.disconnect()
+
+        self.assertEqual((received['content'], received['attachment_ids']), ('', [attachment.id]))
+        self.assertEqual(history['message_history'][0]['attachment_ids'], [attachment.id])
+        attachment = await Attachment.objects.aget(pk=attachment.pk)
+        self.assertEqual(attachment.message_id, received['message_id'])
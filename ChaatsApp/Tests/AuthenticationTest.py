@@ -0,0 +1,78 @@
+from unittest.mock import patch
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase
+from rest_framework_simplejwt.tokens import AccessToken
+from ChaatsApp import middleware
+from ChaatsApp.consumers import ChatMessage, UserAuthConsumer
+from ChaatsApp.middleware import JWTAuthMiddleware, TokenUserCache
+from ChaatsApp.models import CustomUser, Message
+
+
+User = get_user_model()
+
+
+class JWTAuthMiddlewareTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='test_user', password='test_password')
+        self.token = str(AccessToken.for_user(self.user))
+        self.cache = TokenUserCache()
+        self.application = JWTAuthMiddleware(UserAuthConsumer.as_asgi(), cache=self.cache)
+
+    async def connect(self, path):
+        communicator = WebsocketCommunicator(self.application, path)
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        return connected
+
+    async def test_token_in_query_string_authenticates(self):
+        self.assertTrue(await self.connect(f'/ws/user-authentication/?token={self.token}'))
+
+    async def test_missing_or_invalid_token_is_rejected(self):
+        self.assertFalse(await self.connect('/ws/user-authentication/'))
+        self.assertFalse(await self.connect('/ws/user-authentication/?token=invalid'))
+
+    async def test_verified_tokens_are_cached(self):
+        with patch.object(middleware, 'verify_token', wraps=middleware.verify_token) as verify_token:
+            for _ in range(3):
+                self.assertTrue(await self.connect(f'/ws/user-authentication/?token={self.token}'))
+
+        self.assertEqual(verify_token.call_count, 1)
+
+
+class TokenIdentityTests(TransactionTestCase):
+    async def test_token_users_are_the_users_messages_point_at(self):
+        # An unrelated user first, so ids of other tables would not line up
+        await CustomUser.objects.acreate(username='carol', email='carol@example.com')
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        application = JWTAuthMiddleware(ChatMessage.as_asgi(), cache=TokenUserCache())
+
+        communicator = WebsocketCommunicator(application, f'/ws/chat-message/?token={AccessToken.for_user(alice)}')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        try:
+            await communicator.send_json_to({'action': 'direct_message', 'receiver_id': bob.id, 'content': 'hi'})
+            reply = await communicator.receive_json_from()
+        finally:
+            await communicator.disconnect()
+
+        message = await Message.objects.aget(pk=reply['message_id'])
+        self.assertEqual((message.sender_id, message.receiver_id), (alice.id, bob.id))
+
+
+class TokenUserCacheTests(TransactionTestCase):
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = TokenUserCache(max_size=2)
+        cache.set('a', 'user a', float('inf'))
+        cache.set('b', 'user b', float('inf'))
+        cache.get('a')
+        cache.set('c', 'user c', float('inf'))
+
+        self.assertEqual(cache.get('a'), 'user a')
+        self.assertIsNone(cache.get('b'))
+
+    def test_entries_expire_with_their_token(self):
+        cache = TokenUserCache()
+        cache.set('expired', 'user', 0)
+        self.assertIsNone(cache.get('expired'))
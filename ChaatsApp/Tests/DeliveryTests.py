@@ -0,0 +1,217 @@
+import asyncio
+from unittest import skipUnless
+from unittest.mock import patch
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp import delivery
+from ChaatsApp.delivery import WORKER_ID, GroupDirectory, deliver, join_group, leave_group, local_groups, user_group
+from ChaatsApp.models import Conversation, CustomUser, Message
+from ChaatsApp.writer import MessageWriter, MessageWriteError
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class DirectMessageDeliveryTests(TransactionTestCase):
+    async def connect_as(self, user):
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_message_reaches_every_device_of_both_users(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+
+        alice_socket = await self.connect_as(alice)
+        bob_phone = await self.connect_as(bob)
+        bob_laptop = await self.connect_as(bob)
+        self.assertEqual(len(local_groups[user_group(bob.id)]), 2)
+
+        try:
+            await alice_socket.send_json_to({
+                'action': 'direct_message',
+                'receiver_id': bob.id,
+                'content': 'Hello, Bob!',
+            })
+
+            for socket in (bob_phone, bob_laptop):
+                response = await socket.receive_json_from()
+                self.assertEqual(response['action'], 'direct_message')
+                self.assertEqual(response['sender_id'], alice.id)
+                self.assertEqual(response['content'], 'Hello, Bob!')
+                self.assertTrue(await socket.receive_nothing())
+
+            # The echo to the sender's devices and the ack are not ordered
+            echo, ack = sorted([await alice_socket.receive_json_from() for _ in range(2)], key=lambda frame: frame['action'])
+            self.assertEqual(echo['action'], 'direct_message')
+            self.assertEqual(ack, {'action': 'message_sent', 'message_id': echo['message_id']})
+        finally:
+            for socket in (alice_socket, bob_phone, bob_laptop):
+                await socket.disconnect()
+
+        self.assertNotIn(user_group(bob.id), local_groups)
+
+    async def test_own_events_from_channel_layer_are_ignored(self):
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        bob_socket = await self.connect_as(bob)
+
+        try:
+            channel_layer = get_channel_layer()
+            await channel_layer.group_send(user_group(bob.id), {
+                'type': 'chat.direct_message',
+                'text': '{"action": "direct_message"}',
+                'origin': WORKER_ID,
+            })
+            self.assertTrue(await bob_socket.receive_nothing())
+
+            await channel_layer.group_send(user_group(bob.id), {
+                'type': 'chat.direct_message',
+                'text': '{"action": "direct_message"}',
+                'origin': 'another-worker',
+            })
+            response = await bob_socket.receive_json_from()
+            self.assertEqual(response['action'], 'direct_message')
+        finally:
+            await bob_socket.disconnect()
+
+    async def test_senders_do_not_wait_for_local_receivers(self):
+        class SlowConsumer:
+            channel_layer = None
+
+            def __init__(self):
+                self.events = []
+                self.release = asyncio.Event()
+
+            async def dispatch(self, event):
+                await self.release.wait()
+                self.events.append(event['n'])
+
+        consumer = SlowConsumer()
+        await join_group(consumer, 'slow')
+        try:
+            await asyncio.wait_for(deliver(None, 'slow', {'type': 'test', 'n': 1}), 1)
+            await deliver(None, 'slow', {'type': 'test', 'n': 2})
+            self.assertEqual(consumer.events, [])
+            consumer.release.set()
+            await asyncio.sleep(0.01)
+            self.assertEqual(consumer.events, [1, 2])
+        finally:
+            await leave_group(consumer, 'slow')
+
+
+@skipUnless(fakeredis, 'Needs fakeredis')
+class GroupDirectoryTests(TransactionTestCase):
+    def directory(self, server, worker_id):
+        directory = GroupDirectory('redis://localhost', worker_id=worker_id, retry_interval=0.01)
+        directory.redis = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+        return directory
+
+    async def wait_for(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('Condition not reached')
+
+    async def test_channel_layer_is_skipped_while_no_other_worker_is_in_the_group(self):
+        class ChannelLayer:
+            def __init__(self):
+                self.sent = []
+
+            async def group_add(self, group, channel):
+                pass
+
+            async def group_discard(self, group, channel):
+                pass
+
+            async def group_send(self, group, event):
+                self.sent.append(event['n'])
+
+        class Consumer:
+            channel_name = 'local'
+
+            def __init__(self, channel_layer):
+                self.channel_layer = channel_layer
+                self.events = []
+
+            async def dispatch(self, event):
+                self.events.append(event['n'])
+
+        server = fakeredis.FakeServer()
+        here, elsewhere = self.directory(server, 'here'), self.directory(server, 'elsewhere')
+        channel_layer = ChannelLayer()
+        consumer = Consumer(channel_layer)
+
+        with patch.object(delivery, 'get_group_directory', lambda layer: here):
+            await join_group(consumer, 'group')
+            try:
+                await self.wait_for(lambda: here.subscribed)
+                await deliver(channel_layer, 'group', {'type': 'test', 'n': 1})
+                self.assertEqual(channel_layer.sent, [])
+
+                # Another worker joins, and the next event goes out to it
+                await elsewhere.register('group')
+                await self.wait_for(lambda: 'group' not in here.remote)
+                await deliver(channel_layer, 'group', {'type': 'test', 'n': 2})
+                self.assertEqual(channel_layer.sent, [2])
+
+                await elsewhere.unregister('group')
+                await self.wait_for(lambda: 'group' not in here.remote)
+                await deliver(channel_layer, 'group', {'type': 'test', 'n': 3})
+                self.assertEqual(channel_layer.sent, [2])
+                await asyncio.sleep(0.01)
+                self.assertEqual(consumer.events, [1, 2, 3])
+            finally:
+                await leave_group(consumer, 'group')
+                for directory in (here, elsewhere):
+                    if directory.listener is not None:
+                        directory.listener.cancel()
+
+        self.assertEqual(await here.redis.smembers(here.key('group')), set())
+
+
+class MessageWriterTests(TransactionTestCase):
+    async def test_concurrent_messages_are_written_in_one_batch(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        writer = MessageWriter(batch_size=10, batch_window=0.05)
+
+        with patch.object(Message, 'create_batch', wraps=Message.create_batch) as create_batch:
+            messages = await asyncio.gather(*[
+                writer.submit(Message(sender_id=alice.id, receiver_id=bob.id, content=str(i)))
+                for i in range(5)
+            ])
+
+        self.assertEqual(create_batch.call_count, 1)
+        self.assertTrue(all(message.id for message in messages))
+        conversation = await Conversation.objects.aget()
+        self.assertEqual(conversation.last_message_id, max(message.id for message in messages))
+        self.assertEqual(conversation.unread_for(bob.id), 5)
+
+    async def test_invalid_message_only_fails_itself(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        writer = MessageWriter(batch_size=10, batch_window=0.05)
+
+        good, bad = await asyncio.gather(
+            writer.submit(Message(sender_id=alice.id, receiver_id=bob.id, content='ok')),
+            writer.submit(Message(sender_id=alice.id, receiver_id=bob.id, content=None)),
+            return_exceptions=True,
+        )
+
+        self.assertIsNotNone(good.id)
+        self.assertIsInstance(bad, MessageWriteError)
+        self.assertEqual(await Message.objects.acount(), 1)
+
+    async def test_full_queue_applies_backpressure(self):
+        writer = MessageWriter(queue_size=1)
+        await writer.queue.put(None)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(writer.submit(Message(content='waits')), 0.05)
@@ -0,0 +1,76 @@
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import Conversation, CustomUser, Message
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+
+    def test_new_messages_update_summary(self):
+        Message.objects.create(sender=self.alice, receiver=self.bob, content='hi')
+        last = Message.objects.create(sender=self.alice, receiver=self.bob, content='there')
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message_id, last.id)
+        self.assertEqual(conversation.last_timestamp, last.timestamp)
+        self.assertEqual(conversation.unread_for(self.bob.id), 2)
+        self.assertEqual(conversation.unread_for(self.alice.id), 0)
+
+        Conversation.mark_read(conversation.id, self.bob.id)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.unread_for(self.bob.id), 0)
+
+    def test_inbox_is_newest_first_across_both_sides(self):
+        Message.objects.create(sender=self.alice, receiver=self.bob, content='1')
+        Message.objects.create(sender=self.carol, receiver=self.bob, content='2')
+        Message.objects.create(sender=self.bob, receiver=self.alice, content='3')
+
+        inbox = Conversation.inbox(self.bob.id, limit=1)
+        self.assertEqual(len(inbox), 2)
+        self.assertEqual(inbox[0].other_user_id(self.bob.id), self.alice.id)
+        self.assertEqual(inbox[1].other_user_id(self.bob.id), self.carol.id)
+
+        position = (inbox[0].last_timestamp, inbox[0].id)
+        older = Conversation.inbox(self.bob.id, position, limit=1)
+        self.assertEqual([c.other_user_id(self.bob.id) for c in older], [self.carol.id])
+
+
+class InboxConsumerTests(TransactionTestCase):
+    async def test_inbox_action(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        await Message.objects.acreate(sender=alice, receiver=bob, content='hello')
+
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = bob
+        await communicator.connect()
+
+        try:
+            await communicator.send_json_to({'action': 'inbox'})
+            response = await communicator.receive_json_from()
+            entry, = response['conversations']
+            self.assertEqual(entry['user'], alice.id)
+            self.assertEqual(entry['last_message'], 'hello')
+            self.assertEqual(entry['unread_count'], 1)
+            self.assertIsNone(response['next_cursor'])
+        finally:
+            await communicator.disconnect()
+
+    async def test_mark_read_rejects_invalid_conversation(self):
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = bob
+        await communicator.connect()
+
+        try:
+            for conversation_id in ('abc', None, -1):
+                await communicator.send_json_to({'action': 'mark_read', 'conversation_id': conversation_id})
+                response = await communicator.receive_json_from()
+                self.assertEqual(response, {'action': 'mark_read', 'error': 'Invalid conversation'})
+        finally:
+            await communicator.disconnect()
@@ -0,0 +1,88 @@
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from ChaatsApp.consumers import ChatMessage, HISTORY_FRAME_SIZE
+from ChaatsApp.models import Conversation, CustomUser, Message
+
+
+class MessageHistoryPaginationTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        conversation = Conversation.for_users(self.alice.id, self.bob.id)
+        Message.objects.bulk_create([
+            Message(
+                conversation=conversation,
+                sender=self.alice if i % 2 else self.bob,
+                receiver=self.bob if i % 2 else self.alice,
+                content=str(i),
+            )
+            for i in range(250)
+        ])
+
+    def communicator(self):
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = self.alice
+        return communicator
+
+    async def request_history(self, communicator, **options):
+        await communicator.send_json_to({
+            'action': 'message_history',
+            'receiver_id': self.bob.id,
+            **options,
+        })
+
+        frames = []
+        while True:
+            frame = await communicator.receive_json_from()
+            frames.append(frame)
+            if frame.get('final', True):
+                return frames
+
+    async def test_large_page_is_streamed_in_bounded_frames(self):
+        communicator = self.communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        try:
+            frames = await self.request_history(communicator, page_size=230)
+
+            self.assertEqual([len(f['message_history']) for f in frames], [100, 100, 30])
+            self.assertTrue(all(len(f['message_history']) <= HISTORY_FRAME_SIZE for f in frames))
+            # Newest messages come first, each frame in chronological order
+            self.assertEqual(frames[0]['message_history'][-1]['content'], '249')
+            self.assertEqual(frames[-1]['message_history'][0]['content'], '20')
+            self.assertTrue(frames[-1]['has_more'])
+        finally:
+            await communicator.disconnect()
+
+    async def test_cursors_walk_both_directions(self):
+        communicator = self.communicator()
+        await communicator.connect()
+
+        try:
+            first, = await self.request_history(communicator, page_size=10)
+            older, = await self.request_history(communicator, page_size=10, before=first['next_cursor'])
+            self.assertEqual([m['content'] for m in older['message_history']], [str(i) for i in range(230, 240)])
+
+            newer, = await self.request_history(communicator, page_size=5, after=older['next_cursor'])
+            self.assertEqual([m['content'] for m in newer['message_history']], [str(i) for i in range(231, 236)])
+
+            invalid, = await self.request_history(communicator, before='not-a-cursor')
+            self.assertEqual(invalid['error'], 'Invalid cursor')
+        finally:
+            await communicator.disconnect()
+
+    async def test_unknown_conversation_returns_empty_page(self):
+        communicator = self.communicator()
+        await communicator.connect()
+
+        try:
+            await communicator.send_json_to({
+                'action': 'message_history',
+                'receiver_id': self.alice.id,
+            })
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame['message_history'], [])
+            self.assertFalse(frame['has_more'])
+        finally:
+            await communicator.disconnect()
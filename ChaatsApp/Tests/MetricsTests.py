@@ -0,0 +1,64 @@
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TransactionTestCase
+from django.urls import reverse
+from ChaatsApp import metrics
+from ChaatsApp.consumers import UserProfileConsumer
+from ChaatsApp.models import CustomUser, UserProfile
+
+
+class MetricsTests(TransactionTestCase):
+    def value(self, name, labels, index=None):
+        value = metrics.collect().get((name, labels), 0)
+        return value if index is None or not value else value[index]
+
+    async def test_consumer_actions_are_measured(self):
+        user = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        profile = await UserProfile.objects.acreate(user=user)
+        labels = ('UserProfileConsumer', 'get_profile')
+        queries = self.value('chaats_db_queries_total', labels)
+        samples = sum(self.value('chaats_action_duration_seconds', labels) or [0])
+
+        communicator = WebsocketCommunicator(UserProfileConsumer.as_asgi(), '/ws/user-profile/')
+        communicator.scope['user'] = user
+        await communicator.connect()
+        self.assertEqual(self.value('chaats_active_connections', ('UserProfileConsumer',)), 1)
+
+        await communicator.send_json_to({'action': 'get_profile', 'user_id': profile.id})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'action': 'no_such_action'})
+        await communicator.disconnect()
+
+        self.assertEqual(self.value('chaats_active_connections', ('UserProfileConsumer',)), 0)
+        self.assertGreater(self.value('chaats_db_queries_total', labels), queries)
+        self.assertGreater(sum(self.value('chaats_action_duration_seconds', labels)[:-1]), samples)
+        self.assertTrue(self.value('chaats_action_duration_seconds', ('UserProfileConsumer', 'unknown')))
+
+    async def test_frame_sizes_are_counted_in_bytes(self):
+        user = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        labels = ('UserProfileConsumer', 'in')
+        total = self.value('chaats_frame_size_bytes', labels, -1)
+
+        communicator = WebsocketCommunicator(UserProfileConsumer.as_asgi(), '/ws/user-profile/')
+        communicator.scope['user'] = user
+        await communicator.connect()
+        frame = '{"action": "get_profile", "user_id": "ééé"}'
+        await communicator.send_to(text_data=frame)
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+
+        self.assertEqual(self.value('chaats_frame_size_bytes', labels, -1) - total, len(frame.encode()))
+
+    def test_rest_views_are_measured_and_exposed(self):
+        self.client.get(reverse('userprofile-list'))
+        response = self.client.get(reverse('metrics'))
+
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('# TYPE chaats_action_duration_seconds histogram', body)
+        self.assertIn('chaats_action_duration_seconds_count{endpoint="UserProfileList",action="get"}', body)
+        self.assertIn('chaats_db_queries_total{endpoint="UserProfileList",action="get"}', body)
+
+
+class RenderTests(SimpleTestCase):
+    def test_label_values_are_escaped(self):
+        self.assertEqual(metrics.format_labels(('a',), ('say "hi"\n',)), '{a="say \\"hi\\"\\n"}')
@@ -0,0 +1,128 @@
+import asyncio
+from unittest import skipUnless
+from unittest.mock import patch
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from ChaatsApp import presence
+from ChaatsApp.consumers import ChatConsumer
+from ChaatsApp.models import CustomUser
+from ChaatsApp.presence import LocalPresenceStore, PresenceSweeper, RedisPresenceStore
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class PresenceTests(TransactionTestCase):
+    def setUp(self):
+        patcher = patch.object(presence, '_store', LocalPresenceStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect_as(self, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_subscribers_receive_presence_changes(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+
+        bob_socket = await self.connect_as(bob)
+        await bob_socket.send_json_to({'action': 'presence_subscribe', 'user_ids': [alice.id, bob.id]})
+        snapshot = await bob_socket.receive_json_from()
+        self.assertEqual(snapshot['presence'], {str(alice.id): 'offline', str(bob.id): 'online'})
+
+        alice_phone = await self.connect_as(alice)
+        self.assertEqual(await bob_socket.receive_json_from(), {'action': 'user_status', 'user_id': alice.id, 'status': 'online'})
+
+        # A second device or a heartbeat does not change what others see
+        alice_laptop = await self.connect_as(alice)
+        await alice_phone.send_json_to({'action': 'heartbeat'})
+        self.assertTrue(await bob_socket.receive_nothing())
+
+        await alice_laptop.send_json_to({'action': 'user_status', 'status': 'away'})
+        self.assertEqual(await bob_socket.receive_json_from(), {'action': 'user_status', 'user_id': alice.id, 'status': 'away'})
+
+        await alice_phone.disconnect()
+        self.assertTrue(await bob_socket.receive_nothing())
+        await alice_laptop.disconnect()
+        self.assertEqual(await bob_socket.receive_json_from(), {'action': 'user_status', 'user_id': alice.id, 'status': 'offline'})
+
+        await bob_socket.disconnect()
+
+    async def test_subscribers_hear_when_heartbeats_lapse(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        presence._sweepers[asyncio.get_running_loop()] = PresenceSweeper(interval=0.05)
+
+        bob_socket = await self.connect_as(bob)
+        await bob_socket.send_json_to({'action': 'presence_subscribe', 'user_ids': [str(alice.id)]})
+        await bob_socket.receive_json_from()
+        presence._store.ttl = 0.1
+        alice_socket = await self.connect_as(alice)
+        self.assertEqual((await bob_socket.receive_json_from())['status'], 'online')
+
+        # Alice stays connected but stops sending heartbeats
+        self.assertEqual(await bob_socket.receive_json_from(timeout=1), {'action': 'user_status', 'user_id': alice.id, 'status': 'offline'})
+        await alice_socket.send_json_to({'action': 'heartbeat'})
+        self.assertEqual((await bob_socket.receive_json_from())['status'], 'online')
+
+        await bob_socket.send_json_to({'action': 'presence_unsubscribe', 'user_ids': [alice.id, 'x']})
+        self.assertEqual((await bob_socket.receive_json_from())['error'], 'Invalid subscription')
+        await bob_socket.send_json_to({'action': 'presence_unsubscribe', 'user_ids': [str(alice.id)]})
+        await alice_socket.disconnect()
+        self.assertTrue(await bob_socket.receive_nothing())
+        await bob_socket.disconnect()
+
+    async def test_invalid_status_is_rejected(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        alice_socket = await self.connect_as(alice)
+
+        await alice_socket.send_json_to({'action': 'user_status', 'status': 'invisible-ish'})
+        response = await alice_socket.receive_json_from()
+        self.assertEqual(response['error'], 'Invalid status')
+
+        await alice_socket.disconnect()
+
+
+class LocalPresenceStoreTests(TransactionTestCase):
+    async def test_sockets_expire_without_heartbeats(self):
+        store = LocalPresenceStore(ttl=0)
+        await store.touch(1, 'socket', 'busy')
+        self.assertEqual(await store.get_many([1, 2]), {1: 'offline', 2: 'offline'})
+
+
+@skipUnless(fakeredis, 'Needs fakeredis')
+class RedisPresenceStoreTests(TransactionTestCase):
+    def store(self, ttl=60):
+        store = RedisPresenceStore('redis://localhost', ttl=ttl)
+        store.redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        return store
+
+    async def test_presence_follows_the_users_sockets(self):
+        store = self.store()
+        self.assertEqual(await store.touch(1, 'phone'), ('offline', 'online'))
+        self.assertEqual(await store.touch(1, 'laptop', 'away'), ('online', 'away'))
+        self.assertEqual(await store.touch(1, 'phone'), ('away', 'away'))
+        self.assertEqual(await store.get_many([1, 2]), {1: 'away', 2: 'offline'})
+
+        self.assertEqual(await store.remove(1, 'phone'), ('away', 'away'))
+        self.assertEqual(await store.remove(1, 'laptop'), ('away', 'offline'))
+        self.assertEqual(await store.get_many([1]), {1: 'offline'})
+        self.assertEqual(await store.expire(), [])
+
+    async def test_lapsed_users_are_expired_once(self):
+        store = self.store(ttl=1)
+        await store.touch(1, 'phone', 'busy')
+        await store.touch(2, 'phone')
+        await asyncio.sleep(1.1)
+        await store.touch(2, 'phone')
+
+        self.assertEqual(await store.get_many([1, 2]), {1: 'offline', 2: 'online'})
+        self.assertEqual(await store.expire(), [1])
+        self.assertEqual(await store.expire(), [])
+        self.assertEqual(await store.touch(1, 'phone'), ('offline', 'online'))
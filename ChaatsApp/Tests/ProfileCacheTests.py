@@ -0,0 +1,102 @@
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from ChaatsApp.consumers import UserProfileConsumer
+from ChaatsApp.models import CustomUser, UserProfile
+from ChaatsApp.profile_cache import profile_cache
+
+
+class ProfileCacheTests(APITestCase):
+    def setUp(self):
+        profile_cache.local.clear()
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com', first_name='Alice')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.alice_profile = UserProfile.objects.create(user=self.alice)
+        self.bob_profile = UserProfile.objects.create(user=self.bob)
+
+    def test_get_many_loads_misses_in_one_query(self):
+        with self.assertNumQueries(1):
+            profiles = profile_cache.get_many([self.bob_profile.id, self.alice_profile.id, 999999])
+        self.assertEqual(list(profiles), [self.bob_profile.id, self.alice_profile.id])
+        self.assertEqual(profiles[self.alice_profile.id]['first_name'], 'Alice')
+
+        with self.assertNumQueries(0):
+            profile_cache.get_many([self.alice_profile.id, self.bob_profile.id])
+
+    def test_user_save_invalidates_profile(self):
+        profile_cache.get(self.alice_profile.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.first_name = 'Alicia'
+            self.alice.save(update_fields=['first_name'])
+        self.assertEqual(profile_cache.get(self.alice_profile.id)['first_name'], 'Alicia')
+
+    def test_detail_view_reads_through_cache(self):
+        url = reverse('userprofile-detail', args=[self.alice_profile.id])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['data']['email'], 'alice@example.com')
+
+        response = self.client.get(reverse('userprofile-detail', args=[999999]))
+        self.assertEqual(response.status_code, 404)
+
+
+class ProfileUpdateTests(TransactionTestCase):
+    async def test_users_only_update_their_own_profile(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        await UserProfile.objects.acreate(user=alice)
+        await UserProfile.objects.acreate(user=bob)
+
+        communicator = WebsocketCommunicator(UserProfileConsumer.as_asgi(), '/ws/user-profile/')
+        communicator.scope['user'] = alice
+        await communicator.connect()
+        try:
+            await communicator.send_json_to({'action': 'update_profile', 'user_id': bob.id, 'first_name': 'Mallory'})
+            refused = await communicator.receive_json_from()
+            await communicator.send_json_to({'action': 'update_profile', 'user_id': str(alice.id), 'first_name': 'Alice'})
+            updated = await communicator.receive_json_from()
+        finally:
+            await communicator.disconnect()
+
+        self.assertEqual(refused['error'], 'Permission denied')
+        self.assertIn('message', updated)
+        self.assertEqual((await CustomUser.objects.aget(pk=bob.id)).first_name, '')
+        self.assertEqual((await CustomUser.objects.aget(pk=alice.id)).first_name, 'Alice')
+
+    async def test_invalid_updates_are_refused(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        await UserProfile.objects.acreate(user=alice)
+
+        communicator = WebsocketCommunicator(UserProfileConsumer.as_asgi(), '/ws/user-profile/')
+        communicator.scope['user'] = alice
+        await communicator.connect()
+        try:
+            replies = []
+            for changes in ({'email': 'bob@example.com'}, {'email': 'not-an-email'}, {'profile_picture': '../../etc/passwd'}):
+                await communicator.send_json_to({'action': 'update_profile', **changes})
+                replies.append(await communicator.receive_json_from())
+        finally:
+            await communicator.disconnect()
+
+        for reply, field in zip(replies, ('email', 'email', 'profile_picture')):
+            self.assertEqual(reply['error'], 'Invalid profile')
+            self.assertIn(field, reply['errors'])
+        user = await CustomUser.objects.aget(pk=alice.id)
+        self.assertEqual(user.email, 'alice@example.com')
+        self.assertFalse(user.profile_picture)
+
+    async def test_get_profiles_rejects_invalid_ids(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+
+        communicator = WebsocketCommunicator(UserProfileConsumer.as_asgi(), '/ws/user-profile/')
+        communicator.scope['user'] = alice
+        await communicator.connect()
+        try:
+            for user_ids in (1, '12', ['1', 'x']):
+                await communicator.send_json_to({'action': 'get_profiles', 'user_ids': user_ids})
+                reply = await communicator.receive_json_from()
+                self.assertEqual(reply, {'action': 'get_profiles', 'error': 'Invalid user ids'})
+        finally:
+            await communicator.disconnect()
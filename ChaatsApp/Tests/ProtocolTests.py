@@ -0,0 +1,149 @@
+import msgpack
+from unittest.mock import patch
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.test import TransactionTestCase
+from ChaatsApp import presence
+from ChaatsApp.consumers import ChatMessage, MultiplexConsumer
+from ChaatsApp.protocol import binary_frame, encode_frames
+from ChaatsApp.models import CustomUser, Message
+from ChaatsApp.presence import LocalPresenceStore
+
+
+class MessagePackProtocolTests(TransactionTestCase):
+    async def connect_as(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/', subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_binary_and_text_sockets_talk_to_each_other(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+
+        alice_socket, subprotocol = await self.connect_as(alice, ['msgpack', 'json'])
+        self.assertEqual(subprotocol, 'msgpack')
+        bob_socket, subprotocol = await self.connect_as(bob)
+        self.assertIsNone(subprotocol)
+
+        try:
+            await alice_socket.send_to(bytes_data=msgpack.packb({
+                'action': 'direct_message',
+                'receiver_id': bob.id,
+                'content': 'Hello, Bob!',
+            }))
+
+            response = await bob_socket.receive_json_from()
+            self.assertEqual(response['content'], 'Hello, Bob!')
+
+            # The echo to the sender's devices and the ack are not ordered
+            frames = [msgpack.unpackb(await alice_socket.receive_from()) for _ in range(2)]
+            echo, ack = sorted(frames, key=lambda frame: frame['action'])
+            self.assertEqual(echo['message_id'], response['message_id'])
+            self.assertEqual(ack, {'action': 'message_sent', 'message_id': echo['message_id']})
+        finally:
+            await alice_socket.disconnect()
+            await bob_socket.disconnect()
+
+    def test_binary_frames_are_made_once_when_needed(self):
+        payload = {'action': 'typing', 'sender_id': 1, 'content': 'héllo'}
+        frames = encode_frames(payload)
+        self.assertEqual(list(frames), ['text'])
+
+        with patch('ChaatsApp.protocol.msgpack.packb', wraps=msgpack.packb) as packb:
+            self.assertEqual(msgpack.unpackb(binary_frame(frames)), payload)
+            self.assertIs(binary_frame(frames), frames['bytes'])
+        self.assertEqual(packb.call_count, 1)
+
+    async def test_malformed_frames_get_an_error(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        socket, _ = await self.connect_as(alice, ['msgpack'])
+
+        try:
+            await socket.send_to(bytes_data=b'\xc1')
+            self.assertEqual(msgpack.unpackb(await socket.receive_from()), {'error': 'Invalid frame'})
+        finally:
+            await socket.disconnect()
+
+
+class MultiplexTests(TransactionTestCase):
+    def setUp(self):
+        patcher = patch.object(presence, '_store', LocalPresenceStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def connect_as(self, user, subprotocols=None):
+        communicator = WebsocketCommunicator(MultiplexConsumer.as_asgi(), '/ws/multiplex/', subprotocols=subprotocols)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_streams_share_one_socket(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        alice_socket = await self.connect_as(alice)
+        bob_socket = await self.connect_as(bob, ['msgpack'])
+
+        try:
+            await alice_socket.send_json_to({'stream': 'chat', 'payload': {'action': 'presence_subscribe', 'user_ids': [bob.id]}})
+            response = await alice_socket.receive_json_from()
+            self.assertEqual(response, {'stream': 'chat', 'payload': {'action': 'presence_subscribe', 'presence': {str(bob.id): 'online'}}})
+
+            await bob_socket.send_to(bytes_data=msgpack.packb({'stream': 'chat-message', 'payload': {
+                'action': 'direct_message',
+                'receiver_id': alice.id,
+                'content': 'Hi Alice',
+            }}))
+            response = await alice_socket.receive_json_from()
+            self.assertEqual(response['stream'], 'chat-message')
+            self.assertEqual(response['payload']['content'], 'Hi Alice')
+
+            echo = msgpack.unpackb(await bob_socket.receive_from())
+            self.assertEqual(echo['stream'], 'chat-message')
+            self.assertEqual(echo['payload']['message_id'], response['payload']['message_id'])
+        finally:
+            await alice_socket.disconnect()
+            await bob_socket.disconnect()
+
+    async def test_batch_gets_one_reply_frame(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        socket = await self.connect_as(alice)
+
+        try:
+            await socket.send_json_to({'batch': [
+                {'stream': 'chat', 'payload': {'action': 'user_status', 'status': 'sleeping'}},
+                {'stream': 'user-profile', 'payload': {'action': 'get_profile', 'user_id': 999999}},
+                {'stream': 'nope', 'payload': {}},
+            ]})
+            response = await socket.receive_json_from()
+            self.assertEqual(response, {'batch': [
+                {'stream': 'chat', 'payload': {'action': 'user_status', 'error': 'Invalid status'}},
+                {'stream': 'user-profile', 'payload': {'action': 'get_profile', 'error': 'User not found'}},
+                {'stream': 'nope', 'payload': {'error': 'Invalid stream frame'}},
+            ]})
+            self.assertTrue(await socket.receive_nothing())
+        finally:
+            await socket.disconnect()
+
+    async def test_streamed_replies_leave_the_batch(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        await database_sync_to_async(Message.create_batch)([Message(sender=bob, receiver=alice, content=str(i)) for i in range(3)])
+        socket = await self.connect_as(alice)
+
+        try:
+            with patch('ChaatsApp.consumers.HISTORY_FRAME_SIZE', 2):
+                await socket.send_json_to({'batch': [
+                    {'stream': 'chat-message', 'payload': {'action': 'message_history', 'receiver_id': bob.id, 'page_size': 3}},
+                    {'stream': 'user-profile', 'payload': {'action': 'get_profile', 'user_id': 999999}},
+                ]})
+                frames = [await socket.receive_json_from() for _ in range(3)]
+        finally:
+            await socket.disconnect()
+
+        self.assertEqual([len(frame['payload']['message_history']) for frame in frames[:2]], [2, 1])
+        self.assertEqual(frames[2], {'batch': [
+            {'stream': 'user-profile', 'payload': {'action': 'get_profile', 'error': 'User not found'}},
+        ]})
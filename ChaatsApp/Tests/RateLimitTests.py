@@ -0,0 +1,129 @@
+import asyncio
+from unittest import skipUnless
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from ChaatsApp import ratelimit
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import CustomUser
+from ChaatsApp.protocol import FrameWebsocketConsumer, OVERFLOW_CLOSE_CODE
+from ChaatsApp.ratelimit import TOKEN_BUCKET_SCRIPT, RedisRateLimiter, TokenBucket
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401, fakeredis runs scripts with it
+except ImportError:
+    fakeredis = None
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual([bucket.take(), bucket.take()], [0, 0])
+        self.assertAlmostEqual(bucket.take(), 0.1, places=2)
+        bucket.updated -= 0.1
+        self.assertEqual(bucket.take(), 0)
+
+
+@skipUnless(fakeredis, 'Needs fakeredis and lupa')
+class RedisRateLimiterTests(SimpleTestCase):
+    async def test_buckets_are_kept_in_redis(self):
+        limiter = RedisRateLimiter('redis://localhost')
+        limiter.redis = fakeredis.aioredis.FakeRedis()
+        limiter.script = limiter.redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+        self.assertEqual([await limiter.take('alice', 10, 2) for _ in range(2)], [0, 0])
+        self.assertAlmostEqual(await limiter.take('alice', 10, 2), 0.1, places=2)
+        self.assertEqual(await limiter.take('bob', 10, 2), 0)
+        self.assertGreater(await limiter.redis.pttl('ratelimit:alice'), 0)
+
+        await asyncio.sleep(0.11)
+        self.assertEqual(await limiter.take('alice', 10, 2), 0)
+
+
+@override_settings(RATE_LIMITS={'search': ((0.01, 2), (0.01, 3))})
+class RateLimitConsumerTests(TransactionTestCase):
+    def setUp(self):
+        ratelimit._limiter = None
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+
+    async def search(self, communicator):
+        await communicator.send_json_to({'action': 'search', 'query': 'hello'})
+        return await communicator.receive_json_from()
+
+    async def test_limits_apply_per_socket_and_per_user(self):
+        sockets = [WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/') for _ in range(2)]
+        for communicator in sockets:
+            communicator.scope['user'] = self.alice
+            await communicator.connect()
+        try:
+            replies = [await self.search(sockets[0]) for _ in range(3)]
+            replies += [await self.search(sockets[1]) for _ in range(2)]
+            # Unlimited action classes are not affected
+            await sockets[0].send_json_to({'action': 'inbox'})
+            inbox = await sockets[0].receive_json_from()
+        finally:
+            for communicator in sockets:
+                await communicator.disconnect()
+
+        self.assertEqual(['error' in reply for reply in replies], [False, False, True, False, True])
+        self.assertEqual(replies[2]['error'], 'Rate limit exceeded')
+        self.assertGreater(replies[2]['retry_after'], 0)
+        self.assertEqual(inbox['action'], 'inbox')
+
+
+class OutboundBufferTests(SimpleTestCase):
+    def consumer(self):
+        # A socket whose reader never catches up
+        consumer = FrameWebsocketConsumer()
+        consumer.outbound_limit = 2
+        consumer.written, consumer.sent = [], []
+        consumer.reader = asyncio.Event()
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            await consumer.reader.wait()
+            consumer.written.append(text_data)
+
+        async def base_send(message):
+            consumer.sent.append(message)
+        consumer.send, consumer.base_send = send, base_send
+        return consumer
+
+    async def test_ephemeral_frames_are_shed_before_closing(self):
+        consumer = self.consumer()
+        await consumer.send_frame('message 1')
+        await asyncio.sleep(0)
+        await consumer.send_frame('typing 1', ephemeral=True)
+        await consumer.send_frame('message 2')
+        await consumer.send_frame('typing 2', ephemeral=True)
+        self.assertEqual([frame for frame, _ in consumer.outbound], ['typing 1', 'message 2'])
+
+        # A frame that matters takes the place of a queued ephemeral one
+        await consumer.send_frame('message 3')
+        self.assertEqual([frame for frame, _ in consumer.outbound], ['message 2', 'message 3'])
+        self.assertEqual(consumer.sent, [])
+
+        await consumer.send_frame('message 4')
+        self.assertEqual(consumer.sent, [{'type': 'websocket.close', 'code': OVERFLOW_CLOSE_CODE}])
+        self.assertEqual(len(consumer.outbound), 0)
+        await consumer.send_frame('message 5')
+        self.assertEqual(len(consumer.outbound), 0)
+
+    async def test_frames_are_written_in_order(self):
+        consumer = self.consumer()
+        consumer.outbound_limit = 3
+        consumer.reader.set()
+        for frame in ('a', 'b', 'c'):
+            await consumer.send_frame(frame)
+        await consumer.close()
+        self.assertEqual(consumer.written, ['a', 'b', 'c'])
+        self.assertEqual(consumer.sent, [{'type': 'websocket.close'}])
+
+    async def test_failed_writes_are_logged(self):
+        consumer = self.consumer()
+
+        async def send(text_data=None, bytes_data=None, close=False):
+            raise ConnectionResetError
+        consumer.send = send
+        with self.assertLogs('ChaatsApp.protocol', 'ERROR'):
+            await consumer.send_frame('lost')
+            await asyncio.sleep(0.01)
@@ -0,0 +1,95 @@
+import asyncio
+from unittest import mock
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import Conversation, CustomUser, Message
+from ChaatsApp.receipts import ReceiptBatcher
+
+
+class AcknowledgeTests(TestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        self.first, self.last = Message.create_batch([
+            Message(sender=self.alice, receiver=self.bob, content='hi'),
+            Message(sender=self.alice, receiver=self.bob, content='there'),
+        ])
+        self.conversation = Conversation.objects.get()
+
+    def test_marks_of_many_pairs_are_stored_with_one_update(self):
+        with self.assertNumQueries(2):
+            receipts = Conversation.acknowledge({
+                (self.bob.id, self.conversation.id): (self.last.id, self.first.id),
+                (self.alice.id, self.conversation.id): (self.last.id, self.last.id),
+                (self.carol.id, self.conversation.id): (self.last.id, self.last.id),
+            })
+
+        self.assertEqual(sorted(receipts), sorted([
+            (self.conversation.id, self.bob.id, self.alice.id, self.last.id, self.first.id),
+            (self.conversation.id, self.alice.id, self.bob.id, self.last.id, self.last.id),
+        ]))
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.receipts_for(self.alice.id), (self.last.id, self.first.id))
+        self.assertEqual(self.conversation.unread_for(self.bob.id), 2)
+
+    def test_marks_only_move_forward(self):
+        Conversation.acknowledge({(self.bob.id, self.conversation.id): (0, self.last.id)})
+        Conversation.acknowledge({(self.bob.id, self.conversation.id): (self.first.id, self.first.id)})
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.receipts_for(self.alice.id), (self.last.id, self.last.id))
+        # Reading up to the last message clears the unread count
+        self.assertEqual(self.conversation.unread_for(self.bob.id), 0)
+
+    def test_marks_stop_at_the_last_message(self):
+        Conversation.acknowledge({(self.bob.id, self.conversation.id): (0, self.last.id + 1000)})
+
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.receipts_for(self.alice.id), (self.last.id, self.last.id))
+
+
+class ReceiptBatcherTests(TestCase):
+    async def test_failed_flushes_are_logged_and_the_batcher_goes_on(self):
+        batcher = ReceiptBatcher(window=0.01)
+        with mock.patch.object(Conversation, 'acknowledge', side_effect=[OverflowError, []]) as acknowledge:
+            with self.assertLogs('ChaatsApp.receipts', 'ERROR'):
+                batcher.acknowledge(1, 1, 5, 5)
+                await batcher.task
+            batcher.acknowledge(1, 1, 6, 6)
+            await batcher.task
+        self.assertEqual(acknowledge.call_args.args[0], {(1, 1): (6, 6)})
+
+
+class ReceiptDeliveryTests(TransactionTestCase):
+    async def test_acks_within_a_window_reach_the_sender_as_one_receipt(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        message = await Message.objects.acreate(sender=alice, receiver=bob, content='hi')
+
+        sockets = {}
+        for user in (alice, bob):
+            sockets[user] = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+            sockets[user].scope['user'] = user
+            await sockets[user].connect()
+        try:
+            await sockets[bob].send_json_to({'action': 'ack', 'acks': [{'conversation_id': message.conversation_id, 'delivered': message.id}]})
+            await sockets[bob].send_json_to({'action': 'ack', 'acks': [{'conversation_id': message.conversation_id, 'read': message.id}]})
+            receipt = await sockets[alice].receive_json_from(timeout=2)
+            await asyncio.sleep(0.3)
+            self.assertTrue(await sockets[alice].receive_nothing())
+
+            await sockets[bob].send_json_to({'action': 'ack', 'acks': 'all of them'})
+            error = await sockets[bob].receive_json_from()
+            await sockets[bob].send_json_to({'action': 'ack', 'acks': [{'conversation_id': message.conversation_id, 'read': 2 ** 70}]})
+            overflow = await sockets[bob].receive_json_from()
+        finally:
+            for communicator in sockets.values():
+                await communicator.disconnect()
+
+        self.assertEqual(receipt, {
+            'action': 'receipt', 'conversation_id': message.conversation_id,
+            'user_id': bob.id, 'delivered': message.id, 'read': message.id,
+        })
+        self.assertEqual((error['error'], overflow['error']), ('Invalid acks', 'Invalid acks'))
@@ -3,8 +3,9 @@ from channels.testing import ChannelsLiveServerTestCase
 import json
 from channels.db import database_sync_to_async
 from channels.testing import WebsocketCommunicator
-from django.test import TestCase
-from ChaatsApp.consumers import ChatConsumer  
+from django.test import TransactionTestCase
+from ChaatsApp.consumers import ChatConsumer
+from ChaatsApp.models import CustomUser
 
 
 class UserAuthConsumerTests(ChannelsLiveServerTestCase):
@@ -62,47 +63,49 @@ class ChatMessageConsumerTests(ChannelsLiveServerTestCase):
         await communicator.disconnect()
 
 
-class ChatConsumerTests(TestCase):
-    async def test_chat_consumer(self):
-        # Create a WebSocket communicator for testing
+class ChatConsumerTests(TransactionTestCase):
+    async def connect(self, user):
         communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), "/ws/chat/")
-
-        # Connect to the WebSocket
+        communicator.scope["user"] = user
         connected, _ = await communicator.connect()
         self.assertTrue(connected)
+        return communicator
+
+    async def test_chat_consumer(self):
+        # Sockets need an authenticated user; ids come from the user, not the frames
+        alice = await CustomUser.objects.acreate(username="alice", email="alice@example.com")
+        bob = await CustomUser.objects.acreate(username="bob", email="bob@example.com")
+        alice_socket = await self.connect(alice)
+        bob_socket = await self.connect(bob)
 
         try:
-            # Simulate receiving a message
-            await communicator.send_json_to({
+            await bob_socket.send_json_to({"action": "presence_subscribe", "user_ids": [alice.id]})
+            response = await bob_socket.receive_json_from()
+            self.assertEqual(response["presence"], {str(alice.id): "online"})
+
+            # Typing is sent to the receiver
+            await alice_socket.send_json_to({
                 "action": "typing",
-                "sender_id": 1,
-                "receiver_id": 2,
+                "receiver_id": bob.id,
                 "is_typing": True,
             })
-
-            # Expect to receive a message in response
-            response = await communicator.receive_json_from()
+            response = await bob_socket.receive_json_from(timeout=2)
             self.assertEqual(response["action"], "typing")
-            self.assertEqual(response["sender_id"], 1)
-            self.assertEqual(response["receiver_id"], 2)
+            self.assertEqual(response["sender_id"], alice.id)
+            self.assertEqual(response["receiver_id"], bob.id)
             self.assertEqual(response["is_typing"], True)
 
-            # Simulate another action
-            await communicator.send_json_to({
+            # Status changes reach the user's subscribers
+            await alice_socket.send_json_to({
                 "action": "user_status",
-                "user_id": 1,
-                "status": "online",
+                "status": "away",
             })
-
-            # Expect to receive a message for the user status
-            response = await communicator.receive_json_from()
+            response = await bob_socket.receive_json_from()
             self.assertEqual(response["action"], "user_status")
-            self.assertEqual(response["user_id"], 1)
-            self.assertEqual(response["status"], "online")
+            self.assertEqual(response["user_id"], alice.id)
+            self.assertEqual(response["status"], "away")
 
         finally:
-            # Close the WebSocket
-            await communicator.disconnect()
-
-
-
+            # Close the WebSockets
+            await alice_socket.disconnect()
+            await bob_socket.disconnect()
@@ -0,0 +1,120 @@
+from unittest import mock
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import CustomUser, Room, RoomMessage
+
+
+class RoomMembershipTests(TestCase):
+    def test_shards_grow_with_the_room_and_never_shrink(self):
+        users = [CustomUser.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(5)]
+        room = Room.objects.create(name='general')
+        with mock.patch('ChaatsApp.models.ROOM_SHARD_SIZE', 2):
+            self.assertEqual(len(Room.add_members(room.id, [user.id for user in users])), 5)
+            self.assertEqual(Room.add_members(room.id, [users[0].id]), [])
+            Room.remove_member(room.id, users[0].id)
+            Room.add_members(room.id, [])
+
+        room.refresh_from_db()
+        self.assertEqual((room.member_count, room.shard_count), (4, 4))
+
+
+class RoomConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.users = [CustomUser.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(4)]
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = user
+        await communicator.connect()
+        return communicator
+
+    async def test_messages_are_stored_once_and_reach_every_shard(self):
+        owner, member, joiner, outsider = self.users
+        sockets = {user: await self.connect(user) for user in self.users}
+        try:
+            with mock.patch('ChaatsApp.models.ROOM_SHARD_SIZE', 1):
+                await sockets[owner].send_json_to({'action': 'create_room', 'name': 'general', 'public': True, 'member_ids': [member.id, 'x']})
+                created = await sockets[owner].receive_json_from()
+                room_id = created['room']['id']
+                self.assertEqual((await sockets[owner].receive_json_from())['action'], 'room_joined')
+                self.assertEqual(await sockets[member].receive_json_from(), {'action': 'room_joined', 'room_id': room_id, 'name': 'general'})
+
+                await sockets[joiner].send_json_to({'action': 'join_room', 'room_id': room_id})
+                self.assertEqual((await sockets[joiner].receive_json_from())['action'], 'room_joined')
+
+            await sockets[member].send_json_to({'action': 'room_message', 'room_id': room_id, 'content': 'hello all'})
+            # The sender's own copy and its ack are not ordered
+            frames = sorted([await sockets[member].receive_json_from() for _ in range(2)], key=lambda frame: frame['action'])
+            self.assertEqual([frame['action'] for frame in frames], ['room_message', 'room_message_sent'])
+            for frame in [frames[0]] + [await sockets[user].receive_json_from() for user in (owner, joiner)]:
+                self.assertEqual((frame['action'], frame['content'], frame['sender_id']), ('room_message', 'hello all', member.id))
+            self.assertTrue(await sockets[outsider].receive_nothing())
+
+            await sockets[outsider].send_json_to({'action': 'room_message', 'room_id': room_id, 'content': 'let me in'})
+            self.assertEqual((await sockets[outsider].receive_json_from())['error'], 'Room not found')
+
+            # A socket that connects later joins the rooms of its user
+            late = await self.connect(joiner)
+            await sockets[owner].send_json_to({'action': 'room_message', 'room_id': room_id, 'content': 'welcome'})
+            self.assertEqual((await late.receive_json_from())['content'], 'welcome')
+            await late.disconnect()
+        finally:
+            for communicator in sockets.values():
+                await communicator.disconnect()
+
+        room = await Room.objects.aget(pk=room_id)
+        self.assertEqual((room.member_count, room.shard_count), (3, 4))
+        self.assertEqual(await RoomMessage.objects.acount(), 2)
+
+    async def test_private_rooms_only_take_invited_users(self):
+        owner, member, invited, outsider = self.users
+        sockets = {user: await self.connect(user) for user in self.users}
+        try:
+            await sockets[owner].send_json_to({'action': 'create_room', 'name': 'secret', 'member_ids': [member.id]})
+            room_id = (await sockets[owner].receive_json_from())['room']['id']
+            await sockets[owner].receive_json_from()
+            await sockets[member].receive_json_from()
+
+            # Outsiders can neither join nor invite themselves
+            await sockets[outsider].send_json_to({'action': 'join_room', 'room_id': room_id})
+            self.assertEqual((await sockets[outsider].receive_json_from())['error'], 'Room not found')
+            await sockets[outsider].send_json_to({'action': 'invite_room', 'room_id': room_id, 'member_ids': [outsider.id]})
+            self.assertEqual((await sockets[outsider].receive_json_from())['error'], 'Room not found')
+            await sockets[outsider].send_json_to({'action': 'room_history', 'room_id': room_id})
+            self.assertEqual((await sockets[outsider].receive_json_from())['error'], 'Room not found')
+
+            await sockets[member].send_json_to({'action': 'invite_room', 'room_id': room_id, 'member_ids': [invited.id, owner.id]})
+            self.assertEqual(await sockets[member].receive_json_from(), {'action': 'invite_room', 'room_id': room_id, 'added': [invited.id]})
+            self.assertEqual(await sockets[invited].receive_json_from(), {'action': 'room_joined', 'room_id': room_id, 'name': 'secret'})
+            self.assertTrue(await sockets[outsider].receive_nothing())
+        finally:
+            for communicator in sockets.values():
+                await communicator.disconnect()
+
+        room = await Room.objects.aget(pk=room_id)
+        self.assertEqual((room.is_public, room.member_count), (False, 3))
+
+    async def test_history_pages_backwards(self):
+        owner = self.users[0]
+        room = await Room.objects.acreate(name='general', is_public=True)
+        for i in range(5):
+            await RoomMessage.objects.acreate(room=room, sender=owner, content=str(i))
+
+        communicator = await self.connect(owner)
+        try:
+            await communicator.send_json_to({'action': 'room_history', 'room_id': room.id})
+            self.assertEqual((await communicator.receive_json_from())['error'], 'Room not found')
+
+            await communicator.send_json_to({'action': 'join_room', 'room_id': room.id})
+            await communicator.receive_json_from()
+            await communicator.send_json_to({'action': 'room_history', 'room_id': room.id, 'page_size': 3})
+            newest = await communicator.receive_json_from()
+            await communicator.send_json_to({'action': 'room_history', 'room_id': room.id, 'before': newest['next_cursor']})
+            oldest = await communicator.receive_json_from()
+        finally:
+            await communicator.disconnect()
+
+        self.assertEqual([message['content'] for message in newest['messages']], ['2', '3', '4'])
+        self.assertEqual([message['content'] for message in oldest['messages']], ['0', '1'])
+        self.assertIsNone(oldest['next_cursor'])
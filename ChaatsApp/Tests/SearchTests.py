@@ -0,0 +1,85 @@
+from unittest import skipUnless
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test import TransactionTestCase
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import Conversation, CustomUser, Message
+
+
+class MessageSearchTests(APITestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        for content in ('lunch tomorrow?', 'lunch lunch lunch', 'see you at lunch', 'no thanks'):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=content)
+        Message.objects.create(sender=self.bob, receiver=self.carol, content='lunch without alice')
+        self.client.force_authenticate(self.alice)
+
+    def test_results_are_scoped_and_ranked(self):
+        response = self.client.get(reverse('message-search'), {'q': 'lunch'})
+        self.assertEqual(response.status_code, 200)
+        contents = [result['content'] for result in response.data['data']]
+        self.assertEqual(len(contents), 3)
+        self.assertEqual(contents[0], 'lunch lunch lunch')
+        ranks = [result['rank'] for result in response.data['data']]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_cursor_pages_through_results(self):
+        url = reverse('message-search')
+        response = self.client.get(url, {'q': 'lunch', 'page_size': 2})
+        ids = [result['id'] for result in response.data['data']]
+        response = self.client.get(url, {'q': 'lunch', 'page_size': 2, 'cursor': response.data['next_cursor']})
+        ids += [result['id'] for result in response.data['data']]
+
+        self.assertIsNone(response.data['next_cursor'])
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_query_syntax_is_not_interpreted(self):
+        response = self.client.get(reverse('message-search'), {'q': '"lunch* (', 'fields': 'id,content'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data['data'][0]), {'id', 'content', 'rank'})
+
+        response = self.client.get(reverse('message-search'), {'q': 'lunch', 'cursor': 'nope'})
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Needs a PostgreSQL server')
+class PostgresSearchTests(APITestCase):
+    def test_cursor_ranks_match_their_rows(self):
+        alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        for content in ('lunch', 'lunch at noon', 'lunch lunch', 'a long message that mentions lunch once'):
+            Message.objects.create(sender=alice, receiver=bob, content=content)
+        self.client.force_authenticate(alice)
+
+        ids, cursor = [], None
+        for _ in range(5):
+            response = self.client.get(reverse('message-search'), {'q': 'lunch', 'page_size': 1, **({'cursor': cursor} if cursor else {})})
+            ids += [result['id'] for result in response.data['data']]
+            cursor = response.data['next_cursor']
+            if cursor is None:
+                break
+        self.assertEqual(sorted(ids), sorted(Message.objects.values_list('id', flat=True)))
+
+
+class SearchConsumerTests(TransactionTestCase):
+    async def test_search_action(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+        await Message.objects.acreate(sender=alice, receiver=bob, content='meeting moved to friday')
+        conversation_id = await Conversation.objects.values_list('id', flat=True).aget()
+
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = bob
+        await communicator.connect()
+        try:
+            await communicator.send_json_to({'action': 'search', 'query': 'friday', 'conversation_id': conversation_id})
+            response = await communicator.receive_json_from()
+        finally:
+            await communicator.disconnect()
+
+        self.assertEqual([result['content'] for result in response['results']], ['meeting moved to friday'])
+        self.assertIsNone(response['next_cursor'])
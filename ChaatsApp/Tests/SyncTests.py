@@ -0,0 +1,80 @@
+from channels.testing import WebsocketCommunicator
+from django.test import TestCase, TransactionTestCase
+from ChaatsApp.consumers import ChatMessage
+from ChaatsApp.models import Conversation, CustomUser, Message, MessageChange
+
+
+class MessageChangeTests(TestCase):
+    def test_each_user_gets_a_gapless_sequence(self):
+        alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        Message.create_batch([Message(sender=alice, receiver=bob, content='a'), Message(sender=carol, receiver=alice, content='b')])
+        message = Message.objects.create(sender=bob, receiver=carol, content='c')
+        message.content = 'c!'
+        message.save()
+
+        seqs = lambda user: list(MessageChange.objects.filter(user=user).order_by('seq').values_list('seq', 'kind'))
+        self.assertEqual(seqs(alice), [(1, 'created'), (2, 'created')])
+        self.assertEqual(seqs(carol), [(1, 'created'), (2, 'created'), (3, 'edited')])
+        alice.refresh_from_db()
+        self.assertEqual(alice.change_seq, 2)
+
+
+class SyncConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        self.bob = CustomUser.objects.create(username='bob', email='bob@example.com')
+        self.carol = CustomUser.objects.create(username='carol', email='carol@example.com')
+        self.messages = Message.create_batch(
+            [Message(sender=self.bob, receiver=self.alice, content=f'bob {i}') for i in range(3)] +
+            [Message(sender=self.carol, receiver=self.alice, content=f'carol {i}') for i in range(2)]
+        )
+
+    async def sync(self, **options):
+        communicator = WebsocketCommunicator(ChatMessage.as_asgi(), '/ws/chat-message/')
+        communicator.scope['user'] = self.alice
+        await communicator.connect()
+        try:
+            await communicator.send_json_to({'action': 'sync', **options})
+            return await communicator.receive_json_from()
+        finally:
+            await communicator.disconnect()
+
+    async def test_only_changes_after_the_marks_are_returned(self):
+        response = await self.sync(page_size=3)
+        self.assertEqual([change['content'] for change in response['changes']], ['bob 0', 'bob 1', 'bob 2'])
+        self.assertTrue(response['has_more'])
+        response = await self.sync(since=response['seq'])
+        self.assertEqual([change['content'] for change in response['changes']], ['carol 0', 'carol 1'])
+        self.assertEqual((response['seq'], response['has_more']), (5, False))
+
+        edited, deleted = self.messages[0], self.messages[3]
+        deleted_id = deleted.id
+        edited.content = 'bob 0 (edited)'
+        await edited.asave()
+        await deleted.adelete()
+        await Message.objects.acreate(sender=self.bob, receiver=self.alice, content='bob 3')
+
+        response = await self.sync(since=5)
+        changes = [(change['change'], change['message_id']) for change in response['changes']]
+        self.assertEqual(changes[:2], [('edited', edited.id), ('deleted', deleted_id)])
+        self.assertEqual(response['changes'][0]['content'], 'bob 0 (edited)')
+        self.assertEqual(response['changes'][2]['content'], 'bob 3')
+
+    async def test_conversation_marks_override_since(self):
+        bob_conversation = await Conversation.objects.filter(user_low=self.alice, user_high=self.bob).values_list('id', flat=True).aget()
+        response = await self.sync(since=5, marks={str(bob_conversation): 1})
+        self.assertEqual([change['content'] for change in response['changes']], ['bob 1', 'bob 2'])
+
+        # Paging keeps the marks that are still ahead
+        carol_conversation = await Conversation.objects.filter(user_low=self.alice, user_high=self.carol).values_list('id', flat=True).aget()
+        response = await self.sync(marks={str(carol_conversation): 4}, page_size=2)
+        self.assertEqual([change['content'] for change in response['changes']], ['bob 0', 'bob 1'])
+        self.assertEqual((response['seq'], response['marks'], response['has_more']), (2, {str(carol_conversation): 4}, True))
+        response = await self.sync(since=response['seq'], marks=response['marks'])
+        self.assertEqual([change['content'] for change in response['changes']], ['bob 2', 'carol 1'])
+        self.assertEqual((response['seq'], response['marks'], response['has_more']), (5, {}, False))
+
+        response = await self.sync(marks={'oops': 1})
+        self.assertEqual(response['error'], 'Invalid marks')
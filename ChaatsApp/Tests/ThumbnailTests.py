@@ -0,0 +1,124 @@
+import io
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import Future
+from unittest import mock
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from PIL import Image
+from ChaatsApp.fast_serializers import FastSerializer
+from ChaatsApp.models import CustomUser, UserProfile
+from ChaatsApp.serializers import UserProfileSerializer
+from ChaatsApp import thumbnails
+from ChaatsApp.thumbnails import THUMBNAIL_SIZES, get_thumbnail_pool, render_thumbnails, schedule_thumbnails, store_thumbnails, thumbnail_name
+
+
+def picture(width=900, height=600):
+    output = io.BytesIO()
+    exif = Image.Exif()
+    exif[0x010F] = 'Camera maker'
+    Image.new('RGB', (width, height), 'red').save(output, 'JPEG', exif=exif)
+    return output.getvalue()
+
+
+class RenderTests(SimpleTestCase):
+    def test_pictures_become_square_thumbnails_without_metadata(self):
+        digest, thumbnails = render_thumbnails(picture())
+        self.assertEqual(sorted(thumbnails), sorted(THUMBNAIL_SIZES.values()))
+        for size, content in thumbnails.items():
+            with Image.open(io.BytesIO(content)) as image:
+                self.assertEqual((image.format, image.size), ('JPEG', (size, size)))
+                self.assertEqual(len(image.getexif()), 0)
+
+        # Names follow the content
+        self.assertEqual(render_thumbnails(picture())[0], digest)
+        self.assertNotEqual(render_thumbnails(picture(600, 900))[0], digest)
+
+    def test_garbage_is_rejected(self):
+        with self.assertRaises(Exception):
+            render_thumbnails(b'not an image')
+
+
+class ThumbnailStorageMixin:
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.alice = CustomUser.objects.create(username='alice', email='alice@example.com')
+        UserProfile.objects.create(user=self.alice)
+
+    def set_picture(self, content):
+        self.alice.profile_picture.save('alice.jpg', ContentFile(content))
+        return self.alice.profile_picture.name
+
+
+class StoreTests(ThumbnailStorageMixin, TestCase):
+    def test_new_pictures_are_scheduled_once_committed(self):
+        with mock.patch('ChaatsApp.signals.schedule_thumbnails') as schedule:
+            with self.captureOnCommitCallbacks(execute=True):
+                name = self.set_picture(picture())
+                self.alice.first_name = 'Alice'
+                self.alice.save(update_fields=['first_name'])
+            with self.captureOnCommitCallbacks(execute=True):
+                self.alice.save()
+        schedule.assert_called_once_with(self.alice.id, name)
+
+    def test_profiles_list_the_thumbnail_urls(self):
+        with mock.patch('ChaatsApp.signals.schedule_thumbnails'):
+            name = self.set_picture(picture())
+        profile, = FastSerializer(UserProfileSerializer).serialize(UserProfile.objects.all())
+        self.assertIsNone(profile['profile_thumbnails'])
+
+        future = Future()
+        future.set_result(render_thumbnails(picture()))
+        store_thumbnails(self.alice.id, name, future)
+
+        digest = CustomUser.objects.get(pk=self.alice.id).profile_picture_digest
+        profile, = FastSerializer(UserProfileSerializer).serialize(UserProfile.objects.all())
+        self.assertEqual(profile['profile_thumbnails'], {
+            label: f'/media/{thumbnail_name(digest, size)}' for label, size in THUMBNAIL_SIZES.items()
+        })
+        self.assertEqual(UserProfileSerializer(UserProfile.objects.get()).data['profile_thumbnails'], profile['profile_thumbnails'])
+        self.assertTrue(all(default_storage.exists(thumbnail_name(digest, size)) for size in THUMBNAIL_SIZES.values()))
+
+    def test_thumbnails_of_a_replaced_picture_are_dropped(self):
+        with mock.patch('ChaatsApp.signals.schedule_thumbnails'):
+            name = self.set_picture(picture())
+            self.set_picture(picture(600, 900))
+        future = Future()
+        future.set_result(render_thumbnails(picture()))
+        store_thumbnails(self.alice.id, name, future)
+        self.assertEqual(CustomUser.objects.get(pk=self.alice.id).profile_picture_digest, '')
+
+
+class PoolTests(ThumbnailStorageMixin, TransactionTestCase):
+    def setUp(self):
+        super().setUp()
+        # Workers read the picture themselves, from the media root they are
+        # started with
+        for patcher in (mock.patch.dict(os.environ, {'MEDIA_ROOT': default_storage.location}), mock.patch.object(thumbnails, '_pool', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: thumbnails._pool.shutdown())
+        get_thumbnail_pool()
+
+    def test_thumbnails_are_made_in_the_pool(self):
+        with mock.patch('ChaatsApp.signals.schedule_thumbnails'):
+            name = self.set_picture(picture())
+        schedule_thumbnails(self.alice.id, name).result(timeout=30)
+
+        deadline = time.monotonic() + 10
+        while not CustomUser.objects.get(pk=self.alice.id).profile_picture_digest and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(CustomUser.objects.get(pk=self.alice.id).profile_picture_digest, render_thumbnails(picture())[0])
+
+    def test_unreadable_pictures_are_dropped(self):
+        with mock.patch('ChaatsApp.signals.schedule_thumbnails'):
+            name = self.set_picture(b'')
+        with self.assertRaises(ValueError):
+            schedule_thumbnails(self.alice.id, name).result(timeout=30)
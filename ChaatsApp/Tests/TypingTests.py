@@ -0,0 +1,90 @@
+import asyncio
+from unittest.mock import patch
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TransactionTestCase
+from ChaatsApp import presence
+from ChaatsApp.consumers import ChatConsumer
+from ChaatsApp.indicators import TypingDebouncer
+from ChaatsApp.models import CustomUser
+from ChaatsApp.presence import LocalPresenceStore
+
+
+class TypingDebouncerTests(SimpleTestCase):
+    def debouncer(self, **options):
+        self.sent = []
+
+        async def send(sender_id, receiver_id, is_typing):
+            self.sent.append(is_typing)
+
+        return TypingDebouncer(send, **options)
+
+    async def test_repeated_states_are_dropped(self):
+        debouncer = self.debouncer(min_interval=0.01, timeout=1)
+        for _ in range(5):
+            await debouncer.update(1, 2, True)
+        self.assertEqual(self.sent, [True])
+
+    async def test_quick_flips_are_coalesced(self):
+        debouncer = self.debouncer(min_interval=0.05, timeout=1)
+        await debouncer.update(1, 2, True)
+        await debouncer.update(1, 2, False)
+        await debouncer.update(1, 2, True)
+        await debouncer.update(1, 2, False)
+        self.assertEqual(self.sent, [True])
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True, False])
+
+    async def test_typing_expires_without_refresh(self):
+        debouncer = self.debouncer(min_interval=0.01, timeout=0.05)
+        await debouncer.update(1, 2, True)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.sent, [True, False])
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(debouncer.states, {})
+
+    async def test_failed_timer_sends_are_logged(self):
+        async def send(sender_id, receiver_id, is_typing):
+            if not is_typing:
+                raise ConnectionError
+
+        debouncer = TypingDebouncer(send, min_interval=0.01, timeout=0.02)
+        await debouncer.update(1, 2, True)
+        with self.assertLogs('ChaatsApp.protocol', 'ERROR'):
+            await asyncio.sleep(0.05)
+        self.assertEqual(debouncer.tasks, set())
+
+
+class TypingConsumerTests(TransactionTestCase):
+    def setUp(self):
+        patcher = patch.object(presence, '_store', LocalPresenceStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_typing_reaches_the_receiver_only(self):
+        alice = await CustomUser.objects.acreate(username='alice', email='alice@example.com')
+        bob = await CustomUser.objects.acreate(username='bob', email='bob@example.com')
+
+        sockets = []
+        for user in (alice, bob):
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), '/ws/chat/')
+            communicator.scope['user'] = user
+            await communicator.connect()
+            sockets.append(communicator)
+        alice_socket, bob_socket = sockets
+
+        try:
+            for receiver_id in (str(bob.id), bob.id, bob.id):
+                await alice_socket.send_json_to({'action': 'typing', 'receiver_id': receiver_id, 'is_typing': True})
+
+            response = await bob_socket.receive_json_from()
+            self.assertEqual(response, {'action': 'typing', 'sender_id': alice.id, 'receiver_id': bob.id, 'is_typing': True})
+            self.assertTrue(await bob_socket.receive_nothing())
+            self.assertTrue(await alice_socket.receive_nothing())
+
+            await alice_socket.send_json_to({'action': 'typing', 'receiver_id': 'bob', 'is_typing': True})
+            self.assertEqual((await alice_socket.receive_json_from())['error'], 'Invalid receiver')
+        finally:
+            for communicator in sockets:
+                await communicator.disconnect()
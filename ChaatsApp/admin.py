@@ -1,21 +1,133 @@
+import json
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 from .models import CustomUser, UserProfile, Message
+from .search import matching_ids
 from django.contrib.auth.admin import UserAdmin
 
-class CustomUserAdmin(UserAdmin):
+
+# Above this many rows changelists show the planner's estimate instead of
+# running an exact COUNT(*)
+APPROXIMATE_COUNT_THRESHOLD = 10000
+CURSOR_VAR = 'after'
+
+
+def estimate_count(queryset):
+    # Row estimate from the Postgres planner statistics, None elsewhere
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ApproximateCountPaginator(Paginator):
+    approximate = False
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > APPROXIMATE_COUNT_THRESHOLD:
+            self.approximate = True
+            return estimate
+        return super().count
+
+
+class KeysetChangeList(ChangeList):
+    # While the list is ordered by primary key alone, pages are read with
+    # WHERE pk < cursor instead of OFFSET and linked through ?after=
+    keyset = False
+    next_page_url = None
+    first_page_url = None
+
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(CURSOR_VAR, None)
+        return lookup_params
+
+    def keyset_direction(self, request):
+        ordering = self.get_ordering(request, self.root_queryset.order_by())
+        pk_names = {'pk', self.lookup_opts.pk.name, self.lookup_opts.pk.attname}
+        if len(ordering) != 1 or not isinstance(ordering[0], str) or ordering[0].lstrip('-') not in pk_names:
+            return None
+        return 'lt' if ordering[0].startswith('-') else 'gt'
+
+    def get_results(self, request):
+        direction = self.keyset_direction(request)
+        if direction is None or self.model_admin.list_editable:
+            return super().get_results(request)
+
+        cursor = request.GET.get(CURSOR_VAR)
+        queryset = self.queryset
+        if cursor:
+            try:
+                queryset = queryset.filter(**{f'pk__{direction}': int(cursor)})
+            except ValueError:
+                raise IncorrectLookupParameters
+
+        rows = list(queryset[:self.list_per_page + 1])
+        if len(rows) > self.list_per_page:
+            rows = rows[:self.list_per_page]
+            self.next_page_url = self.get_query_string({CURSOR_VAR: rows[-1].pk})
+        if cursor:
+            self.first_page_url = self.get_query_string(remove=[CURSOR_VAR])
+
+        self.keyset = True
+        self.paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        self.result_count = self.paginator.count
+        self.show_full_result_count = False
+        self.show_admin_actions = True
+        self.full_result_count = None
+        self.result_list = rows
+        self.can_show_all = False
+        self.multi_page = bool(self.next_page_url or self.first_page_url)
+
+
+class ScalableChangeListMixin:
+    # Changelists that stay fast on large tables: no exact counts over big
+    # tables, no OFFSET paging and no unfiltered full-table counts
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
+    ordering = ('-id',)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class CustomUserAdmin(ScalableChangeListMixin, UserAdmin):
     list_display = ('username', 'email', 'first_name', 'last_name', 'profile_picture', 'is_staff')
-    search_fields = ('username', 'email', 'first_name', 'last_name')
-    
+    # Prefix matches can use the varchar_pattern_ops indexes
+    search_fields = ('username__startswith', 'email__startswith')
+
 admin.site.register(CustomUser, CustomUserAdmin)
 
 
 @admin.register(UserProfile)
-class UserProfileAdmin(admin.ModelAdmin):
+class UserProfileAdmin(ScalableChangeListMixin, admin.ModelAdmin):
     list_display = ('user',)
-    search_fields = ('user__username',)
+    list_select_related = ('user',)
+    search_fields = ('user__username__startswith',)
 
 @admin.register(Message)
-class MessageAdmin(admin.ModelAdmin):
+class MessageAdmin(ScalableChangeListMixin, admin.ModelAdmin):
     list_display = ('sender', 'receiver', 'timestamp')
+    list_select_related = ('sender', 'receiver')
     list_filter = ('timestamp',)
-    search_fields = ('sender__username', 'receiver__username', 'content')
+    search_fields = ('sender__username__startswith', 'receiver__username__startswith')
+
+    def get_search_results(self, request, queryset, search_term):
+        # Content is matched through the full-text index
+        results, may_have_duplicates = super().get_search_results(request, queryset, search_term)
+        matches = matching_ids(search_term) if search_term else None
+        if matches is not None:
+            results = results | queryset.filter(id__in=matches)
+        return results, may_have_duplicates
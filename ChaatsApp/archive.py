@@ -0,0 +1,204 @@
+import heapq
+import mmap
+import os
+import re
+import struct
+import zlib
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+from datetime import datetime, timedelta, timezone as dt_timezone
+import msgpack
+from django.conf import settings
+from .cache import LRUCache
+
+
+# Cold messages live in one file per month, written by the archive_messages
+# command. A file holds one zlib-compressed msgpack block per conversation
+# and, at its end, an index of the blocks sorted by conversation id, so a
+# conversation is found by binary search over the memory-mapped index and
+# only its own block is ever decompressed.
+ARCHIVE_MAGIC = b'CHATARC1'
+HEADER = struct.Struct('<8sIQ')  # magic, block count, index offset
+# conversation id, block offset, block length, message count, then the
+# (timestamp in microseconds, id) of the first and last message
+INDEX_ENTRY = struct.Struct('<qQIIqqqq')
+ARCHIVE_FILE_PATTERN = re.compile(r'^messages-(\d{4})-(\d{2})\.arc$')
+ARCHIVE_BLOCK_CACHE_SIZE = 256
+ARCHIVE_BLOCK_CACHE_TTL = 300
+
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+ArchivedMessage = namedtuple('ArchivedMessage', 'id conversation_id sender_id receiver_id content timestamp')
+
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def archive_dir():
+    return str(settings.MESSAGE_ARCHIVE_DIR)
+
+
+def archive_path(month):
+    return os.path.join(archive_dir(), f'messages-{month:%Y-%m}.arc')
+
+
+def merge_conversations(*sources):
+    # Merge streams of (conversation_id, messages) sorted by conversation id,
+    # combining the messages of a conversation found in several of them
+    for conversation_id, group in groupby(heapq.merge(*sources, key=itemgetter(0)), key=itemgetter(0)):
+        messages = {}
+        for _, batch in group:
+            for message in batch:
+                messages[message.id] = message
+        yield conversation_id, sorted(messages.values(), key=lambda message: (message.timestamp, message.id))
+
+
+def archived_row(message, columns):
+    # An archived message as a values_list() row of the given columns
+    return tuple(getattr(message, column if column in ArchivedMessage._fields else f'{column}_id') for column in columns)
+
+
+def write_archive(path, conversations):
+    # conversations yields (conversation_id, messages) in increasing
+    # conversation id order, each message list sorted by (timestamp, id).
+    # The file is written next to its destination and renamed over it.
+    entries = []
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(ARCHIVE_MAGIC, 0, 0))
+        for conversation_id, messages in conversations:
+            if not messages:
+                continue
+            block = zlib.compress(msgpack.packb([
+                (message.id, message.sender_id, message.receiver_id, message.content, to_micros(message.timestamp))
+                for message in messages
+            ], use_bin_type=True))
+            first, last = messages[0], messages[-1]
+            entries.append(INDEX_ENTRY.pack(
+                conversation_id, f.tell(), len(block), len(messages),
+                to_micros(first.timestamp), first.id, to_micros(last.timestamp), last.id,
+            ))
+            f.write(block)
+
+        index_offset = f.tell()
+        f.write(b''.join(entries))
+        f.seek(0)
+        f.write(HEADER.pack(ARCHIVE_MAGIC, len(entries), index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ArchiveFile:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.index_offset = HEADER.unpack_from(self.mmap, 0)
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f'{path} is not a message archive')
+
+    def entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.mmap, self.index_offset + position * INDEX_ENTRY.size)
+
+    def find(self, conversation_id):
+        # Index entry of a conversation, or None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self.entry(middle)
+            if entry[0] == conversation_id:
+                return entry
+            if entry[0] < conversation_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def conversations(self):
+        for position in range(self.count):
+            entry = self.entry(position)
+            yield entry[0], self.read_block(entry)
+
+    def read_block(self, entry):
+        conversation_id, offset, length = entry[:3]
+        rows = msgpack.unpackb(zlib.decompress(self.mmap[offset:offset + length]), raw=False)
+        return [
+            ArchivedMessage(message_id, conversation_id, sender_id, receiver_id, content, from_micros(micros))
+            for message_id, sender_id, receiver_id, content, micros in rows
+        ]
+
+    def close(self):
+        self.mmap.close()
+
+
+class MessageArchive:
+    # Read side of the archive files of one directory
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.files = {}
+        self.listing = (None, [])
+        self.blocks = LRUCache(ARCHIVE_BLOCK_CACHE_SIZE, ARCHIVE_BLOCK_CACHE_TTL)
+
+    def months(self):
+        # Archive files oldest first, re-listed only when the directory changes
+        directory = self.directory or archive_dir()
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if self.listing[0] != (directory, mtime):
+            names = sorted(name for name in os.listdir(directory) if ARCHIVE_FILE_PATTERN.match(name))
+            self.listing = ((directory, mtime), [os.path.join(directory, name) for name in names])
+            self.reset()
+        return self.listing[1]
+
+    def reset(self):
+        for archive_file in self.files.values():
+            archive_file.close()
+        self.files = {}
+        self.blocks.clear()
+
+    def open(self, path):
+        if path not in self.files:
+            self.files[path] = ArchiveFile(path)
+        return self.files[path]
+
+    def read_history(self, conversation_id, position, direction, limit, since=None, until=None):
+        # Archived messages of a conversation strictly after/before the
+        # (timestamp, id) position, nearest first, like keyset_filter()
+        after = direction == 'after'
+        key = position and (to_micros(position[0]), position[1])
+        messages = []
+        for path in (self.months() if after else reversed(self.months())):
+            archive_file = self.open(path)
+            entry = archive_file.find(conversation_id)
+            if entry is None:
+                continue
+            first, last = (entry[4], entry[5]), (entry[6], entry[7])
+            if key is not None and (last <= key if after else first >= key):
+                continue
+
+            block = self.blocks.get((path, conversation_id))
+            if block is None:
+                block = archive_file.read_block(entry)
+                self.blocks.set((path, conversation_id), block)
+            for message in (block if after else reversed(block)):
+                message_key = (to_micros(message.timestamp), message.id)
+                if key is not None and (message_key <= key if after else message_key >= key):
+                    continue
+                if (since and message.timestamp < since) or (until and message.timestamp >= until):
+                    continue
+                messages.append(message)
+                if len(messages) >= limit:
+                    return messages
+        return messages
+
+
+message_archive = MessageArchive()
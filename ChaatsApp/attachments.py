@@ -0,0 +1,122 @@
+import os
+import re
+from django.conf import settings
+from django.http import FileResponse
+
+
+ATTACHMENT_MAX_SIZE = 100 * 1024 * 1024
+# Upper bound of one PUT; clients may send smaller chunks
+ATTACHMENT_MAX_CHUNK = 8 * 1024 * 1024
+ATTACHMENT_BLOCK_SIZE = 64 * 1024
+INLINE_TYPES = ('image/', 'audio/', 'video/')
+
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def attachment_dir():
+    return str(settings.ATTACHMENT_DIR)
+
+
+def attachment_path(attachment_id):
+    # Grouped by thousands so no directory grows without bound
+    return os.path.join(attachment_dir(), str(attachment_id // 1000), str(attachment_id))
+
+
+def create_file(attachment_id):
+    path = attachment_path(attachment_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+
+
+def parse_content_range(value, size):
+    # 'bytes start-end/total' of an upload chunk as (start, length)
+    match = CONTENT_RANGE.match(value or '')
+    if match is None:
+        raise ValueError('Invalid Content-Range')
+    start, end, total = (int(group) for group in match.groups())
+    if total != size or start > end or end >= size or end - start + 1 > ATTACHMENT_MAX_CHUNK:
+        raise ValueError('Invalid Content-Range')
+    return start, end - start + 1
+
+
+def write_chunk(attachment_id, stream, start, length):
+    # Copies up to length bytes of the request body to the file at start,
+    # one block at a time. Returns the bytes written, which is less than
+    # length when the client went away; the upload resumes after them.
+    written = 0
+    with open(attachment_path(attachment_id), 'r+b') as file:
+        file.seek(start)
+        while written < length:
+            block = stream.read(min(ATTACHMENT_BLOCK_SIZE, length - written))
+            if not block:
+                break
+            file.write(block)
+            written += len(block)
+        file.flush()
+        os.fsync(file.fileno())
+    return written
+
+
+def parse_range(value, size):
+    # (start, length) of a single 'bytes=' range, None to send the whole
+    # file. Several ranges are answered with the whole file as well.
+    match = RANGE.match(value or '')
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        # The last n bytes
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start >= size or start > end:
+        raise ValueError('Range not satisfiable')
+    return start, end - start + 1
+
+
+class FileRange:
+    # The part of an open file FileResponse streams for a range request
+    def __init__(self, file, start, length):
+        file.seek(start)
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def attachment_response(attachment, range_header, if_range):
+    # The file, or the requested part of it with a 206. Uploaded files never
+    # change, so the ETag only has to tell attachments apart.
+    etag = f'"attachment-{attachment.id}-{attachment.size}"'
+    requested = None
+    if range_header and (not if_range or if_range == etag):
+        requested = parse_range(range_header, attachment.size)
+
+    # Only media is shown inline; anything else, e.g. HTML or SVG, which
+    # can carry scripts, is downloaded
+    inline = attachment.content_type.startswith(INLINE_TYPES) and attachment.content_type != 'image/svg+xml'
+    options = {'content_type': attachment.content_type, 'filename': attachment.filename, 'as_attachment': not inline}
+    file = open(attachment_path(attachment.id), 'rb')
+    if requested is None:
+        response = FileResponse(file, **options)
+    else:
+        start, length = requested
+        response = FileResponse(FileRange(file, start, length), status=206, **options)
+        response['Content-Length'] = str(length)
+        response['Content-Range'] = f'bytes {start}-{start + length - 1}/{attachment.size}'
+    response['Accept-Ranges'] = 'bytes'
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
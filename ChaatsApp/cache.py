@@ -0,0 +1,48 @@
+import time
+from collections import OrderedDict
+from django.conf import settings
+import redis
+
+
+class LRUCache:
+    # Bounded in-process LRU whose entries also expire after ttl seconds
+    def __init__(self, max_size, ttl):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.time():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, expires_at=None):
+        ttl_expiry = time.time() + self.ttl
+        self.entries[key] = (value, ttl_expiry if expires_at is None else min(ttl_expiry, expires_at))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def delete(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+
+_redis = None
+
+
+def get_redis():
+    # Shared synchronous Redis client, or None when REDIS_URL is not set
+    global _redis
+    redis_url = getattr(settings, 'REDIS_URL', None)
+    if _redis is None and redis_url:
+        _redis = redis.Redis.from_url(redis_url)
+    return _redis
@@ -1,20 +1,52 @@
-import json
-from channels.generic.websocket import AsyncWebsocketConsumer
+import contextvars
 from django.contrib.auth import get_user_model
-from rest_framework_simplejwt.tokens import TokenError, RefreshToken
-from rest_framework_simplejwt.serializers import TokenRefreshSerializer, TokenVerifySerializer
-from django.contrib.auth import authenticate, login
+from channels.consumer import get_handler_name
 from channels.db import database_sync_to_async 
-from django.db import models
-from models import Message, UserProfile, CustomUser
-from serializers import CustomUserSerializer, UserProfileSerializer, MessageSerializer
+from django.db import IntegrityError, models, transaction
+from .models import Conversation, Message, MessageChange, UserProfile, CustomUser, Room, Membership, RoomMessage, Attachment
+from .serializers import CustomUserSerializer, UserProfileSerializer, MessageSerializer, ConversationSerializer
+from .fast_serializers import FastSerializer
+from .protocol import FrameWebsocketConsumer, encode_frame, encode_frames, wrap_frame, batch_frames
+from .profile_cache import profile_cache
+from .writer import get_message_writer, MessageWriteError
+from .indicators import get_typing_debouncer
+from .receipts import get_receipt_batcher, RECEIPT_MAX_ACKS, RECEIPT_MAX_MARK
+from .delivery import user_group, chat_group, room_group, join_group, leave_group, deliver, is_echo
+from .presence import get_presence_store, get_presence_sweeper, presence_group, presence_event, parse_user_ids, PRESENCE_STATUSES, PRESENCE_MAX_SUBSCRIPTIONS
+from .search import search_messages, decode_rank_cursor, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
+from .archive import message_archive
+from .pagination import encode_cursor, decode_cursor, keyset_filter, read_tiers, clamp_page_size, INBOX_PAGE_SIZE, INBOX_MAX_PAGE_SIZE
 
 
 User = get_user_model()
 
-class UserAuthConsumer(AsyncWebsocketConsumer):
+# Message history is returned a page at a time and each page is streamed
+# to the client in frames of at most HISTORY_FRAME_SIZE messages
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 1000
+HISTORY_FRAME_SIZE = 100
+
+# A sync response holds at most SYNC_MAX_PAGE_SIZE changes; clients keep
+# syncing from the returned seq and marks while has_more is set
+SYNC_PAGE_SIZE = 200
+SYNC_MAX_PAGE_SIZE = 500
+SYNC_MAX_MARKS = 500
+
+# Files are uploaded over HTTP beforehand; messages only carry their ids
+MESSAGE_MAX_ATTACHMENTS = 10
+
+ROOM_NAME_MAX_LENGTH = 100
+ROOM_MAX_INITIAL_MEMBERS = 1000
+ROOM_HISTORY_PAGE_SIZE = 50
+ROOM_HISTORY_MAX_PAGE_SIZE = 200
+
+PROFILE_BATCH_SIZE = 1000
+# The user fields a socket may change on its own profile
+PROFILE_UPDATE_FIELDS = ('email', 'first_name', 'last_name', 'profile_picture')
+
+class UserAuthConsumer(FrameWebsocketConsumer):
     async def connect(self):
-        # Authenticate the WebSocket connection using JWT token
+        # The JWT middleware in asgi.py has already verified the token
         authentication_status = await self.authenticate_websocket()
         if authentication_status == "authenticated":
             await self.accept()
@@ -22,99 +54,612 @@ class UserAuthConsumer(AsyncWebsocketConsumer):
             await self.close(code=1008)  # Close WebSocket connection with status 1008 
 
     async def authenticate_websocket(self):
-        try:
-            token_data = await self.get_token_data()
-            if token_data and 'user_id' in token_data:
-                user = User.objects.get(id=token_data['user_id'])
-                if user.is_authenticated:
-                    return "authenticated"
-        except TokenError:
-            pass
+        user = self.scope.get('user')
+        if user is not None and user.is_authenticated:
+            return "authenticated"
 
         # Authentication failed
         return "authentication_failed"
 
-    async def get_token_data(self):
-        try:
-            token = self.scope["user"]
-            serializer = TokenVerifySerializer(data={'token': token})
-            serializer.is_valid(raise_exception=True)
-            return serializer.validated_data
-        except TokenError:
-            return None
 
+class AuthenticatedConsumer(FrameWebsocketConsumer):
+    # Only accepts sockets whose scope carries an authenticated user
+    async def connect(self):
+        if await self.authenticate():
+            await self.accept()
+
+    async def authenticate(self):
+        # Sets user_id, or closes the socket and returns False
+        self.user_id = None
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close(code=1008)
+            return False
+        self.user_id = user.id
+        return True
+
+
+class ChatMessage(AuthenticatedConsumer):
+    actions = (
+        'direct_message', 'message_history', 'inbox', 'mark_read', 'ack', 'search', 'sync',
+        'create_room', 'join_room', 'invite_room', 'leave_room', 'room_message', 'room_history',
+    )
+
+    async def connect(self):
+        # Room id -> the shard group this socket joined for it
+        self.room_groups = {}
+        await super().connect()
+        # Every socket of the user joins the user's group so direct
+        # messages reach all of their devices on any worker, and one shard
+        # group of each of the user's rooms
+        if self.user_id is not None:
+            await join_group(self, user_group(self.user_id))
+            for room_id, shard_count in await self.fetch_rooms():
+                await self.join_room_group(room_id, shard_count)
+
+    async def disconnect(self, code):
+        if getattr(self, 'user_id', None) is not None:
+            await leave_group(self, user_group(self.user_id))
+            for group in self.room_groups.values():
+                await leave_group(self, group)
+            self.room_groups = {}
+
+    @database_sync_to_async
+    def fetch_rooms(self):
+        return list(Membership.objects.filter(user_id=self.user_id).values_list('room_id', 'room__shard_count'))
 
-   
+    async def join_room_group(self, room_id, shard_count):
+        if room_id not in self.room_groups:
+            self.room_groups[room_id] = room_group(room_id, int(self.user_id) % shard_count)
+            await join_group(self, self.room_groups[room_id])
 
-class ChatMessage(AsyncWebsocketConsumer):
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive_data(self, data):
         action = data.get('action')
 
         if action == 'direct_message':
             await self.send_direct_message(data)
-        elif action == 'receive_message':
-            await self.receive_message(data)
         elif action == 'message_history':
             await self.get_message_history(data)
+        elif action == 'inbox':
+            await self.get_inbox(data)
+        elif action == 'mark_read':
+            await self.mark_conversation_read(data)
+        elif action == 'ack':
+            await self.acknowledge(data)
+        elif action == 'search':
+            await self.search_messages(data)
+        elif action == 'sync':
+            await self.sync_changes(data)
+        elif action == 'create_room':
+            await self.create_room(data)
+        elif action == 'join_room':
+            await self.join_room(data)
+        elif action == 'invite_room':
+            await self.invite_to_room(data)
+        elif action == 'leave_room':
+            await self.leave_room(data)
+        elif action == 'room_message':
+            await self.send_room_message(data)
+        elif action == 'room_history':
+            await self.get_room_history(data)
       
 
     async def send_direct_message(self, data):
-        sender_id = data.get('sender_id')
+        sender_id = self.user_id
         receiver_id = data.get('receiver_id')
         content = data.get('content')
+        attachment_ids = data.get('attachment_ids') or []
 
-        # Create new message
-        message = Message.objects.create(
-            sender_id=sender_id,
-            receiver_id=receiver_id,
-            content=content
-        )
+        if attachment_ids and not await self.check_attachments(attachment_ids):
+            await self.send_data({
+                'action': 'message_sent',
+                'error': 'Invalid attachments',
+            })
+            return
+        if attachment_ids and content is None:
+            content = ''
 
-        message.save()
+        # Queue the new message; it is inserted together with messages from
+        # other sockets on this worker and returned once its batch commits
+        try:
+            message = await get_message_writer().submit(Message(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=content
+            ))
+        except MessageWriteError as exc:
+            await self.send_data({
+                'action': 'message_sent',
+                'error': str(exc),
+            })
+            return
 
-        # Send the message via WebSocket to receiver
-        await self.send(text_data=json.dumps({
+        payload = {
             'action': 'direct_message',
             'message_id': message.id,
+            'conversation_id': message.conversation_id,
+            'sender_id': message.sender_id,
+            'receiver_id': message.receiver_id,
             'content': message.content,
             'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-        }))
+        }
+        if attachment_ids:
+            await database_sync_to_async(Attachment.attach)(message, attachment_ids)
+            payload['attachment_ids'] = sorted(set(attachment_ids))
+
+        # Encode the frame once per subprotocol and hand the same frames to
+        # every device of the receiver and the sender
+        event = {
+            'type': 'chat.direct_message',
+            **encode_frames(payload),
+        }
+        await deliver(self.channel_layer, user_group(message.receiver_id), event)
+        if str(message.sender_id) != str(message.receiver_id):
+            await deliver(self.channel_layer, user_group(message.sender_id), event)
 
         # Notify sender
-        await self.send(text_data=json.dumps({
+        await self.send_data({
             'action': 'message_sent',
             'message_id': message.id,
-        }))
+        })
+
+    @database_sync_to_async
+    def check_attachments(self, attachment_ids):
+        # Every id must be a finished upload of this user not sent before
+        if not isinstance(attachment_ids, list) or len(attachment_ids) > MESSAGE_MAX_ATTACHMENTS:
+            return False
+        if not all(isinstance(attachment_id, int) for attachment_id in attachment_ids):
+            return False
+        attachment_ids = set(attachment_ids)
+        return Attachment.unsent(self.user_id, attachment_ids).count() == len(attachment_ids)
+
+    async def chat_direct_message(self, event):
+        if not is_echo(event):
+            await self.send_frames(event)
 
 
     async def get_message_history(self, data):
-        sender_id = data.get('sender_id')
+        sender_id = self.user_id
         receiver_id = data.get('receiver_id')
+        page_size = clamp_page_size(data.get('page_size'), HISTORY_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE)
 
-        # Retrieve message history between sender and receiver
-        messages = Message.objects.filter(            
-            (models.Q(sender_id=sender_id, receiver_id=receiver_id) |
-             models.Q(sender_id=receiver_id, receiver_id=sender_id))
-        ).order_by('timestamp')
+        # Without a cursor the newest messages are returned first
+        direction = 'after' if data.get('after') else 'before'
+        cursor = data.get(direction)
+        try:
+            position = decode_cursor(cursor) if cursor else None
+        except ValueError:
+            await self.send_data({
+                'action': 'message_history',
+                'error': 'Invalid cursor',
+            })
+            return
+
+        conversation_id = await database_sync_to_async(Conversation.lookup_id)(sender_id, receiver_id)
+
+        remaining = page_size
+        while True:
+            frame_size = min(remaining, HISTORY_FRAME_SIZE)
+            rows = []
+            if conversation_id is not None:
+                rows = await self.fetch_message_history(conversation_id, position, direction, frame_size)
+            has_more = len(rows) > frame_size
+            rows = rows[:frame_size]
+            remaining -= len(rows)
+
+            next_cursor = None
+            if rows:
+                position = (rows[-1][2], rows[-1][0])
+                next_cursor = encode_cursor(*position)
+            if direction == 'before':
+                # Frames always list messages in chronological order
+                rows.reverse()
+
+            attachments = {}
+            if rows:
+                attachments = await database_sync_to_async(Attachment.ids_by_message)([row[0] for row in rows])
+            history = []
+            for message_id, content, timestamp in rows:
+                entry = {
+                    'message_id': message_id,
+                    'content': content,
+                    'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                }
+                if message_id in attachments:
+                    entry['attachment_ids'] = attachments[message_id]
+                history.append(entry)
+
+            final = not has_more or remaining <= 0
+            await self.send_data({
+                'action': 'message_history',
+                'message_history': history,
+                'direction': direction,
+                'next_cursor': next_cursor,
+                'has_more': has_more,
+                'final': final,
+            })
+
+            if final:
+                break
+
+    @database_sync_to_async
+    def fetch_message_history(self, conversation_id, position, direction, limit):
+        # Retrieve one frame of message history of a conversation, fetching
+        # one extra row to know whether more messages follow. Archived
+        # messages are older than every message left in the table.
+        def stored(position, count):
+            messages = keyset_filter(Message.objects.filter(conversation_id=conversation_id), position, direction)
+            return list(messages.values_list('id', 'content', 'timestamp')[:count])
+
+        def archived(position, count):
+            return [
+                (message.id, message.content, message.timestamp)
+                for message in message_archive.read_history(conversation_id, position, direction, count)
+            ]
+
+        readers = (stored, archived) if direction == 'before' else (archived, stored)
+        return read_tiers(readers, position, limit + 1, lambda row: (row[2], row[0]))
+
+    async def get_inbox(self, data):
+        user_id = self.user_id
+        page_size = clamp_page_size(data.get('page_size'), INBOX_PAGE_SIZE, INBOX_MAX_PAGE_SIZE)
+        try:
+            position = decode_cursor(data['before']) if data.get('before') else None
+        except ValueError:
+            await self.send_data({
+                'action': 'inbox',
+                'error': 'Invalid cursor',
+            })
+            return
+
+        conversations, next_cursor = await self.fetch_inbox(user_id, position, page_size)
+
+        await self.send_data({
+            'action': 'inbox',
+            'conversations': conversations,
+            'next_cursor': next_cursor,
+        })
+
+    @database_sync_to_async
+    def fetch_inbox(self, user_id, position, page_size):
+        conversations = Conversation.inbox(user_id, position, page_size)
+        next_cursor = None
+        if len(conversations) > page_size:
+            conversations = conversations[:page_size]
+            last = conversations[-1]
+            next_cursor = encode_cursor(last.last_timestamp, last.id)
+
+        return ConversationSerializer(conversations, many=True, context={'user_id': user_id}).data, next_cursor
+
+    async def mark_conversation_read(self, data):
+        conversation_id = data.get('conversation_id')
+        user_id = self.user_id
+        if not str(conversation_id).isdigit():
+            await self.send_data({'action': 'mark_read', 'error': 'Invalid conversation'})
+            return
+
+        await database_sync_to_async(Conversation.mark_read)(conversation_id, user_id)
+
+        await self.send_data({
+            'action': 'mark_read',
+            'conversation_id': conversation_id,
+        })
+
+    async def acknowledge(self, data):
+        # Delivered/read high-water marks, one message id per conversation:
+        # {'acks': [{'conversation_id': 1, 'delivered': 40, 'read': 38}]}.
+        # Nothing is sent back; the other users get a receipt.
+        acks = data.get('acks')
+        try:
+            if not isinstance(acks, list) or len(acks) > RECEIPT_MAX_ACKS:
+                raise ValueError
+            acks = [
+                (int(ack['conversation_id']), int(ack.get('delivered') or 0), int(ack.get('read') or 0))
+                for ack in acks
+            ]
+            if any(not 0 <= mark <= RECEIPT_MAX_MARK for ack in acks for mark in ack):
+                raise ValueError
+        except (KeyError, TypeError, ValueError, AttributeError):
+            await self.send_data({
+                'action': 'ack',
+                'error': 'Invalid acks',
+            })
+            return
+
+        batcher = get_receipt_batcher()
+        for conversation_id, delivered, read in acks:
+            batcher.acknowledge(self.user_id, conversation_id, delivered, read)
+
+    async def chat_receipt(self, event):
+        if not is_echo(event):
+            await self.send_frames(event)
 
-        message_history = []
+    async def search_messages(self, data):
+        page_size = clamp_page_size(data.get('page_size'), SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        conversation_id = data.get('conversation_id')
+        try:
+            position = decode_rank_cursor(data['cursor']) if data.get('cursor') else None
+            if conversation_id is not None and not str(conversation_id).isdigit():
+                raise ValueError('Invalid conversation')
+        except ValueError as exc:
+            await self.send_data({
+                'action': 'search',
+                'error': str(exc),
+            })
+            return
+
+        results, next_cursor = await database_sync_to_async(search_messages)(
+            self.user_id, data.get('query'), conversation_id, position, page_size,
+        )
+
+        await self.send_data({
+            'action': 'search',
+            'results': results,
+            'next_cursor': next_cursor,
+        })
+
+    async def sync_changes(self, data):
+        # Messages created, edited or deleted since the client's high-water
+        # marks: since for every conversation, or a conversation's own mark
+        # in marks ({conversation_id: seq}). The reply's seq and marks are
+        # the ones to send next; marks is empty once caught up.
+        page_size = clamp_page_size(data.get('page_size'), SYNC_PAGE_SIZE, SYNC_MAX_PAGE_SIZE)
+        try:
+            since = int(data.get('since') or 0)
+            marks = {int(conversation_id): int(mark) for conversation_id, mark in (data.get('marks') or {}).items()}
+            if len(marks) > SYNC_MAX_MARKS:
+                raise ValueError
+        except (AttributeError, TypeError, ValueError):
+            await self.send_data({
+                'action': 'sync',
+                'error': 'Invalid marks',
+            })
+            return
+
+        changes, seq, marks, has_more = await self.fetch_changes(since, marks, page_size)
+        await self.send_data({
+            'action': 'sync',
+            'changes': changes,
+            'seq': seq,
+            'marks': {str(conversation_id): mark for conversation_id, mark in marks.items()},
+            'has_more': has_more,
+        })
+
+    @database_sync_to_async
+    def fetch_changes(self, since, marks, limit):
+        changes, latest = MessageChange.pending(self.user_id, since, marks, limit)
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        if has_more:
+            # Every change up to the last one returned has been sent, so the
+            # marks move up to it; marks still ahead of it are kept
+            last = changes[-1].seq
+            seq = max(since, last)
+            marks = {conversation_id: max(mark, last) for conversation_id, mark in marks.items()}
+            marks = {conversation_id: mark for conversation_id, mark in marks.items() if mark != seq}
+        else:
+            # Caught up: every conversation continues from the latest seq
+            seq, marks = max(latest, since), {}
+
+        # Several changes of one message are folded into the newest one,
+        # which carries the message as it is now
+        folded = {}
+        for change in changes:
+            previous = folded.pop(change.message_id, None)
+            if previous is not None and previous.kind == MessageChange.CREATED and change.kind == MessageChange.EDITED:
+                change.kind = MessageChange.CREATED
+            folded[change.message_id] = change
+
+        messages = {
+            row[0]: row for row in Message.objects.filter(
+                id__in=[change.message_id for change in folded.values() if change.kind != MessageChange.DELETED]
+            ).values_list('id', 'sender_id', 'receiver_id', 'content', 'timestamp')
+        }
+        results = []
+        for change in folded.values():
+            result = {
+                'seq': change.seq,
+                'change': change.kind,
+                'conversation_id': change.conversation_id,
+                'message_id': change.message_id,
+            }
+            if change.kind != MessageChange.DELETED:
+                message = messages.get(change.message_id)
+                if message is None:
+                    # Deleted by a later change, or archived
+                    continue
+                _, result['sender_id'], result['receiver_id'], result['content'], timestamp = message
+                result['timestamp'] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
+            results.append(result)
+        return results, seq, marks, has_more
+
+    async def create_room(self, data):
+        name = data.get('name')
+        member_ids = data.get('member_ids') or []
+        if not isinstance(name, str) or not 0 < len(name.strip()) <= ROOM_NAME_MAX_LENGTH:
+            await self.send_data({'action': 'create_room', 'error': 'Invalid room name'})
+            return
+        if not isinstance(member_ids, list) or len(member_ids) > ROOM_MAX_INITIAL_MEMBERS:
+            await self.send_data({'action': 'create_room', 'error': 'Invalid members'})
+            return
+
+        room, added = await self.save_room(name.strip(), data.get('public') is True, member_ids)
+        await self.send_data({
+            'action': 'create_room',
+            'room': {'id': room.id, 'name': room.name, 'public': room.is_public, 'member_count': len(added)},
+        })
+        for user_id in added:
+            await self.announce_membership(room, user_id, 'room.joined')
+
+    @database_sync_to_async
+    def save_room(self, name, is_public, member_ids):
+        room = Room.objects.create(name=name, created_by_id=self.user_id, is_public=is_public)
+        added = Room.add_members(room.id, [self.user_id, *self.existing_users(member_ids)])
+        room.refresh_from_db(fields=['shard_count'])
+        return room, added
+
+    def existing_users(self, user_ids):
+        user_ids = [user_id for user_id in user_ids if str(user_id).isdigit()]
+        return sorted(CustomUser.objects.filter(id__in=user_ids).values_list('id', flat=True))
+
+    async def join_room(self, data):
+        # Private rooms are not found by outsiders, whose only way in is an invite
+        room = await self.fetch_room(data.get('room_id'))
+        if room is None or not room.is_public:
+            await self.send_data({'action': 'join_room', 'error': 'Room not found'})
+            return
+        await database_sync_to_async(Room.add_members)(room.id, [self.user_id])
+        await database_sync_to_async(room.refresh_from_db)(fields=['shard_count'])
+        # Every socket of the user joins, this one included
+        await self.announce_membership(room, self.user_id, 'room.joined')
+
+    async def invite_to_room(self, data):
+        # Members add other users to the room: {'room_id', 'member_ids'}
+        member_ids = data.get('member_ids')
+        if not isinstance(member_ids, list) or len(member_ids) > ROOM_MAX_INITIAL_MEMBERS:
+            await self.send_data({'action': 'invite_room', 'error': 'Invalid members'})
+            return
+        invited = await self.save_invites(data.get('room_id'), member_ids)
+        if invited is None:
+            await self.send_data({'action': 'invite_room', 'error': 'Room not found'})
+            return
+
+        room, added = invited
+        await self.send_data({'action': 'invite_room', 'room_id': room.id, 'added': added})
+        for user_id in added:
+            await self.announce_membership(room, user_id, 'room.joined')
 
-        for message in messages:
-            message_history.append({
+    @database_sync_to_async
+    def save_invites(self, room_id, member_ids):
+        # The room and the users added to it, or None for non-members
+        if not str(room_id).isdigit() or not Membership.objects.filter(room_id=room_id, user_id=self.user_id).exists():
+            return None
+        added = Room.add_members(room_id, self.existing_users(member_ids))
+        return Room.objects.only('name', 'shard_count').get(pk=room_id), added
+
+    async def leave_room(self, data):
+        room = await self.fetch_room(data.get('room_id'))
+        if room is None or not await database_sync_to_async(Room.remove_member)(room.id, self.user_id):
+            await self.send_data({'action': 'leave_room', 'error': 'Room not found'})
+            return
+        await self.announce_membership(room, self.user_id, 'room.left')
+
+    @database_sync_to_async
+    def fetch_room(self, room_id):
+        if not str(room_id).isdigit():
+            return None
+        return Room.objects.filter(pk=room_id).only('name', 'shard_count', 'is_public').first()
+
+    async def announce_membership(self, room, user_id, event_type):
+        await deliver(self.channel_layer, user_group(user_id), {
+            'type': event_type,
+            'room_id': room.id,
+            'name': room.name,
+            'shard_count': room.shard_count,
+        })
+
+    async def room_joined(self, event):
+        if not is_echo(event):
+            await self.join_room_group(event['room_id'], event['shard_count'])
+            await self.send_data({'action': 'room_joined', 'room_id': event['room_id'], 'name': event['name']})
+
+    async def room_left(self, event):
+        if not is_echo(event):
+            group = self.room_groups.pop(event['room_id'], None)
+            if group is not None:
+                await leave_group(self, group)
+            await self.send_data({'action': 'room_left', 'room_id': event['room_id']})
+
+    async def send_room_message(self, data):
+        room_id = data.get('room_id')
+        content = data.get('content')
+        if not isinstance(content, str) or not content:
+            await self.send_data({'action': 'room_message', 'error': 'Message could not be saved'})
+            return
+        saved = await self.save_room_message(room_id, content)
+        if saved is None:
+            await self.send_data({'action': 'room_message', 'error': 'Room not found'})
+            return
+
+        # The frame is encoded once and the event sent once per shard, so the
+        # cost of a message does not depend on how many sockets receive it
+        message, shard_count = saved
+        event = {
+            'type': 'room.message',
+            **encode_frames({
+                'action': 'room_message',
+                'room_id': message.room_id,
                 'message_id': message.id,
+                'sender_id': message.sender_id,
                 'content': message.content,
                 'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            })
+            }),
+        }
+        for shard in range(shard_count):
+            await deliver(self.channel_layer, room_group(message.room_id, shard), event)
+
+        await self.send_data({
+            'action': 'room_message_sent',
+            'message_id': message.id,
+        })
 
-        await self.send(text_data=json.dumps({
-            'action': 'message_history',
-            'message_history': message_history,
-        }))
+    @database_sync_to_async
+    def save_room_message(self, room_id, content):
+        # The message and the room's shard count, or None for non-members
+        if not str(room_id).isdigit():
+            return None
+        shard_count = Room.objects.filter(pk=room_id, memberships__user_id=self.user_id).values_list('shard_count', flat=True).first()
+        if shard_count is None:
+            return None
+        return RoomMessage.objects.create(room_id=room_id, sender_id=self.user_id, content=content), shard_count
 
-class UserProfileConsumer(AsyncWebsocketConsumer):
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def room_message(self, event):
+        if not is_echo(event):
+            await self.send_frames(event)
+
+    async def get_room_history(self, data):
+        room_id = data.get('room_id')
+        page_size = clamp_page_size(data.get('page_size'), ROOM_HISTORY_PAGE_SIZE, ROOM_HISTORY_MAX_PAGE_SIZE)
+        try:
+            position = decode_cursor(data['before']) if data.get('before') else None
+        except ValueError:
+            await self.send_data({'action': 'room_history', 'error': 'Invalid cursor'})
+            return
+
+        rows = await self.fetch_room_history(room_id, position, page_size)
+        if rows is None:
+            await self.send_data({'action': 'room_history', 'error': 'Room not found'})
+            return
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_cursor(rows[-1][3], rows[-1][0])
+        # Newest page first, each page in chronological order
+        rows.reverse()
+        await self.send_data({
+            'action': 'room_history',
+            'room_id': int(room_id),
+            'messages': [{
+                'message_id': message_id,
+                'sender_id': sender_id,
+                'content': content,
+                'timestamp': timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            } for message_id, sender_id, content, timestamp in rows],
+            'next_cursor': next_cursor,
+        })
+
+    @database_sync_to_async
+    def fetch_room_history(self, room_id, position, limit):
+        if not str(room_id).isdigit() or not Membership.objects.filter(room_id=room_id, user_id=self.user_id).exists():
+            return None
+        messages = keyset_filter(RoomMessage.objects.filter(room_id=room_id), position, 'before')
+        return list(messages.values_list('id', 'sender_id', 'content', 'timestamp')[:limit + 1])
+
+class UserProfileConsumer(AuthenticatedConsumer):
+    actions = ('list_users', 'get_profile', 'get_profiles', 'update_profile')
+
+    async def receive_data(self, data):
         action = data.get('action')
 
         if action == 'list_users':
@@ -122,98 +667,342 @@ class UserProfileConsumer(AsyncWebsocketConsumer):
         elif action == 'get_profile':
             user_id = data.get('user_id')
             await self.retrieve_user_profile(user_id)
+        elif action == 'get_profiles':
+            await self.retrieve_user_profiles(data.get('user_ids', []))
         elif action == 'update_profile':
             await self.update_user_profile(data)
 
-    @database_sync_to_async
-    def list_all_users(self):
-        users = UserProfile.objects.all()
-        user_list = UserProfileSerializer(users, many=True).data
+    async def list_all_users(self):
+        user_list = await self.fetch_all_users()
 
         # Send the list of users to the WebSocket client
-        self.send_json({'action': 'list_users', 'users': user_list})
+        await self.send_data({'action': 'list_users', 'users': user_list})
 
     @database_sync_to_async
-    def retrieve_user_profile(self, user_id):
-        # Query and retrieve the user profile data based on the provided user_id
-        try:
-            user_profile = UserProfile.objects.get(id=user_id)
-            user_data = UserProfileSerializer(user_profile).data
-
-            # Send the user profile data to the WebSocket client
-            self.send_json({'action': 'get_profile', 'user': user_data})
-        except UserProfile.DoesNotExist:
+    def fetch_all_users(self):
+        # Only the ids come from the database, the profiles from the cache
+        profile_ids = UserProfile.objects.order_by('id').values_list('id', flat=True)
+        return list(profile_cache.get_many(profile_ids).values())
+
+    async def retrieve_user_profile(self, user_id):
+        # Retrieve the user profile data based on the provided user_id
+        user_data = None
+        if str(user_id).isdigit():
+            user_data = await database_sync_to_async(profile_cache.get)(user_id)
+
+        if user_data is None:
             # Handle the case where the user profile doesn't exist
-            self.send_json({'action': 'get_profile', 'error': 'User not found'})
+            await self.send_data({'action': 'get_profile', 'error': 'User not found'})
+            return
 
-    @database_sync_to_async
-    def update_user_profile(self, data):
-        # Extract, update, and save user profile data
-        user_id = data.get('user_id')
-        new_data = {
-            'email': data.get('email'),
-            'first_name': data.get('first_name'),
-            'last_name': data.get('last_name'),
-            'profile_picture': data.get('profile_picture')
-        }
+        # Send the user profile data to the WebSocket client
+        await self.send_data({'action': 'get_profile', 'user': user_data})
 
-        try:
-            user_profile = UserProfile.objects.get(id=user_id)
+    async def retrieve_user_profiles(self, user_ids):
+        # Profiles for a whole contact list in one cache round trip
+        user_ids = parse_user_ids(user_ids)
+        if user_ids is None:
+            await self.send_data({'action': 'get_profiles', 'error': 'Invalid user ids'})
+            return
+        profiles = await database_sync_to_async(profile_cache.get_many)(user_ids[:PROFILE_BATCH_SIZE])
+
+        await self.send_data({'action': 'get_profiles', 'users': list(profiles.values())})
 
-            for key, value in new_data.items():
-                setattr(user_profile, key, value)
+    async def update_user_profile(self, data):
+        # Users only edit their own profile; user_id may be left out
+        user_id = data.get('user_id', self.user_id)
+        if str(user_id) != str(self.user_id):
+            await self.send_data({'action': 'update_profile', 'error': 'Permission denied'})
+            return
 
-            user_profile.save()
+        # Send the outcome to the WebSocket client
+        await self.send_data({'action': 'update_profile', **await self.save_user_profile(data)})
 
-            # Send a success message to the WebSocket client
-            self.send_json({'action': 'update_profile', 'message': 'Profile updated successfully'})
+    @database_sync_to_async
+    def save_user_profile(self, data):
+        # The profile details live on the user; saving it invalidates the
+        # cached profile through the post_save signal
+        try:
+            user_profile = UserProfile.objects.select_related('user').get(user_id=self.user_id)
         except UserProfile.DoesNotExist:
-            # Handle the case where the user profile doesn't exist
-            self.send_json({'action': 'update_profile', 'error': 'User not found'})
+            return {'error': 'User not found'}
+
+        user = user_profile.user
+        changes = {key: data[key] for key in PROFILE_UPDATE_FIELDS if data.get(key) is not None}
+        serializer = CustomUserSerializer(user, data=changes, partial=True)
+        if not serializer.is_valid():
+            return {'error': 'Invalid profile', 'errors': serializer.errors}
+
+        for key, value in serializer.validated_data.items():
+            setattr(user, key, value)
+        try:
+            with transaction.atomic():
+                user.save(update_fields=list(serializer.validated_data))
+        except IntegrityError:
+            # Another user took the email since it was validated
+            return {'error': 'Invalid profile', 'errors': {'email': ['This email is already in use.']}}
+        return {'message': 'Profile updated successfully'}
 
 
+class ChatConsumer(AuthenticatedConsumer):
+    actions = ('typing', 'user_status', 'heartbeat', 'presence_subscribe', 'presence_unsubscribe')
 
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def connect(self):
+        await super().connect()
+        self.presence_subscriptions = set()
+        if self.user_id is not None:
+            await join_group(self, chat_group(self.user_id))
+            await self.update_presence()
+            get_presence_sweeper().add(self)
+
+    async def disconnect(self, code):
+        for user_id in getattr(self, 'presence_subscriptions', ()):
+            await leave_group(self, presence_group(user_id))
+        if getattr(self, 'user_id', None) is not None:
+            get_presence_sweeper().discard(self)
+            await leave_group(self, chat_group(self.user_id))
+            previous, current = await get_presence_store().remove(self.user_id, self.socket_id)
+            if previous != current:
+                await self.broadcast_presence(current)
+
+    async def receive_data(self, data):
         action = data.get('action')
 
         if action == 'typing':
             await self.handle_typing(data)
         elif action == 'user_status':
             await self.handle_user_status(data)
+        elif action == 'heartbeat':
+            await self.update_presence()
+        elif action == 'presence_subscribe':
+            await self.subscribe_presence(data)
+        elif action == 'presence_unsubscribe':
+            await self.unsubscribe_presence(data)
 
     async def handle_typing(self, data):
         # Handle typing event
-        sender_id = data.get('sender_id')
+        sender_id = self.user_id
         receiver_id = data.get('receiver_id')
-        is_typing = data.get('is_typing')
+        is_typing = bool(data.get('is_typing'))
+        if not str(receiver_id).isdigit():
+            await self.send_data({
+                'action': 'typing',
+                'error': 'Invalid receiver',
+            })
+            return
+        receiver_id = int(receiver_id)
+
+        # Notify the receiver about typing status, coalesced with the
+        # sender's other typing events
+        await get_typing_debouncer().update(sender_id, receiver_id, is_typing)
 
-        # Notify the receiver about typing status
-        await self.send_user_typing_status(receiver_id, sender_id, is_typing)
+    async def chat_typing(self, event):
+        if not is_echo(event):
+            await self.send_frames(event, ephemeral=True)
 
     async def handle_user_status(self, data):
         # Handle user status change event
-        user_id = data.get('user_id')
         status = data.get('status')
+        if status not in PRESENCE_STATUSES:
+            await self.send_data({
+                'action': 'user_status',
+                'error': 'Invalid status',
+            })
+            return
+
+        await self.update_presence(status)
+
+    @property
+    def socket_id(self):
+        return getattr(self, 'channel_name', None) or str(id(self))
+
+    async def update_presence(self, status=None):
+        # Refreshes this socket's presence; subscribers only hear about it
+        # when the user's visible status actually changes
+        previous, current = await get_presence_store().touch(self.user_id, self.socket_id, status)
+        if previous != current:
+            await self.broadcast_presence(current)
+
+    async def broadcast_presence(self, status):
+        await deliver(self.channel_layer, presence_group(self.user_id), presence_event(self.user_id, status))
+
+    async def presence_update(self, event):
+        if not is_echo(event):
+            await self.send_frames(event, ephemeral=True)
+
+    async def subscribe_presence(self, data):
+        user_ids = parse_user_ids(data.get('user_ids', []))
+        if user_ids is None or len(self.presence_subscriptions | set(user_ids)) > PRESENCE_MAX_SUBSCRIPTIONS:
+            await self.send_data({
+                'action': 'presence_subscribe',
+                'error': 'Invalid subscription',
+            })
+            return
+
+        for user_id in user_ids:
+            if user_id not in self.presence_subscriptions:
+                self.presence_subscriptions.add(user_id)
+                await join_group(self, presence_group(user_id))
+
+        # Current presence of all requested users in one lookup
+        presence = await get_presence_store().get_many(user_ids)
+        await self.send_data({
+            'action': 'presence_subscribe',
+            'presence': {str(user_id): status for user_id, status in presence.items()},
+        })
+
+    async def unsubscribe_presence(self, data):
+        user_ids = parse_user_ids(data.get('user_ids', []))
+        if user_ids is None:
+            await self.send_data({
+                'action': 'presence_unsubscribe',
+                'error': 'Invalid subscription',
+            })
+            return
+
+        for user_id in user_ids:
+            if user_id in self.presence_subscriptions:
+                self.presence_subscriptions.discard(user_id)
+                await leave_group(self, presence_group(user_id))
+
+
+class StreamConsumer:
+    # Runs a consumer as one stream of a multiplexed socket: the socket is
+    # accepted and closed by the multiplexer and frames go out through it.
+    # Rate limits and the outbound buffer are the socket's.
+    def __init__(self, multiplexer, stream):
+        super().__init__()
+        self.multiplexer = multiplexer
+        self.stream = stream
+        self.scope = multiplexer.scope
+        self.channel_layer = multiplexer.channel_layer
+        self.channel_name = multiplexer.channel_name
+        self.binary = multiplexer.binary
+        self.rate_buckets = multiplexer.rate_buckets
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code=None):
+        await self.multiplexer.close(code)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await self.multiplexer.send_stream(self.stream, bytes_data if bytes_data is not None else text_data)
+        if close:
+            await self.close()
+
+    async def send_frame(self, frame, ephemeral=False):
+        await self.multiplexer.send_stream(self.stream, frame, ephemeral)
+
+
+# Streams of the multiplexed endpoint, named after the standalone endpoints
+MULTIPLEX_STREAMS = {
+    'user-authentication': UserAuthConsumer,
+    'chat-message': ChatMessage,
+    'user-profile': UserProfileConsumer,
+    'chat': ChatConsumer,
+}
+MULTIPLEX_MAX_BATCH = 100
+# Larger replies to a batched request are sent on their own
+MULTIPLEX_MAX_BATCHED_REPLY = 64 * 1024
+
+# The reply being collected for the batched request this task is handling
+batched_reply = contextvars.ContextVar('batched_reply', default=None)
+
+
+class BatchedReply:
+    # Frames a request of a batch answers with. A single reply joins the
+    # batch frame; a request that answers with several frames, e.g. a
+    # streamed history, or a large one, sends them on their own as they come.
+    def __init__(self, multiplexer):
+        self.multiplexer = multiplexer
+        self.frames = []
+        self.collecting = True
+
+
+class MultiplexConsumer(AuthenticatedConsumer):
+    # One socket carrying every stream. Frames are {'stream': ..., 'payload':
+    # ...} envelopes, or {'batch': [envelope, ...]} answered by one batch
+    # frame holding the replies.
+    stream_classes = {
+        stream: type(f'{consumer_class.__name__}Stream', (StreamConsumer, consumer_class), {})
+        for stream, consumer_class in MULTIPLEX_STREAMS.items()
+    }
 
-
-    async def send_user_typing_status(self, receiver_id, sender_id, is_typing):
-        # Notify the receiver of typing status of sender
-        await self.send(text_data=json.dumps({
-            'action': 'typing',
-            'sender_id': sender_id,
-            'receiver_id': receiver_id,
-            'is_typing': is_typing,
-        }))
-
-
-
-
-
-
-
-
-
-
-
+    async def connect(self):
+        self.streams = {}
+        if not await self.authenticate():
+            return
+
+        # The socket is accepted once every stream is connected, so the
+        # client's first frame finds them joined to their groups
+        subprotocol = self.select_subprotocol()
+        for stream, stream_class in self.stream_classes.items():
+            self.streams[stream] = stream_class(self, stream)
+            await self.streams[stream].connect()
+        await self.accept(subprotocol)
+
+    async def disconnect(self, code):
+        for consumer in getattr(self, 'streams', {}).values():
+            await consumer.disconnect(code)
+
+    async def dispatch(self, message):
+        # Channel layer events are handled by the stream that knows them
+        handler_name = get_handler_name(message)
+        if not hasattr(self, handler_name):
+            for consumer in self.streams.values():
+                if hasattr(consumer, handler_name):
+                    return await consumer.dispatch(message)
+        await super().dispatch(message)
+
+    async def handle_data(self, data):
+        # Envelopes are timed by the stream that handles them
+        await self.receive_data(data)
+
+    async def receive_data(self, data):
+        if 'batch' not in data:
+            await self.route(data)
+            return
+
+        frames = data['batch']
+        if not isinstance(frames, list) or len(frames) > MULTIPLEX_MAX_BATCH:
+            await self.send_data({'error': 'Invalid batch'})
+            return
+
+        # Replies are collected while the batch runs and sent together.
+        # Only this task's requests are collected: pushes from other users
+        # or tasks go out as usual.
+        replies = []
+        for frame in frames:
+            reply = BatchedReply(self)
+            token = batched_reply.set(reply)
+            try:
+                await self.route(frame)
+            finally:
+                batched_reply.reset(token)
+                reply.collecting = False
+            replies += reply.frames
+        await self.send_frame(batch_frames(replies, self.binary))
+
+    async def route(self, frame):
+        stream = frame.get('stream') if isinstance(frame, dict) else None
+        payload = frame.get('payload') if isinstance(frame, dict) else None
+        consumer = self.streams.get(stream) if isinstance(stream, str) else None
+        if consumer is None or not isinstance(payload, dict):
+            error = encode_frame({'error': 'Invalid stream frame'}, self.binary)
+            await self.send_stream(stream if isinstance(stream, str) else None, error)
+            return
+        await consumer.handle_data(payload)
+
+    async def send_stream(self, stream, frame, ephemeral=False):
+        frame = wrap_frame(stream, frame)
+        reply = batched_reply.get()
+        if reply is None or reply.multiplexer is not self or not reply.collecting or ephemeral:
+            await self.send_frame(frame, ephemeral)
+            return
+        reply.frames.append(frame)
+        if len(reply.frames) > 1 or len(frame) > MULTIPLEX_MAX_BATCHED_REPLY:
+            reply.collecting = False
+            frames, reply.frames = reply.frames, []
+            for frame in frames:
+                await self.send_frame(frame)
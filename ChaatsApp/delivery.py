@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import uuid
+import weakref
+from collections import defaultdict, deque
+from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+
+# Tags group events sent by this worker so its own sockets, which were
+# already served in-process, can ignore the copy coming back from Redis
+WORKER_ID = uuid.uuid4().hex
+
+# Consumers connected to this worker, by group name
+local_groups = defaultdict(set)
+
+# Events waiting for each consumer of this worker, with the task handling them
+local_inboxes = weakref.WeakKeyDictionary()
+
+logger = logging.getLogger(__name__)
+
+
+def user_group(user_id):
+    # Group holding every socket of a user that wants direct messages
+    return f'user_{user_id}_messages'
+
+
+def chat_group(user_id):
+    # Group holding every chat socket of a user, for ephemeral events
+    return f'user_{user_id}_chat'
+
+
+def room_group(room_id, shard):
+    # One of the shard groups holding the sockets of a room's members
+    return f'room_{room_id}_{shard}'
+
+
+async def join_group(consumer, group):
+    local_groups[group].add(consumer)
+    if consumer.channel_layer is not None:
+        await consumer.channel_layer.group_add(group, consumer.channel_name)
+        directory = get_group_directory(consumer.channel_layer)
+        if directory is not None and len(local_groups[group]) == 1:
+            await directory.register(group)
+
+
+async def leave_group(consumer, group):
+    local_groups[group].discard(consumer)
+    last = not local_groups[group]
+    if last:
+        del local_groups[group]
+    if consumer.channel_layer is not None:
+        await consumer.channel_layer.group_discard(group, consumer.channel_name)
+        directory = get_group_directory(consumer.channel_layer)
+        if directory is not None and last:
+            await directory.unregister(group)
+
+
+async def deliver(channel_layer, group, event):
+    # Sockets living in this worker get the event without a channel layer
+    # round trip. It is queued for each of them and handled by a task of
+    # their own, so the sender neither runs nor waits for their handlers.
+    # The channel layer reaches the other workers and is skipped when the
+    # group directory knows they have no sockets in the group; otherwise
+    # our own copy coming back is ignored.
+    members = local_groups.get(group, ())
+    for consumer in members:
+        enqueue(consumer, group, event)
+
+    if channel_layer is None:
+        return
+    directory = get_group_directory(channel_layer)
+    if members and directory is not None and await directory.is_local(group):
+        return
+    await channel_layer.group_send(group, {**event, 'origin': WORKER_ID})
+
+
+def enqueue(consumer, group, event):
+    inbox = local_inboxes.get(consumer)
+    if inbox is None:
+        inbox = local_inboxes[consumer] = [deque(), None]
+    events, task = inbox
+    events.append((group, event))
+    if task is None or task.done():
+        inbox[1] = asyncio.create_task(drain(consumer, events))
+
+
+async def drain(consumer, events):
+    # Handles a consumer's events in the order they were delivered. Events
+    # of groups it has left since, e.g. by disconnecting, are dropped.
+    while events:
+        group, event = events.popleft()
+        if consumer not in local_groups.get(group, ()):
+            continue
+        try:
+            await consumer.dispatch(event)
+        except Exception:
+            logger.exception('Handling %s failed', event.get('type'))
+
+
+def is_echo(event):
+    # True for our own group_send coming back through the channel layer
+    return event.get('origin') == WORKER_ID
+
+
+class GroupDirectory:
+    # Records in Redis which workers have sockets in each group, so that a
+    # worker holding all of a group's sockets can skip the channel layer.
+    # Workers remember the answers for their own groups and forget them
+    # when another worker announces a change over pub/sub. While those
+    # announcements cannot be received nothing is known, and every event
+    # goes through the channel layer.
+    #
+    # A worker joining a group may miss events until the announcement has
+    # reached the others, just like events sent shortly before it joined;
+    # clients catch up on both through sync. An entry left behind by a
+    # crashed worker only keeps the others using the channel layer.
+    channel = 'delivery:groups'
+
+    def __init__(self, url, worker_id=WORKER_ID, retry_interval=1):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.worker_id = worker_id
+        self.retry_interval = retry_interval
+        # Groups with sockets in this worker, and whether other workers
+        # have sockets in them as far as known
+        self.groups = set()
+        self.remote = {}
+        # Bumped whenever remote answers are forgotten, so that lookups
+        # started before then are not remembered
+        self.generation = 0
+        self.subscribed = False
+        self.listener = None
+
+    @staticmethod
+    def key(group):
+        return f'delivery:group:{group}'
+
+    async def register(self, group):
+        # The first socket of this worker joined the group
+        self.groups.add(group)
+        self.start()
+        try:
+            await self.announce('sadd', group)
+        except RedisError:
+            # Announced again once the listener has reconnected; until then
+            # the others may believe they hold all of the group's sockets
+            logger.exception('Registering group %s failed', group)
+            self.restart()
+
+    async def unregister(self, group):
+        # The last socket of this worker left the group
+        self.groups.discard(group)
+        self.remote.pop(group, None)
+        try:
+            await self.announce('srem', group)
+        except RedisError:
+            logger.exception('Unregistering group %s failed', group)
+
+    async def announce(self, command, group):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            getattr(pipe, command)(self.key(group), self.worker_id)
+            pipe.publish(self.channel, f'{self.worker_id} {group}')
+            await pipe.execute()
+
+    async def is_local(self, group):
+        # True when no other worker is known to have sockets in the group
+        if not self.subscribed:
+            self.start()
+            return False
+        remote = self.remote.get(group)
+        if remote is None:
+            generation = self.generation
+            try:
+                workers = await self.redis.smembers(self.key(group))
+            except RedisError:
+                return False
+            remote = bool(workers - {self.worker_id})
+            if generation == self.generation and group in self.groups:
+                self.remote[group] = remote
+        return not remote
+
+    def start(self):
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self.listen())
+
+    def restart(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+        self.forget()
+        self.start()
+
+    def forget(self):
+        self.subscribed = False
+        self.remote.clear()
+        self.generation += 1
+
+    async def listen(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    async for message in pubsub.listen():
+                        if message['type'] == 'subscribe':
+                            # Changes made while we were not listening went
+                            # unannounced, possibly our own registrations
+                            for group in list(self.groups):
+                                await self.announce('sadd', group)
+                            self.subscribed = True
+                        elif message['type'] == 'message':
+                            worker_id, _, group = message['data'].partition(' ')
+                            if worker_id != self.worker_id:
+                                self.remote.pop(group, None)
+                                self.generation += 1
+            except RedisError:
+                logger.exception('Group directory listener failed')
+            finally:
+                self.forget()
+            await asyncio.sleep(self.retry_interval)
+
+
+_directories = weakref.WeakKeyDictionary()
+
+
+def get_group_directory(channel_layer):
+    # One directory per event loop, i.e. per worker, kept next to a Redis
+    # channel layer; other layers have none and always get the events
+    redis_url = getattr(settings, 'REDIS_URL', None)
+    if not redis_url or not isinstance(channel_layer, RedisChannelLayer):
+        return None
+    loop = asyncio.get_running_loop()
+    if loop not in _directories:
+        _directories[loop] = GroupDirectory(redis_url)
+    return _directories[loop]
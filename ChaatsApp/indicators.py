@@ -0,0 +1,113 @@
+import asyncio
+import weakref
+from channels.layers import get_channel_layer
+from .delivery import chat_group, deliver
+from .protocol import encode_frames, log_task_error
+
+
+# Typing state flips between a sender and a receiver are forwarded at most
+# once per TYPING_MIN_INTERVAL seconds, and is_typing=True is withdrawn
+# automatically after TYPING_TIMEOUT seconds without a refresh
+TYPING_MIN_INTERVAL = 1.0
+TYPING_TIMEOUT = 6.0
+
+
+class TypingState:
+    __slots__ = ('sent', 'flipped_at', 'pending', 'timer')
+
+    def __init__(self):
+        self.sent = False
+        self.flipped_at = float('-inf')
+        self.pending = None
+        self.timer = None
+
+
+class TypingDebouncer:
+    # Coalesces typing events per (sender, receiver). Repeated states are
+    # dropped, quick flips are merged into one trailing update and stale
+    # is_typing=True states expire. Nothing here touches the database.
+    def __init__(self, send, min_interval=TYPING_MIN_INTERVAL, timeout=TYPING_TIMEOUT):
+        self.send = send
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.states = {}
+        # Timer tasks still running, kept so they are not collected midway
+        self.tasks = set()
+
+    async def update(self, sender_id, receiver_id, is_typing):
+        key = (sender_id, receiver_id)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = TypingState()
+
+        if is_typing == state.sent:
+            # Same state as the receiver already has, which also cancels a
+            # flip that was still waiting for its slot
+            state.pending = None
+            self.arm(key, state)
+            return
+
+        wait = state.flipped_at + self.min_interval - asyncio.get_running_loop().time()
+        if wait <= 0:
+            await self.emit(key, state, is_typing)
+        else:
+            state.pending = is_typing
+            self.arm(key, state, wait)
+
+    def arm(self, key, state, delay=None):
+        # One timer per pair, doing whatever is due when it fires: send the
+        # pending flip, expire is_typing=True, or forget an idle pair
+        if state.timer is not None:
+            state.timer.cancel()
+        if delay is None:
+            delay = self.timeout if state.sent else self.min_interval
+        state.timer = asyncio.get_running_loop().call_later(delay, self.start_fire, key)
+
+    def start_fire(self, key):
+        task = asyncio.get_running_loop().create_task(self.fire(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        task.add_done_callback(log_task_error)
+
+    async def fire(self, key):
+        state = self.states.get(key)
+        if state is None:
+            return
+        state.timer = None
+        if state.pending is not None:
+            await self.emit(key, state, state.pending)
+        elif state.sent:
+            await self.emit(key, state, False)
+        else:
+            del self.states[key]
+
+    async def emit(self, key, state, is_typing):
+        state.sent = is_typing
+        state.flipped_at = asyncio.get_running_loop().time()
+        state.pending = None
+        self.arm(key, state)
+        await self.send(*key, is_typing)
+
+
+async def send_typing_status(sender_id, receiver_id, is_typing):
+    # Ephemeral, so it goes straight through the channel layer
+    await deliver(get_channel_layer(), chat_group(receiver_id), {
+        'type': 'chat.typing',
+        **encode_frames({
+            'action': 'typing',
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'is_typing': is_typing,
+        }),
+    })
+
+
+_debouncers = weakref.WeakKeyDictionary()
+
+
+def get_typing_debouncer():
+    # One debouncer per event loop, i.e. per worker
+    loop = asyncio.get_running_loop()
+    if loop not in _debouncers:
+        _debouncers[loop] = TypingDebouncer(send_typing_status)
+    return _debouncers[loop]
@@ -0,0 +1,74 @@
+import os
+from itertools import groupby
+from operator import attrgetter
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from ChaatsApp.archive import ArchiveFile, archive_dir, archive_path, merge_conversations, write_archive
+from ChaatsApp.models import Conversation, Message
+from ChaatsApp.partitions import MESSAGE_COLUMNS, add_months, drop_partition_if_empty, is_partitioned, month_start, months_between
+
+
+class Command(BaseCommand):
+    help = 'Move messages of months older than --months into monthly archive files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=6, help='Months of messages, including the current one, kept in the database')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows read and deleted at a time')
+        parser.add_argument('--dry-run', action='store_true', help='Only report how many messages would be archived')
+
+    def handle(self, *args, **options):
+        if options['months'] < 1 or options['batch_size'] < 1:
+            raise CommandError('--months and --batch-size must be positive')
+
+        cutoff = add_months(month_start(timezone.now()), 1 - options['months'])
+        oldest = Message.objects.filter(timestamp__lt=cutoff).order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            self.stdout.write(f'No messages before {cutoff:%Y-%m}')
+            return
+
+        os.makedirs(archive_dir(), exist_ok=True)
+        partitioned = is_partitioned()
+        for month in months_between(oldest, cutoff):
+            self.archive_month(month, options['batch_size'], options['dry_run'])
+            if partitioned and not options['dry_run'] and drop_partition_if_empty(month):
+                self.stdout.write(f'{month:%Y-%m}: dropped the empty partition')
+
+    def archive_month(self, month, batch_size, dry_run):
+        # The newest message of every conversation stays in the table, so
+        # archived messages are always older than the ones left behind
+        messages = Message.objects.filter(timestamp__gte=month, timestamp__lt=add_months(month, 1)).exclude(
+            id__in=Conversation.objects.filter(last_message__isnull=False).values('last_message_id')
+        )
+        if dry_run:
+            self.stdout.write(f'{month:%Y-%m}: {messages.count()} messages would be archived')
+            return
+        if not messages.exists():
+            return
+
+        ids = []
+
+        def read_conversations():
+            rows = messages.order_by('conversation_id', 'timestamp', 'id').values_list(*MESSAGE_COLUMNS, named=True)
+            for conversation_id, group in groupby(rows.iterator(chunk_size=batch_size), key=attrgetter('conversation_id')):
+                group = list(group)
+                ids.extend(row.id for row in group)
+                yield conversation_id, group
+
+        # Messages archived by an earlier run are merged in; a run that
+        # stopped before deleting its rows leaves duplicates that are merged
+        # away here
+        path = archive_path(month)
+        existing = ArchiveFile(path) if os.path.exists(path) else None
+        try:
+            sources = [read_conversations()] + ([existing.conversations()] if existing else [])
+            write_archive(path, merge_conversations(*sources))
+        finally:
+            if existing:
+                existing.close()
+
+        # Rows are only deleted once the archive file is safely on disk
+        for start in range(0, len(ids), batch_size):
+            with transaction.atomic():
+                Message.objects.filter(id__in=ids[start:start + batch_size]).delete()
+        self.stdout.write(f'{month:%Y-%m}: archived {len(ids)} messages to {path}')
@@ -0,0 +1,242 @@
+import asyncio
+import json
+import math
+import random
+import time
+from collections import defaultdict, deque
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from rest_framework_simplejwt.tokens import AccessToken
+from ChaatsApp.models import Conversation, CustomUser, Message, UserProfile
+
+
+# Action name -> (stream, action of the reply that completes it). Typing
+# has no reply, so its latency is the time taken to hand the frame over.
+ACTIONS = {
+    'direct_message': ('chat-message', 'message_sent'),
+    'message_history': ('chat-message', 'message_history'),
+    'inbox': ('chat-message', 'inbox'),
+    'typing': ('chat', None),
+    'get_profile': ('user-profile', 'get_profile'),
+}
+DEFAULT_MIX = 'direct_message=40,message_history=15,typing=35,get_profile=10'
+HISTORY_MESSAGES = 20
+
+
+class Client:
+    # One simulated user, on the multiplexed endpoint or on one socket per
+    # stream. A reader task per socket resolves the pending requests.
+    def __init__(self, application, token, multiplex):
+        self.application = application
+        self.token = token
+        self.multiplex = multiplex
+        self.sockets = {}
+        self.readers = []
+        self.waiters = defaultdict(deque)
+        self.received = 0
+
+    async def connect(self):
+        paths = {None: 'multiplex'} if self.multiplex else {stream: stream for stream in ('chat-message', 'chat', 'user-profile')}
+        for stream, path in paths.items():
+            communicator = WebsocketCommunicator(self.application, f'/ws/{path}/?token={self.token}')
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise ConnectionError('Connection rejected')
+            self.sockets[stream] = communicator
+            self.readers.append(asyncio.create_task(self.read(communicator, stream)))
+
+    async def disconnect(self):
+        for reader in self.readers:
+            reader.cancel()
+        for communicator in self.sockets.values():
+            await communicator.disconnect()
+
+    async def read(self, communicator, stream):
+        while True:
+            message = await communicator.output_queue.get()
+            if message['type'] != 'websocket.send':
+                return
+            frame = json.loads(message['text'])
+            if self.multiplex:
+                stream, frame = frame['stream'], frame['payload']
+
+            self.received += 1
+            action = frame.get('action')
+            # History streams several frames; only the last one completes it
+            if action == 'message_history' and not frame.get('final', True) and 'error' not in frame:
+                continue
+            waiters = self.waiters[stream, action]
+            if waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(frame)
+
+    async def request(self, action, payload, timeout):
+        # Returns the reply frame, or None for actions without a reply
+        stream, reply_action = ACTIONS[action]
+        waiter = None
+        if reply_action is not None:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters[stream, reply_action].append(waiter)
+
+        payload = {'action': action, **payload}
+        if self.multiplex:
+            await self.sockets[None].send_to(text_data=json.dumps({'stream': stream, 'payload': payload}))
+        else:
+            await self.sockets[stream].send_to(text_data=json.dumps(payload))
+        return await asyncio.wait_for(waiter, timeout) if waiter is not None else None
+
+
+class Command(BaseCommand):
+    help = 'Drive simulated WebSocket clients against the ASGI application and report latency per action'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Simulated users, each with its own sockets')
+        parser.add_argument('--actions', type=int, default=20, help='Actions sent by each client')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help='Weighted action mix, e.g. "direct_message=3,typing=1"')
+        parser.add_argument('--think', type=float, default=50, help='Mean pause between actions of a client, in ms')
+        parser.add_argument('--timeout', type=float, default=30, help='Seconds to wait for a reply before counting an error')
+        parser.add_argument('--connect-concurrency', type=int, default=100, help='Handshakes in flight at once')
+        parser.add_argument('--multiplex', action='store_true', help='Use one ws/multiplex/ socket per client')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed, for repeatable runs')
+
+    def handle(self, *args, **options):
+        mix = self.parse_mix(options['mix'])
+        if options['clients'] < 2:
+            raise CommandError('At least two clients are needed')
+        random.seed(options['seed'])
+
+        # Everything runs against a throwaway test database, the in-memory
+        # channel layer and in-process presence and caches, so the numbers
+        # describe a single worker. Rate limits would only measure themselves.
+        with override_settings(
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+            REDIS_URL=None,
+            RATE_LIMITS={},
+        ):
+            old_config = setup_databases(verbosity=0, interactive=False, serialized_aliases=set())
+            try:
+                users, profile_ids = self.create_sample_data(options['clients'])
+                from ChaatsProject.asgi import application
+                asyncio.run(self.run_load(application, users, profile_ids, mix, options))
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+    @staticmethod
+    def parse_mix(value):
+        mix = {}
+        for part in value.split(','):
+            name, _, weight = part.partition('=')
+            name = name.strip()
+            if name not in ACTIONS:
+                raise CommandError(f'Unknown action {name!r}; choose from {", ".join(ACTIONS)}')
+            try:
+                mix[name] = float(weight or 1)
+            except ValueError:
+                raise CommandError(f'Invalid weight for {name}')
+        return mix
+
+    def create_sample_data(self, clients):
+        CustomUser.objects.bulk_create([
+            CustomUser(username=f'bench-user-{i}', email=f'bench-user-{i}@example.com', first_name='Bench')
+            for i in range(clients)
+        ])
+        users = list(CustomUser.objects.filter(username__startswith='bench-user-').order_by('id'))
+        profiles = UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+
+        # Some history between neighbours so message_history has pages to read
+        messages = []
+        for i in range(0, len(users) - 1, 2):
+            sender, receiver = users[i], users[i + 1]
+            conversation = Conversation.for_users(sender.id, receiver.id)
+            messages += [
+                Message(conversation=conversation, sender=sender, receiver=receiver, content=f'history {n}')
+                for n in range(HISTORY_MESSAGES)
+            ]
+        Message.create_batch(messages)
+
+        return [(user.id, str(AccessToken.for_user(user))) for user in users], [profile.id for profile in profiles]
+
+    async def run_load(self, application, users, profile_ids, mix, options):
+        user_ids = [user_id for user_id, _ in users]
+        clients = [Client(application, token, options['multiplex']) for _, token in users]
+        latencies = defaultdict(list)
+        errors = defaultdict(int)
+
+        semaphore = asyncio.Semaphore(options['connect_concurrency'])
+
+        async def connect(client):
+            async with semaphore:
+                start = time.perf_counter()
+                await client.connect()
+                latencies['connect'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[connect(client) for client in clients])
+        self.stdout.write(f'Connected {len(clients)} clients in {time.perf_counter() - start:.2f}s')
+
+        names, weights = list(mix), list(mix.values())
+
+        async def run_client(index, client):
+            # Each client talks to its history neighbour most of the time
+            partner_id = user_ids[index ^ 1] if (index ^ 1) < len(user_ids) else user_ids[0]
+            for _ in range(options['actions']):
+                await asyncio.sleep(random.expovariate(1000 / options['think']) if options['think'] > 0 else 0)
+                action = random.choices(names, weights)[0]
+                receiver_id = partner_id if random.random() < 0.8 else random.choice(user_ids)
+                payload = self.build_payload(action, receiver_id, partner_id, profile_ids)
+
+                started = time.perf_counter()
+                try:
+                    reply = await client.request(action, payload, options['timeout'])
+                except asyncio.TimeoutError:
+                    errors[action] += 1
+                    continue
+                if reply is not None and 'error' in reply:
+                    errors[action] += 1
+                else:
+                    latencies[action].append(time.perf_counter() - started)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[run_client(index, client) for index, client in enumerate(clients)])
+        elapsed = time.perf_counter() - start
+
+        received = sum(client.received for client in clients)
+        await asyncio.gather(*[client.disconnect() for client in clients])
+        self.report(latencies, errors, elapsed, received)
+
+    @staticmethod
+    def build_payload(action, receiver_id, partner_id, profile_ids):
+        if action == 'direct_message':
+            return {'receiver_id': receiver_id, 'content': 'bench message'}
+        if action == 'message_history':
+            return {'receiver_id': partner_id, 'page_size': 50}
+        if action == 'inbox':
+            return {'page_size': 20}
+        if action == 'typing':
+            return {'receiver_id': receiver_id, 'is_typing': random.random() < 0.7}
+        return {'user_id': random.choice(profile_ids)}
+
+    def report(self, latencies, errors, elapsed, received):
+        self.stdout.write(f'{"action":<18}{"count":>8}{"errors":>8}{"ops/s":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+        total = 0
+        for action in ['connect', *ACTIONS]:
+            samples = sorted(latencies.get(action, ()))
+            if not samples and not errors.get(action):
+                continue
+            if action != 'connect':
+                total += len(samples)
+            rate = len(samples) / elapsed if action != 'connect' else float('nan')
+            self.stdout.write(
+                f'{action:<18}{len(samples):>8}{errors.get(action, 0):>8}{rate:>10.1f}'
+                + ''.join(f'{self.percentile(samples, p) * 1000:>10.1f}' for p in (50, 95, 99, 100))
+            )
+        self.stdout.write(f'{total} actions in {elapsed:.2f}s: {total / elapsed:.1f} actions/s, {received / elapsed:.1f} frames received/s')
+
+    @staticmethod
+    def percentile(samples, p):
+        # Nearest-rank percentile of sorted samples
+        if not samples:
+            return float('nan')
+        return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
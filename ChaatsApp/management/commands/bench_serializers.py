@@ -0,0 +1,67 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ChaatsApp.fast_serializers import FastSerializer
+from ChaatsApp.models import Conversation, CustomUser, Message, UserProfile
+from ChaatsApp.serializers import CustomUserSerializer, MessageSerializer, UserProfileSerializer
+
+
+class Command(BaseCommand):
+    help = 'Compare DRF serializers with the values_list() fast path on list reads'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=5000, help='Rows of each model to serialize')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per serializer; the best one is reported')
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+
+        # Sample data lives in a transaction that is always rolled back
+        with transaction.atomic():
+            self.create_sample_data(rows)
+            self.stdout.write(f'{"serializer":<24}{"rows":>8}{"DRF ms":>12}{"fast ms":>12}{"speedup":>10}')
+            for serializer_class, queryset in (
+                (CustomUserSerializer, CustomUser.objects.order_by('id')),
+                (UserProfileSerializer, UserProfile.objects.select_related('user').order_by('id')),
+                (MessageSerializer, Message.objects.order_by('id')),
+            ):
+                self.compare(serializer_class, queryset, repeat)
+            transaction.set_rollback(True)
+
+    def create_sample_data(self, rows):
+        users = CustomUser.objects.bulk_create([
+            CustomUser(
+                username=f'bench-user-{i}', email=f'bench-user-{i}@example.com',
+                first_name='Bench', last_name=str(i), profile_picture=f'profile_pictures/{i}.jpg' if i % 2 else '',
+            )
+            for i in range(rows)
+        ])
+        UserProfile.objects.bulk_create([UserProfile(user=user) for user in users])
+
+        conversation = Conversation.for_users(users[0].id, users[1].id)
+        Message.create_batch([
+            Message(conversation=conversation, sender=users[i % 2], receiver=users[1 - i % 2], content=f'message {i}')
+            for i in range(rows)
+        ])
+
+    def compare(self, serializer_class, queryset, repeat):
+        drf_data, drf_time = self.best_of(repeat, lambda: serializer_class(list(queryset), many=True).data)
+        fast_data, fast_time = self.best_of(repeat, lambda: FastSerializer(serializer_class).serialize(queryset))
+
+        if [dict(row) for row in drf_data] != fast_data:
+            self.stderr.write(f'{serializer_class.__name__}: fast output differs from DRF output')
+
+        self.stdout.write(
+            f'{serializer_class.__name__:<24}{len(fast_data):>8}'
+            f'{drf_time * 1000:>12.1f}{fast_time * 1000:>12.1f}{drf_time / fast_time:>9.1f}x'
+        )
+
+    @staticmethod
+    def best_of(repeat, run):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = run()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+from ChaatsApp.models import Message
+from ChaatsApp.partitions import add_months, conversion_sql, create_partition_sql, is_partitioned, month_start
+
+
+class Command(BaseCommand):
+    help = 'Create upcoming monthly partitions of the message table, or print the script converting it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=3, help='Months after the current one to create partitions for')
+        parser.add_argument(
+            '--conversion-sql', action='store_true',
+            help='Print the script converting the message table into a partitioned one instead of running anything',
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('Message partitioning needs PostgreSQL')
+
+        current = month_start(timezone.now())
+        last = add_months(current, options['ahead'])
+        if options['conversion_sql']:
+            if is_partitioned():
+                raise CommandError('The message table is already partitioned')
+            oldest = Message.objects.order_by('timestamp').values_list('timestamp', flat=True).first()
+            self.stdout.write(conversion_sql(month_start(oldest or current), last), ending='')
+            return
+
+        if not is_partitioned():
+            raise CommandError(
+                'The message table is not partitioned; review and run the script printed by --conversion-sql first'
+            )
+        with connection.cursor() as cursor:
+            for months in range(options['ahead'] + 1):
+                cursor.execute(create_partition_sql(add_months(current, months)))
+        self.stdout.write(f'Partitions exist up to {last:%Y-%m}')
@@ -0,0 +1,175 @@
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from django.http import HttpResponse
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+HTTP_METHODS = ('get', 'post', 'put', 'patch', 'delete', 'head', 'options')
+
+# name -> (type, help, label names, buckets)
+METRICS = {
+    'chaats_action_duration_seconds': (
+        'histogram', 'Time spent handling a WebSocket action or REST request.', ('endpoint', 'action'), DURATION_BUCKETS,
+    ),
+    'chaats_db_queries_total': (
+        'counter', 'Database queries run while handling an action.', ('endpoint', 'action'), None,
+    ),
+    'chaats_db_query_seconds_total': (
+        'counter', 'Time spent in database queries while handling an action.', ('endpoint', 'action'), None,
+    ),
+    'chaats_frame_size_bytes': (
+        'histogram', 'Size of WebSocket frames.', ('endpoint', 'direction'), SIZE_BUCKETS,
+    ),
+    'chaats_active_connections': (
+        'gauge', 'Open WebSocket connections.', ('endpoint',), None,
+    ),
+    'chaats_rate_limited_total': (
+        'counter', 'WebSocket actions refused by a rate limit.', ('endpoint', 'action'), None,
+    ),
+    'chaats_outbound_dropped_total': (
+        'counter', 'Outbound WebSocket frames dropped because a client read too slowly.', ('endpoint',), None,
+    ),
+    'chaats_thumbnails_total': (
+        'counter', 'Profile pictures turned into thumbnails, by result.', ('result',), None,
+    ),
+}
+
+# (endpoint, action) being handled, so database queries can be attributed
+current_action = contextvars.ContextVar('current_action', default=None)
+
+
+# Each thread writes to its own shard without locking; shards are only
+# summed when the metrics are scraped. The lock guards shard creation.
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+
+
+def get_shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = {}
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def inc(name, labels, value=1):
+    # Counters, and gauges as a sum of increments and decrements
+    shard = get_shard()
+    key = (name, labels)
+    shard[key] = shard.get(key, 0) + value
+
+
+def observe(name, labels, value):
+    # Histogram samples are kept as per-bucket counts, then +Inf, then sum
+    buckets = METRICS[name][3]
+    shard = get_shard()
+    key = (name, labels)
+    counts = shard.get(key)
+    if counts is None:
+        counts = shard[key] = [0] * (len(buckets) + 2)
+    counts[bisect.bisect_left(buckets, value)] += 1
+    counts[-1] += value
+
+
+@contextmanager
+def measure(endpoint, action):
+    token = current_action.set((endpoint, action))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('chaats_action_duration_seconds', (endpoint, action), time.perf_counter() - start)
+        current_action.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    # Database execute wrapper counting queries per action
+    labels = current_action.get() or ('other', 'other')
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        inc('chaats_db_queries_total', labels)
+        inc('chaats_db_query_seconds_total', labels, time.perf_counter() - start)
+
+
+def collect():
+    # Sum of all shards. Copying a dict or list is atomic under the GIL,
+    # so writers never have to wait for a scrape.
+    with _shards_lock:
+        shards = list(_shards)
+
+    totals = {}
+    for shard in shards:
+        for key, value in shard.copy().items():
+            if isinstance(value, list):
+                value = list(value)
+                total = totals.setdefault(key, [0] * len(value))
+                for i, part in enumerate(value):
+                    total[i] += part
+            else:
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def render():
+    # Prometheus text exposition format
+    totals = collect()
+    lines = []
+    for name, (metric_type, help_text, label_names, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        for (metric_name, labels), value in sorted(totals.items(), key=lambda item: item[0][1]):
+            if metric_name != name:
+                continue
+            if metric_type != 'histogram':
+                lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+                continue
+
+            cumulative = 0
+            for bound, count in zip((*buckets, '+Inf'), value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(label_names, labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(label_names, labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_labels(label_names, labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view(request):
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class MetricsMiddleware:
+    # Times every REST view per view class and HTTP method
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        response = self.get_response(request)
+        labels = getattr(request, 'metrics_labels', None)
+        if labels is not None:
+            observe('chaats_action_duration_seconds', labels, time.perf_counter() - start)
+            current_action.set(None)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'view_class', view_func)
+        method = request.method.lower()
+        request.metrics_labels = (getattr(view, '__name__', 'view'), method if method in HTTP_METHODS else 'other')
+        current_action.set(request.metrics_labels)
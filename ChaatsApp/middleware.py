@@ -0,0 +1,80 @@
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.tokens import AccessToken
+from .cache import LRUCache
+
+
+User = get_user_model()
+
+# Verified tokens are remembered for at most TOKEN_CACHE_TTL seconds and
+# never past their own expiry
+TOKEN_CACHE_SIZE = 10000
+TOKEN_CACHE_TTL = 300
+
+
+class TokenUserCache(LRUCache):
+    # Verified token -> user
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        super().__init__(max_size, ttl)
+
+
+token_cache = TokenUserCache()
+
+
+def get_scope_token(scope):
+    # Browsers cannot set headers on WebSocket requests, so the token may
+    # also come in the query string as ?token=...
+    for name, value in scope.get('headers', ()):
+        if name == b'authorization':
+            scheme, _, token = value.decode('latin1').partition(' ')
+            if scheme.lower() == 'bearer' and token:
+                return token.strip()
+
+    query = parse_qs(scope.get('query_string', b'').decode('latin1'))
+    tokens = query.get('token')
+    return tokens[0] if tokens else None
+
+
+@database_sync_to_async
+def verify_token(token):
+    # Signature check and user lookup both run off the event loop
+    try:
+        access_token = AccessToken(token)
+        user = User.objects.get(id=access_token['user_id'])
+    except (TokenError, KeyError, User.DoesNotExist):
+        return None, None
+
+    if not user.is_active:
+        return None, None
+    return user, access_token['exp']
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    # Puts the user of a valid JWT access token into scope['user'], or an
+    # AnonymousUser when there is no valid token
+    def __init__(self, inner, cache=token_cache):
+        super().__init__(inner)
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        scope['user'] = await self.resolve_user(get_scope_token(scope))
+        return await super().__call__(scope, receive, send)
+
+    async def resolve_user(self, token):
+        if not token:
+            return AnonymousUser()
+
+        user = self.cache.get(token)
+        if user is not None:
+            return user
+
+        user, expires_at = await verify_token(token)
+        if user is None:
+            return AnonymousUser()
+        self.cache.set(token, user, expires_at)
+        return user
@@ -0,0 +1,33 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ChaatsApp.customuser')),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ChaatsApp.customuser')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_conversation_pair'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.CheckConstraint(check=models.Q(('user_low__lte', models.F('user_high'))), name='conversation_pair_ordered'),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='ChaatsApp.conversation'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+
+def backfill_conversations(apps, schema_editor):
+    Conversation = apps.get_model('ChaatsApp', 'Conversation')
+    Message = apps.get_model('ChaatsApp', 'Message')
+
+    pairs = set()
+    for sender_id, receiver_id in Message.objects.values_list('sender_id', 'receiver_id').distinct():
+        pairs.add((min(sender_id, receiver_id), max(sender_id, receiver_id)))
+
+    for user_low_id, user_high_id in pairs:
+        conversation, _ = Conversation.objects.get_or_create(user_low_id=user_low_id, user_high_id=user_high_id)
+        Message.objects.filter(
+            models.Q(sender_id=user_low_id, receiver_id=user_high_id) |
+            models.Q(sender_id=user_high_id, receiver_id=user_low_id)
+        ).update(conversation=conversation)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0002_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
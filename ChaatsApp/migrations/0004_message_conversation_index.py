@@ -0,0 +1,21 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0003_backfill_conversations'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='ChaatsApp.conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conversation_idx'),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0004_message_conversation_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='ChaatsApp.message'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_timestamp',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_high_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_low_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_low', '-last_timestamp', '-id'], name='conversation_inbox_low_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user_high', '-last_timestamp', '-id'], name='conversation_inbox_high_idx'),
+        ),
+    ]
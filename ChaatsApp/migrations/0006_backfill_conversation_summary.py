@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+def backfill_summaries(apps, schema_editor):
+    Conversation = apps.get_model('ChaatsApp', 'Conversation')
+    Message = apps.get_model('ChaatsApp', 'Message')
+
+    # Unread counters start at zero since no read state existed before
+    latest = Message.objects.filter(conversation=models.OuterRef('pk')).order_by('-timestamp', '-id')
+    Conversation.objects.update(
+        last_message_id=models.Subquery(latest.values('id')[:1]),
+        last_timestamp=models.Subquery(latest.values('timestamp')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0005_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
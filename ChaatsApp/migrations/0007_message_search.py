@@ -0,0 +1,61 @@
+from django.db import migrations
+
+
+# Full-text index over Message.content, kept outside the model state. On
+# Postgres it is a generated tsvector column with a GIN index; on SQLite
+# an external-content FTS5 table synced by triggers. SQLite drops the
+# triggers whenever Django rebuilds the message table, so migrations that
+# do must recreate them.
+POSTGRES_FORWARD = [
+    '''ALTER TABLE "ChaatsApp_message" ADD COLUMN "search_vector" tsvector
+       GENERATED ALWAYS AS (to_tsvector('english', coalesce("content", ''))) STORED''',
+    'CREATE INDEX "message_search_idx" ON "ChaatsApp_message" USING GIN ("search_vector")',
+]
+POSTGRES_BACKWARD = [
+    'DROP INDEX IF EXISTS "message_search_idx"',
+    'ALTER TABLE "ChaatsApp_message" DROP COLUMN IF EXISTS "search_vector"',
+]
+
+SQLITE_FORWARD = [
+    '''CREATE VIRTUAL TABLE "message_fts" USING fts5(
+       "content", content='ChaatsApp_message', content_rowid='id')''',
+    '''CREATE TRIGGER "message_fts_insert" AFTER INSERT ON "ChaatsApp_message" BEGIN
+       INSERT INTO "message_fts" (rowid, "content") VALUES (new."id", new."content");
+       END''',
+    '''CREATE TRIGGER "message_fts_delete" AFTER DELETE ON "ChaatsApp_message" BEGIN
+       INSERT INTO "message_fts" ("message_fts", rowid, "content") VALUES ('delete', old."id", old."content");
+       END''',
+    '''CREATE TRIGGER "message_fts_update" AFTER UPDATE OF "content" ON "ChaatsApp_message" BEGIN
+       INSERT INTO "message_fts" ("message_fts", rowid, "content") VALUES ('delete', old."id", old."content");
+       INSERT INTO "message_fts" (rowid, "content") VALUES (new."id", new."content");
+       END''',
+    '''INSERT INTO "message_fts" ("message_fts") VALUES ('rebuild')''',
+]
+SQLITE_BACKWARD = [
+    'DROP TRIGGER IF EXISTS "message_fts_insert"',
+    'DROP TRIGGER IF EXISTS "message_fts_delete"',
+    'DROP TRIGGER IF EXISTS "message_fts_update"',
+    'DROP TABLE IF EXISTS "message_fts"',
+]
+
+
+def run_for_vendor(postgres, sqlite):
+    def run(apps, schema_editor):
+        statements = {'postgresql': postgres, 'sqlite': sqlite}.get(schema_editor.connection.vendor, [])
+        for statement in statements:
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0006_backfill_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor(POSTGRES_FORWARD, SQLITE_FORWARD),
+            run_for_vendor(POSTGRES_BACKWARD, SQLITE_BACKWARD),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0007_message_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['username'], name='customuser_username_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='customuser',
+            index=models.Index(fields=['email'], name='customuser_email_prefix', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
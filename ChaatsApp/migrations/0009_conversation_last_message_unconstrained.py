@@ -0,0 +1,19 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0008_customuser_prefix_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='ChaatsApp.message'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0009_conversation_last_message_unconstrained'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='change_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MessageChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveBigIntegerField()),
+                ('message_id', models.BigIntegerField()),
+                ('kind', models.CharField(choices=[('created', 'Created'), ('edited', 'Edited'), ('deleted', 'Deleted')], max_length=7)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ChaatsApp.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='ChaatsApp.customuser')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='messagechange',
+            constraint=models.UniqueConstraint(fields=('user', 'seq'), name='unique_message_change_seq'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0010_message_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='user_high_delivered',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_high_read',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_low_delivered',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='user_low_read',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 10:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0012_rooms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='profile_picture_digest',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64),
+        ),
+    ]
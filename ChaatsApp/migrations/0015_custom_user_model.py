@@ -0,0 +1,112 @@
+from datetime import timezone
+from django.db import migrations
+from django.utils.timezone import is_naive, make_aware
+
+
+# AUTH_USER_MODEL now names CustomUser. New databases are created that way
+# from the start; this converts databases created while auth.User was the
+# user model:
+#
+# - Accounts that only exist in auth_user are copied over by username, with
+#   their password hashes, so people can still log in. Their ids change.
+# - The admin log is pointed at the new user table, each entry at the user
+#   with the same username; entries of users that no longer exist are
+#   dropped.
+#
+# Tokens issued before the upgrade carry auth_user ids, which may belong to
+# someone else among the new users. Rotate SIMPLE_JWT's SIGNING_KEY (the
+# SECRET_KEY by default) when deploying this, so every client logs in again.
+
+USER_COLUMNS = (
+    'password', 'last_login', 'is_superuser', 'username', 'first_name', 'last_name',
+    'email', 'is_staff', 'is_active', 'date_joined',
+)
+
+
+def copy_auth_users(apps, schema_editor):
+    connection = schema_editor.connection
+    if 'auth_user' not in connection.introspection.table_names():
+        return
+    CustomUser = apps.get_model('ChaatsApp', 'CustomUser')
+    existing = set(CustomUser.objects.values_list('username', flat=True))
+    taken_emails = set(CustomUser.objects.values_list('email', flat=True))
+
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT {", ".join(USER_COLUMNS)} FROM auth_user ORDER BY id')
+        rows = cursor.fetchall()
+
+    users = []
+    for row in rows:
+        values = dict(zip(USER_COLUMNS, row))
+        if values['username'] in existing:
+            continue
+        # CustomUser.email is unique and required
+        if not values['email'] or values['email'] in taken_emails:
+            values['email'] = f'{values["username"]}@users.invalid'
+        taken_emails.add(values['email'])
+        for key in ('last_login', 'date_joined'):
+            if values[key] is not None and is_naive(values[key]):
+                values[key] = make_aware(values[key], timezone.utc)
+        values['first_name'] = values['first_name'][:30]
+        values['last_name'] = values['last_name'][:30]
+        users.append(CustomUser(**values))
+    CustomUser.objects.bulk_create(users)
+
+
+def repoint_admin_log(apps, schema_editor):
+    connection = schema_editor.connection
+    LogEntry = apps.get_model('admin', 'LogEntry')
+    CustomUser = apps.get_model('ChaatsApp', 'CustomUser')
+    table = LogEntry._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    targets = {
+        constraint['foreign_key'][0] for constraint in constraints.values()
+        if constraint['foreign_key'] and constraint['columns'] == ['user_id']
+    }
+    if targets <= {CustomUser._meta.db_table}:
+        return
+
+    # The historical field points at the new table, the database column
+    # still at the old one. Its constraint is dropped while the ids are
+    # mapped, then created again for the new table.
+    new_field = LogEntry._meta.get_field('user')
+    old_field = new_field.clone()
+    old_field.remote_field.model = apps.get_model('auth', 'User')
+    old_field.set_attributes_from_name('user')
+    old_field.model = LogEntry
+    unconstrained = new_field.clone()
+    unconstrained.db_constraint = False
+    unconstrained.remote_field.model = CustomUser
+    unconstrained.set_attributes_from_name('user')
+    unconstrained.model = LogEntry
+    schema_editor.alter_field(LogEntry, old_field, unconstrained)
+
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT id, username FROM auth_user')
+        old_ids = dict(cursor.fetchall())
+    new_ids = dict(CustomUser.objects.values_list('username', 'id'))
+    entries = {}
+    for entry_id, user_id in LogEntry.objects.values_list('id', 'user_id'):
+        entries.setdefault(new_ids.get(old_ids.get(user_id)), []).append(entry_id)
+    for user_id, entry_ids in entries.items():
+        if user_id is None:
+            LogEntry.objects.filter(id__in=entry_ids).delete()
+        else:
+            LogEntry.objects.filter(id__in=entry_ids).update(user_id=user_id)
+
+    schema_editor.alter_field(LogEntry, unconstrained, new_field)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0014_attachment'),
+        ('admin', '0003_logentry_add_action_flag_choices'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_auth_users, migrations.RunPython.noop),
+        migrations.RunPython(repoint_admin_log, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ChaatsApp', '0015_custom_user_model'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='is_public',
+            field=models.BooleanField(default=False),
+        ),
+    ]
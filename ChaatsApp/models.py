@@ -1,15 +1,18 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
-from django.contrib.auth import get_user_model
+from django.db import models, transaction
+from django.db.models.functions import Coalesce, Greatest, Least
+from .pagination import keyset_filter
 
 
-User = get_user_model()
-
 class CustomUser(AbstractUser):
     email = models.EmailField(unique=True)
     first_name = models.CharField(max_length=30)
     last_name = models.CharField(max_length=30)
     profile_picture = models.ImageField(upload_to='profile_pictures/', blank=True, null=True)
+    # Names the thumbnails of profile_picture, empty until they are made
+    profile_picture_digest = models.CharField(max_length=64, blank=True, default='', editable=False)
+    # Last MessageChange.seq handed out for this user
+    change_seq = models.PositiveBigIntegerField(default=0)
 
     groups = models.ManyToManyField(
             'auth.Group',
@@ -26,6 +29,14 @@ class CustomUser(AbstractUser):
             related_name='customuser_set',  
         )
 
+    class Meta(AbstractUser.Meta):
+        # Prefix searches (LIKE 'abc%') in the admin; opclasses only
+        # matter on Postgres
+        indexes = [
+            models.Index(fields=['username'], name='customuser_username_prefix', opclasses=['varchar_pattern_ops']),
+            models.Index(fields=['email'], name='customuser_email_prefix', opclasses=['varchar_pattern_ops']),
+        ]
+
     def __str__(self):
         return self.username
 
@@ -40,7 +51,183 @@ class UserProfile(models.Model):
 
 
 
+class Conversation(models.Model):
+    # One row per pair of users, stored with the smaller user id first so
+    # both directions of a chat share the same key
+    user_low = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+
+    # Inbox summary, kept up to date as messages are created. No database
+    # constraint, so the message table can be partitioned by month.
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, related_name='+', db_constraint=False)
+    last_timestamp = models.DateTimeField(null=True, blank=True)
+    user_low_unread = models.PositiveIntegerField(default=0)
+    user_high_unread = models.PositiveIntegerField(default=0)
+
+    # Receipts: id of the newest message each side has received and read
+    user_low_delivered = models.PositiveBigIntegerField(default=0)
+    user_low_read = models.PositiveBigIntegerField(default=0)
+    user_high_delivered = models.PositiveBigIntegerField(default=0)
+    user_high_read = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.user_low_id} and {self.user_high_id}'
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_conversation_pair'),
+            models.CheckConstraint(check=models.Q(user_low__lte=models.F('user_high')), name='conversation_pair_ordered'),
+        ]
+        indexes = [
+            # Each side of the pair has its own newest-first inbox index
+            models.Index(fields=('user_low', '-last_timestamp', '-id'), name='conversation_inbox_low_idx'),
+            models.Index(fields=('user_high', '-last_timestamp', '-id'), name='conversation_inbox_high_idx'),
+        ]
+
+    def other_user_id(self, user_id):
+        return self.user_high_id if int(user_id) == self.user_low_id else self.user_low_id
+
+    def unread_for(self, user_id):
+        return self.user_low_unread if int(user_id) == self.user_low_id else self.user_high_unread
+
+    def receipts_for(self, user_id):
+        # How far the other user got through the conversation: the
+        # (delivered, read) marks of the other side
+        if int(user_id) == self.user_low_id:
+            return self.user_high_delivered, self.user_high_read
+        return self.user_low_delivered, self.user_low_read
+
+    @staticmethod
+    def normalize(user_a_id, user_b_id):
+        user_a_id, user_b_id = int(user_a_id), int(user_b_id)
+        return min(user_a_id, user_b_id), max(user_a_id, user_b_id)
+
+    @classmethod
+    def for_users(cls, user_a_id, user_b_id):
+        user_low_id, user_high_id = cls.normalize(user_a_id, user_b_id)
+        conversation, _ = cls.objects.get_or_create(user_low_id=user_low_id, user_high_id=user_high_id)
+        return conversation
+
+    @classmethod
+    def lookup_id(cls, user_a_id, user_b_id):
+        # Conversation id for a pair of users, or None if they never talked
+        try:
+            user_low_id, user_high_id = cls.normalize(user_a_id, user_b_id)
+        except (TypeError, ValueError):
+            return None
+        return cls.objects.filter(
+            user_low_id=user_low_id, user_high_id=user_high_id
+        ).values_list('id', flat=True).first()
+
+    @classmethod
+    def record_messages(cls, messages):
+        # Fold newly created messages into their conversation summaries,
+        # one UPDATE per conversation
+        by_conversation = {}
+        for message in messages:
+            by_conversation.setdefault(message.conversation_id, []).append(message)
+
+        # Rows are updated in id order so concurrent batches lock them in
+        # the same order and cannot deadlock
+        for conversation_id in sorted(by_conversation):
+            batch = by_conversation[conversation_id]
+            latest = max(batch, key=lambda message: (message.timestamp, message.id))
+            unread = {'user_low_unread': 0, 'user_high_unread': 0}
+            for message in batch:
+                if message.sender_id != message.receiver_id:
+                    field = 'user_low_unread' if message.receiver_id < message.sender_id else 'user_high_unread'
+                    unread[field] += 1
+
+            # Concurrent writers may commit out of order, so the summary only
+            # moves forward in (timestamp, id)
+            newer = (
+                models.Q(last_timestamp__isnull=True) |
+                models.Q(last_timestamp__lt=latest.timestamp) |
+                models.Q(last_timestamp=latest.timestamp, last_message_id__lt=latest.id)
+            )
+            cls.objects.filter(pk=conversation_id).update(
+                last_message_id=models.Case(
+                    models.When(newer, then=models.Value(latest.id, output_field=models.BigIntegerField())),
+                    default=models.F('last_message_id'),
+                    output_field=models.BigIntegerField(),
+                ),
+                last_timestamp=models.Case(
+                    models.When(newer, then=models.Value(latest.timestamp, output_field=models.DateTimeField())),
+                    default=models.F('last_timestamp'),
+                ),
+                user_low_unread=models.F('user_low_unread') + unread['user_low_unread'],
+                user_high_unread=models.F('user_high_unread') + unread['user_high_unread'],
+            )
+
+    @classmethod
+    def mark_read(cls, conversation_id, user_id):
+        user_id = int(user_id)
+        cls.objects.filter(pk=conversation_id, user_low_id=user_id).update(user_low_unread=0)
+        cls.objects.filter(pk=conversation_id, user_high_id=user_id).update(user_high_unread=0)
+
+    @classmethod
+    def acknowledge(cls, acks):
+        # Raise the delivered and read marks of many {(user_id,
+        # conversation_id): (delivered, read)} pairs with a single UPDATE.
+        # Marks only move forward, never past the conversation's last
+        # message, and reading up to it clears the unread count. Returns
+        # the stored marks of every pair whose user is part of the
+        # conversation, as (conversation_id, user_id, other_user_id,
+        # delivered, read).
+        assignments = {}
+        for side in ('user_low', 'user_high'):
+            delivered_whens, read_whens, unread_whens = [], [], []
+            for (user_id, conversation_id), (delivered, read) in acks.items():
+                pair = models.Q(pk=conversation_id, **{f'{side}_id': user_id})
+                delivered = cls.capped_mark(max(delivered, read))
+                read_value = cls.capped_mark(read)
+                delivered_whens.append(models.When(pair, then=Greatest(models.F(f'{side}_delivered'), delivered)))
+                read_whens.append(models.When(pair, then=Greatest(models.F(f'{side}_read'), read_value)))
+                unread_whens.append(models.When(pair & models.Q(last_message_id__lte=read), then=models.Value(0, output_field=models.PositiveIntegerField())))
+            for name, whens in (('delivered', delivered_whens), ('read', read_whens), ('unread', unread_whens)):
+                field = f'{side}_{name}'
+                assignments[field] = models.Case(*whens, default=models.F(field))
+
+        conversation_ids = {conversation_id for _, conversation_id in acks}
+        cls.objects.filter(pk__in=conversation_ids).update(**assignments)
+
+        receipts = []
+        for conversation in cls.objects.filter(pk__in=conversation_ids).only(
+            'user_low', 'user_high', 'user_low_delivered', 'user_low_read', 'user_high_delivered', 'user_high_read',
+        ):
+            for user_id in {conversation.user_low_id, conversation.user_high_id}:
+                if (user_id, conversation.id) in acks:
+                    other_user_id = conversation.other_user_id(user_id)
+                    receipts.append((conversation.id, user_id, other_user_id, *conversation.receipts_for(other_user_id)))
+        return receipts
+
+    @staticmethod
+    def capped_mark(mark):
+        value = models.Value(mark, output_field=models.PositiveBigIntegerField())
+        return Least(value, Coalesce(models.F('last_message_id'), value), output_field=models.PositiveBigIntegerField())
+
+    @classmethod
+    def inbox(cls, user_id, position=None, limit=20):
+        # Newest conversations first. Each side of the pair is read with its
+        # own index range scan and the two short lists are merged here, so
+        # the cost is proportional to the page size, not the user's history.
+        # One extra row is returned to tell whether more pages follow.
+        conversations = cls.objects.filter(last_timestamp__isnull=False).select_related('last_message')
+        sides = (
+            conversations.filter(user_low_id=user_id),
+            conversations.filter(user_high_id=user_id).exclude(user_low_id=user_id),
+        )
+
+        page = []
+        for side in sides:
+            page.extend(keyset_filter(side, position, 'before', field='last_timestamp')[:limit + 1])
+        page.sort(key=lambda conversation: (conversation.last_timestamp, conversation.id), reverse=True)
+        return page[:limit + 1]
+
+
+
 class Message(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='sent_messages')
     receiver = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='received_messages')
     content = models.TextField()
@@ -49,7 +236,236 @@ class Message(models.Model):
     def __str__(self):
         return f'{self.sender.username} to {self.receiver.username}'
 
+    @classmethod
+    def create_batch(cls, messages):
+        # Insert unsaved messages with a single INSERT and fold them into
+        # their conversation summaries. bulk_create skips save(), so the
+        # conversation keys are filled in here.
+        conversations = {}
+        for message in messages:
+            if message.conversation_id is None:
+                pair = Conversation.normalize(message.sender_id, message.receiver_id)
+                if pair not in conversations:
+                    conversations[pair] = Conversation.for_users(*pair)
+                message.conversation = conversations[pair]
+
+        with transaction.atomic():
+            created = cls.objects.bulk_create(messages)
+            Conversation.record_messages(created)
+            MessageChange.record(created, MessageChange.CREATED)
+        return created
+
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        with transaction.atomic():
+            if self.conversation_id is None:
+                self.conversation = Conversation.for_users(self.sender_id, self.receiver_id)
+            super().save(*args, **kwargs)
+            if adding:
+                Conversation.record_messages([self])
+            MessageChange.record([self], MessageChange.CREATED if adding else MessageChange.EDITED)
+
+    def delete(self, *args, **kwargs):
+        # Only deleting a single message is a change clients sync; bulk
+        # deletes, like archiving, are not
+        with transaction.atomic():
+            MessageChange.record([self], MessageChange.DELETED)
+            return super().delete(*args, **kwargs)
+
     class Meta:
         ordering = ('timestamp',)
+        indexes = [
+            # History reads are a single range scan over one conversation
+            models.Index(fields=('conversation', 'timestamp', 'id'), name='message_conversation_idx'),
+        ]
+
+
+class MessageChange(models.Model):
+    # Log of message changes per user, read by the sync action. seq counts
+    # the changes of one user; see record() for why it never goes back.
+    CREATED = 'created'
+    EDITED = 'edited'
+    DELETED = 'deleted'
+    KINDS = ((CREATED, 'Created'), (EDITED, 'Edited'), (DELETED, 'Deleted'))
+
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='+')
+    seq = models.PositiveBigIntegerField()
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='+')
+    # Not a foreign key: changes outlive deleted and archived messages
+    message_id = models.BigIntegerField()
+    kind = models.CharField(max_length=7, choices=KINDS)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('user', 'seq'), name='unique_message_change_seq'),
+        ]
+
+    @classmethod
+    def record(cls, messages, kind):
+        # Log a change of each message for both of its users. Runs inside
+        # the transaction writing the messages: the UPDATE of a user's
+        # counter keeps the row locked until commit, so the changes of one
+        # user commit in seq order and a reader that has seen seq n has seen
+        # everything below it. Users are locked in id order to avoid
+        # deadlocks between concurrent writers.
+        #
+        # The price is that writes touching a user are serialized: both
+        # users' rows stay locked for the rest of the message's transaction,
+        # so a busy user's messages commit one transaction at a time. Keep
+        # these transactions short; MessageWriter batches concurrent
+        # messages so a batch takes each lock once.
+        by_user = {}
+        for message in messages:
+            for user_id in {message.sender_id, message.receiver_id}:
+                by_user.setdefault(user_id, []).append(message)
+
+        changes = []
+        for user_id in sorted(by_user):
+            batch = by_user[user_id]
+            users = CustomUser.objects.filter(pk=user_id)
+            users.update(change_seq=models.F('change_seq') + len(batch))
+            last_seq = users.values_list('change_seq', flat=True).get()
+            changes.extend(
+                cls(user_id=user_id, seq=seq, conversation_id=message.conversation_id, message_id=message.id, kind=kind)
+                for seq, message in enumerate(batch, last_seq - len(batch) + 1)
+            )
+        cls.objects.bulk_create(changes)
+
+    @classmethod
+    def pending(cls, user_id, since, marks, limit):
+        # Changes of the user after since, or after their own mark for the
+        # conversations in marks, oldest first, with one extra row to tell
+        # whether more follow. Also returns the user's latest seq, read
+        # first so no change up to it can still be uncommitted.
+        latest = CustomUser.objects.filter(pk=user_id).values_list('change_seq', flat=True).first() or 0
+        changes = cls.objects.filter(user_id=user_id, seq__gt=min([since, *marks.values()]), seq__lte=latest)
+        if marks:
+            condition = models.Q(seq__gt=since) & ~models.Q(conversation_id__in=marks)
+            for conversation_id, mark in marks.items():
+                condition |= models.Q(conversation_id=conversation_id, seq__gt=mark)
+            changes = changes.filter(condition)
+        return list(changes.order_by('seq')[:limit + 1]), latest
+
+
+# Room sockets are spread over shard_count channel layer groups so no single
+# group of a large room holds every socket. Shards double as the room grows
+# and never shrink, so a socket that joined under an older count is still
+# reached: its shard is below the current count.
+ROOM_SHARD_SIZE = 1000
+ROOM_MAX_SHARDS = 64
+
+
+class Room(models.Model):
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    member_count = models.PositiveIntegerField(default=0)
+    shard_count = models.PositiveSmallIntegerField(default=1)
+    # Anyone may join a public room; others only take users invited by a member
+    is_public = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def add_members(cls, room_id, user_ids):
+        # Returns the ids of the users that were not members yet
+        with transaction.atomic():
+            existing = set(Membership.objects.filter(room_id=room_id, user_id__in=user_ids).values_list('user_id', flat=True))
+            added = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in existing]
+            Membership.objects.bulk_create([Membership(room_id=room_id, user_id=user_id) for user_id in added])
+            cls.objects.filter(pk=room_id).update(member_count=models.F('member_count') + len(added))
+
+            member_count = cls.objects.filter(pk=room_id).values_list('member_count', flat=True).get()
+            shard_count = 1
+            while shard_count * ROOM_SHARD_SIZE < member_count and shard_count < ROOM_MAX_SHARDS:
+                shard_count *= 2
+            cls.objects.filter(pk=room_id, shard_count__lt=shard_count).update(shard_count=shard_count)
+        return added
+
+    @classmethod
+    def remove_member(cls, room_id, user_id):
+        with transaction.atomic():
+            deleted, _ = Membership.objects.filter(room_id=room_id, user_id=user_id).delete()
+            if deleted:
+                cls.objects.filter(pk=room_id).update(member_count=models.F('member_count') - 1)
+        return bool(deleted)
+
+
+class Membership(models.Model):
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='memberships')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='memberships')
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=('room', 'user'), name='unique_room_membership'),
+        ]
+        indexes = [
+            # A connecting socket looks up every room of its user
+            models.Index(fields=('user', 'room'), name='membership_user_idx'),
+        ]
+
+
+class RoomMessage(models.Model):
+    # Stored once per room, whatever the number of members
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
+    sender = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, related_name='+')
+    content = models.TextField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('timestamp',)
+        indexes = [
+            models.Index(fields=('room', 'timestamp', 'id'), name='room_message_history_idx'),
+        ]
+
+
+class Attachment(models.Model):
+    # A file uploaded in chunks, then sent with one direct message. Messages
+    # only carry attachment ids; the bytes live on disk, see attachments.py.
+    uploader = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='attachments')
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, default='application/octet-stream')
+    size = models.PositiveBigIntegerField()
+    # Bytes stored so far; an interrupted upload resumes from here
+    received = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Archived messages leave the table but keep their attachments, so the
+    # reference is not a constraint. The conversation decides who may read.
+    message = models.ForeignKey(Message, on_delete=models.DO_NOTHING, null=True, blank=True, db_constraint=False, related_name='attachments')
+    conversation = models.ForeignKey(Conversation, on_delete=models.SET_NULL, null=True, blank=True, related_name='attachments')
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def readable_by(self, user_id):
+        if self.uploader_id == user_id:
+            return True
+        conversation = self.conversation
+        return conversation is not None and user_id in (conversation.user_low_id, conversation.user_high_id)
+
+    @classmethod
+    def unsent(cls, user_id, attachment_ids):
+        # Completed uploads of the user not yet sent with a message
+        return cls.objects.filter(
+            id__in=attachment_ids, uploader_id=user_id, message__isnull=True, received=models.F('size'),
+        )
+
+    @classmethod
+    def attach(cls, message, attachment_ids):
+        return cls.unsent(message.sender_id, attachment_ids).update(
+            message_id=message.id, conversation_id=message.conversation_id,
+        )
 
+    @classmethod
+    def ids_by_message(cls, message_ids):
+        attachments = {}
+        rows = cls.objects.filter(message_id__in=message_ids).order_by('id').values_list('message_id', 'id')
+        for message_id, attachment_id in rows:
+            attachments.setdefault(message_id, []).append(attachment_id)
+        return attachments
@@ -0,0 +1,103 @@
+import base64
+import binascii
+from datetime import datetime
+from django.db import models
+
+
+INBOX_PAGE_SIZE = 20
+INBOX_MAX_PAGE_SIZE = 100
+
+LIST_PAGE_SIZE = 100
+LIST_MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(timestamp, pk):
+    # Opaque cursor holding the (timestamp, id) position of a row; lists
+    # ordered by id alone pass None as the timestamp
+    raw = f'{timestamp.isoformat() if timestamp is not None else ""}|{pk}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.split('|')
+        return (datetime.fromisoformat(timestamp) if timestamp else None), int(pk)
+    except (AttributeError, TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+def keyset_filter(queryset, position, direction, field='timestamp'):
+    # Restrict the queryset to rows strictly after/before position on
+    # (field, id), or on id alone when field is None, and order it so the
+    # rows nearest to the cursor come first
+    after = direction == 'after'
+    if position is not None:
+        value, pk = position
+        if field is None:
+            queryset = queryset.filter(**{'id__gt' if after else 'id__lt': pk})
+        elif after:
+            queryset = queryset.filter(
+                models.Q(**{f'{field}__gt': value}) |
+                models.Q(**{field: value, 'id__gt': pk})
+            )
+        else:
+            queryset = queryset.filter(
+                models.Q(**{f'{field}__lt': value}) |
+                models.Q(**{field: value, 'id__lt': pk})
+            )
+
+    ordering = ('id',) if field is None else (field, 'id')
+    if not after:
+        ordering = tuple(f'-{name}' for name in ordering)
+    return queryset.order_by(*ordering)
+
+
+def read_tiers(readers, position, limit, position_of):
+    # Rows from several storage tiers holding successive ranges of one
+    # ordering, e.g. the table then the archive. Each reader takes a
+    # position and a row count; the next one is only asked for the rows
+    # the previous ones could not supply, from where they stopped.
+    rows = []
+    for read in readers:
+        if len(rows) >= limit:
+            break
+        rows += read(position_of(rows[-1]) if rows else position, limit - len(rows))
+    return rows
+
+
+def paginate_queryset(queryset, query_params, field, default_page_size, maximum_page_size, position_of=None, older=None):
+    # Cursor pagination for REST list views. Pages always list rows in
+    # ascending order; ?after= walks forward and ?before= walks backward.
+    # position_of maps a row to its (field, id) values when rows are not
+    # model instances. older(position, direction, limit) supplies rows that
+    # come before every row of the queryset, e.g. archived ones. Raises
+    # ValueError for a malformed cursor.
+    page_size = clamp_page_size(query_params.get('page_size'), default_page_size, maximum_page_size)
+    direction = 'before' if query_params.get('before') else 'after'
+    cursor = query_params.get(direction)
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None and (position[0] is None) != (field is None):
+        raise ValueError('Invalid cursor')
+    if position_of is None:
+        position_of = lambda row: (getattr(row, field) if field else None, row.id)
+
+    readers = [lambda position, limit: list(keyset_filter(queryset, position, direction, field)[:limit])]
+    if older is not None:
+        readers.insert(0 if direction == 'after' else 1, lambda position, limit: older(position, direction, limit))
+    rows = read_tiers(readers, position, page_size + 1, position_of)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(*position_of(rows[-1]))
+    if direction == 'before':
+        rows.reverse()
+    return rows, next_cursor
+
+
+def clamp_page_size(value, default, maximum):
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(page_size, maximum))
@@ -0,0 +1,113 @@
+from datetime import datetime, timezone as dt_timezone
+from django.db import connection
+from .models import Message
+
+
+# Postgres monthly range partitions of the message table on timestamp. The
+# table is converted once, with the script printed by the message_partitions
+# command; afterwards partitions are created ahead of time by that command
+# and dropped by archive_messages once their month is archived.
+MESSAGE_COLUMNS = ('id', 'conversation_id', 'sender_id', 'receiver_id', 'content', 'timestamp')
+
+
+def month_start(timestamp):
+    return datetime(timestamp.year, timestamp.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, count):
+    year, index = divmod(month.year * 12 + month.month - 1 + count, 12)
+    return month.replace(year=year, month=index + 1)
+
+
+def months_between(start, end):
+    # First days of the months from the one holding start up to end
+    month = month_start(start)
+    while month < end:
+        yield month
+        month = add_months(month, 1)
+
+
+def partition_name(month):
+    return f'{Message._meta.db_table}_{month:%Y%m}'
+
+
+def is_partitioned():
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass',
+            [connection.ops.quote_name(Message._meta.db_table)],
+        )
+        return cursor.fetchone() is not None
+
+
+def create_partition_sql(month):
+    quote = connection.ops.quote_name
+    return (
+        f'CREATE TABLE IF NOT EXISTS {quote(partition_name(month))} PARTITION OF {quote(Message._meta.db_table)}'
+        f" FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def drop_partition_if_empty(month):
+    # Drops the partition of a month once every row left it; returns
+    # whether it was dropped
+    quote = connection.ops.quote_name
+    name = partition_name(month)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT to_regclass(%s)', [quote(name)])
+        if cursor.fetchone()[0] is None:
+            return False
+        cursor.execute(f'SELECT EXISTS (SELECT 1 FROM {quote(name)})')
+        if cursor.fetchone()[0]:
+            return False
+        cursor.execute(f'ALTER TABLE {quote(Message._meta.db_table)} DETACH PARTITION {quote(name)}')
+        cursor.execute(f'DROP TABLE {quote(name)}')
+    return True
+
+
+def conversion_sql(first_month, last_month):
+    # Script turning the plain message table into a partitioned one, to be
+    # reviewed and run during a maintenance window. Rows are copied, so it
+    # needs free space for a second copy of the table. The primary key has
+    # to include the partition key, and the indexes are recreated from
+    # their current definitions.
+    quote = connection.ops.quote_name
+    table = quote(Message._meta.db_table)
+    old_table = quote(f'{Message._meta.db_table}_unpartitioned')
+    columns = ', '.join(quote(column) for column in MESSAGE_COLUMNS)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s"
+            " AND indexname NOT IN (SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass)",
+            [Message._meta.db_table, table],
+        )
+        indexes = [row[0] for row in cursor.fetchall()]
+
+    statements = [
+        'BEGIN',
+        f'LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE',
+        f'ALTER TABLE {table} RENAME TO {old_table}',
+        f'CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING IDENTITY INCLUDING GENERATED)'
+        f' PARTITION BY RANGE ({quote("timestamp")})',
+        f'ALTER TABLE {table} ADD PRIMARY KEY ({quote("id")}, {quote("timestamp")})',
+    ]
+    for field in Message._meta.concrete_fields:
+        if field.remote_field is not None and field.db_constraint:
+            target = field.remote_field.model._meta
+            statements.append(
+                f'ALTER TABLE {table} ADD FOREIGN KEY ({quote(field.column)})'
+                f' REFERENCES {quote(target.db_table)} ({quote(target.pk.column)}) DEFERRABLE INITIALLY DEFERRED'
+            )
+    statements += [create_partition_sql(month) for month in months_between(first_month, add_months(last_month, 1))]
+    statements += [
+        f'CREATE TABLE {quote(Message._meta.db_table + "_default")} PARTITION OF {table} DEFAULT',
+        f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {old_table}',
+        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT coalesce(max({quote('id')}), 0) + 1 FROM {old_table}), false)",
+        f'DROP TABLE {old_table}',
+        *indexes,
+        'COMMIT',
+    ]
+    return ';\n'.join(statements) + ';\n'
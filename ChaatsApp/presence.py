@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+import weakref
+from channels.layers import get_channel_layer
+from django.conf import settings
+import redis.asyncio as aioredis
+from .delivery import deliver
+from .protocol import encode_frames
+
+
+# A socket counts as connected until PRESENCE_TTL seconds after its last
+# heartbeat, so crashed workers cannot leave users online forever. Users
+# whose sockets lapsed are found every PRESENCE_SWEEP_INTERVAL seconds and
+# their subscribers told they went offline.
+PRESENCE_TTL = 60
+PRESENCE_SWEEP_INTERVAL = 15
+PRESENCE_STATUSES = ('online', 'away', 'busy')
+PRESENCE_MAX_SUBSCRIPTIONS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def presence_group(user_id):
+    # Group of the sockets subscribed to a user's presence changes
+    return f'presence_{user_id}'
+
+
+def parse_user_ids(user_ids):
+    # The ids of a subscription request, or None if any of them is not one
+    if not isinstance(user_ids, list) or not all(str(user_id).isdigit() for user_id in user_ids):
+        return None
+    return [int(user_id) for user_id in user_ids]
+
+
+def presence_event(user_id, status):
+    return {
+        'type': 'presence.update',
+        **encode_frames({
+            'action': 'user_status',
+            'user_id': user_id,
+            'status': status,
+        }),
+    }
+
+
+class RedisPresenceStore:
+    # Per user, a sorted set of live sockets scored by their expiry and a
+    # status key, both refreshed by heartbeats. One more sorted set holds
+    # the users with sockets, scored by when their last socket expires.
+    users_key = 'presence:users'
+
+    def __init__(self, url, ttl=PRESENCE_TTL):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+
+    @staticmethod
+    def keys(user_id):
+        return f'presence:{user_id}:sockets', f'presence:{user_id}:status'
+
+    async def touch(self, user_id, socket_id, status=None):
+        # Registers or refreshes a socket. Returns the user's presence
+        # before and after, 'offline' meaning no live socket.
+        sockets_key, status_key = self.keys(user_id)
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(sockets_key, '-inf', now)
+            pipe.zcard(sockets_key)
+            pipe.get(status_key)
+            pipe.zadd(sockets_key, {socket_id: now + self.ttl})
+            pipe.expire(sockets_key, self.ttl)
+            pipe.zadd(self.users_key, {user_id: now + self.ttl})
+            if status:
+                pipe.set(status_key, status, ex=self.ttl)
+            else:
+                pipe.set(status_key, 'online', ex=self.ttl, nx=True)
+                pipe.expire(status_key, self.ttl)
+            _, live_sockets, old_status, *_ = await pipe.execute()
+
+        previous = (old_status or 'online') if live_sockets else 'offline'
+        return previous, status or old_status or 'online'
+
+    async def remove(self, user_id, socket_id):
+        sockets_key, status_key = self.keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(sockets_key, socket_id)
+            pipe.zremrangebyscore(sockets_key, '-inf', time.time())
+            pipe.zcard(sockets_key)
+            pipe.get(status_key)
+            _, _, live_sockets, status = await pipe.execute()
+
+        if live_sockets:
+            return status or 'online', status or 'online'
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(status_key)
+            pipe.zrem(self.users_key, user_id)
+            await pipe.execute()
+        return status or 'online', 'offline'
+
+    async def expire(self):
+        # Users whose last socket expired, each returned to one worker only
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrangebyscore(self.users_key, '-inf', time.time())
+            pipe.zremrangebyscore(self.users_key, '-inf', time.time())
+            user_ids, _ = await pipe.execute()
+        return [int(user_id) for user_id in user_ids]
+
+    async def get_many(self, user_ids):
+        # Presence of many users in a single pipelined round trip
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                sockets_key, status_key = self.keys(user_id)
+                pipe.zcount(sockets_key, now, '+inf')
+                pipe.get(status_key)
+            results = await pipe.execute()
+
+        return {
+            user_id: (results[2 * i + 1] or 'online') if results[2 * i] else 'offline'
+            for i, user_id in enumerate(user_ids)
+        }
+
+
+class LocalPresenceStore:
+    # Same behaviour kept in process memory, for a single worker without Redis
+    def __init__(self, ttl=PRESENCE_TTL):
+        self.sockets = {}
+        self.statuses = {}
+        self.ttl = ttl
+
+    def live_sockets(self, user_id):
+        now = time.time()
+        sockets = self.sockets.get(user_id, {})
+        for socket_id, expires_at in list(sockets.items()):
+            if expires_at <= now:
+                del sockets[socket_id]
+        return sockets
+
+    async def touch(self, user_id, socket_id, status=None):
+        sockets = self.live_sockets(user_id)
+        old_status = self.statuses.get(user_id) if sockets else None
+        previous = (old_status or 'online') if sockets else 'offline'
+
+        self.sockets.setdefault(user_id, sockets)[socket_id] = time.time() + self.ttl
+        self.statuses[user_id] = status or old_status or 'online'
+        return previous, self.statuses[user_id]
+
+    async def remove(self, user_id, socket_id):
+        sockets = self.live_sockets(user_id)
+        sockets.pop(socket_id, None)
+        status = self.statuses.get(user_id, 'online')
+        if sockets:
+            return status, status
+
+        self.sockets.pop(user_id, None)
+        self.statuses.pop(user_id, None)
+        return status, 'offline'
+
+    async def get_many(self, user_ids):
+        return {
+            user_id: self.statuses.get(user_id, 'online') if self.live_sockets(user_id) else 'offline'
+            for user_id in user_ids
+        }
+
+    async def expire(self):
+        user_ids = [user_id for user_id in list(self.sockets) if not self.live_sockets(user_id)]
+        for user_id in user_ids:
+            self.sockets.pop(user_id, None)
+            self.statuses.pop(user_id, None)
+        return user_ids
+
+
+class PresenceSweeper:
+    # Tells subscribers about users whose heartbeats lapsed, e.g. because
+    # their worker died. Runs while the worker has presence sockets; any
+    # worker's sweep finds the users of every worker.
+    def __init__(self, interval=PRESENCE_SWEEP_INTERVAL):
+        self.interval = interval
+        self.consumers = weakref.WeakSet()
+        self.task = None
+
+    def add(self, consumer):
+        self.consumers.add(consumer)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def discard(self, consumer):
+        self.consumers.discard(consumer)
+
+    async def run(self):
+        while self.consumers:
+            await asyncio.sleep(self.interval)
+            await self.sweep()
+
+    async def sweep(self):
+        try:
+            user_ids = await get_presence_store().expire()
+        except Exception:
+            logger.exception('Presence sweep failed')
+            return
+        channel_layer = get_channel_layer()
+        for user_id in user_ids:
+            await deliver(channel_layer, presence_group(user_id), presence_event(user_id, 'offline'))
+
+
+_store = None
+
+
+def get_presence_store():
+    global _store
+    if _store is None:
+        redis_url = getattr(settings, 'REDIS_URL', None)
+        _store = RedisPresenceStore(redis_url) if redis_url else LocalPresenceStore()
+    return _store
+
+
+_sweepers = weakref.WeakKeyDictionary()
+
+
+def get_presence_sweeper():
+    # One sweeper per event loop, i.e. per worker
+    loop = asyncio.get_running_loop()
+    if loop not in _sweepers:
+        _sweepers[loop] = PresenceSweeper()
+    return _sweepers[loop]
@@ -0,0 +1,77 @@
+import json
+from .cache import LRUCache, get_redis
+from .fast_serializers import FastSerializer
+from .models import UserProfile
+from .serializers import UserProfileSerializer
+
+
+# Serialized profiles are kept briefly in each worker and longer in Redis.
+# Invalidation clears both tiers of the worker doing the write and Redis;
+# other workers may serve their local copy for up to PROFILE_LOCAL_TTL.
+PROFILE_LOCAL_SIZE = 10000
+PROFILE_LOCAL_TTL = 10
+PROFILE_REDIS_TTL = 3600
+
+
+class ProfileCache:
+    def __init__(self, local_size=PROFILE_LOCAL_SIZE, local_ttl=PROFILE_LOCAL_TTL, redis_ttl=PROFILE_REDIS_TTL):
+        self.local = LRUCache(local_size, local_ttl)
+        self.redis_ttl = redis_ttl
+
+    @staticmethod
+    def key(profile_id):
+        return f'profile:{profile_id}'
+
+    def get(self, profile_id):
+        return self.get_many([profile_id]).get(int(profile_id))
+
+    def get_many(self, profile_ids):
+        # Profiles by id, skipping ids that do not exist. Local misses cost
+        # one Redis MGET, and what Redis lacks one IN query plus one
+        # pipelined write back.
+        profile_ids = list(dict.fromkeys(int(profile_id) for profile_id in profile_ids))
+        profiles = {}
+        missing = []
+        for profile_id in profile_ids:
+            profile = self.local.get(profile_id)
+            if profile is None:
+                missing.append(profile_id)
+            else:
+                profiles[profile_id] = profile
+
+        client = get_redis()
+        if missing and client is not None:
+            cached = client.mget([self.key(profile_id) for profile_id in missing])
+            still_missing = []
+            for profile_id, value in zip(missing, cached):
+                if value is None:
+                    still_missing.append(profile_id)
+                else:
+                    profiles[profile_id] = json.loads(value)
+                    self.local.set(profile_id, profiles[profile_id])
+            missing = still_missing
+
+        if missing:
+            loaded = FastSerializer(UserProfileSerializer).serialize(UserProfile.objects.filter(id__in=missing))
+            if client is not None and loaded:
+                pipe = client.pipeline(transaction=False)
+                for profile in loaded:
+                    pipe.set(self.key(profile['id']), json.dumps(profile), ex=self.redis_ttl)
+                pipe.execute()
+            for profile in loaded:
+                profiles[profile['id']] = profile
+                self.local.set(profile['id'], profile)
+
+        return {profile_id: profiles[profile_id] for profile_id in profile_ids if profile_id in profiles}
+
+    def invalidate(self, profile_ids):
+        profile_ids = [int(profile_id) for profile_id in profile_ids]
+        for profile_id in profile_ids:
+            self.local.delete(profile_id)
+
+        client = get_redis()
+        if profile_ids and client is not None:
+            client.delete(*[self.key(profile_id) for profile_id in profile_ids])
+
+
+profile_cache = ProfileCache()
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import logging
+from collections import deque
+import msgpack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from .metrics import inc, measure, observe
+from .ratelimit import check_rate
+
+
+# WebSocket subprotocols a client can ask for. Sockets that ask for none
+# keep talking JSON over text frames.
+JSON_SUBPROTOCOL = 'json'
+MSGPACK_SUBPROTOCOL = 'msgpack'
+SUBPROTOCOLS = (MSGPACK_SUBPROTOCOL, JSON_SUBPROTOCOL)
+
+# Frames waiting for a slow reader are bounded per socket. With the 'shed'
+# policy a full buffer drops ephemeral frames (typing, presence) first and
+# closes the socket only when a frame that matters does not fit; with
+# 'close' any overflow closes it. Clients resync after reconnecting.
+OUTBOUND_LIMIT = 256
+OVERFLOW_SHED = 'shed'
+OVERFLOW_CLOSE = 'close'
+OVERFLOW_CLOSE_CODE = 1013  # Try again later
+
+logger = logging.getLogger(__name__)
+
+
+def log_task_error(task):
+    # Done callback of background tasks nobody awaits
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Background task %s failed', task.get_name(), exc_info=task.exception())
+
+
+def frame_size(frame):
+    # Bytes on the wire: text frames are sent as UTF-8
+    if isinstance(frame, bytes) or frame.isascii():
+        return len(frame)
+    return len(frame.encode())
+
+
+def encode_frame(payload, binary):
+    return msgpack.packb(payload, use_bin_type=True) if binary else json.dumps(payload)
+
+
+def encode_frames(payload):
+    # A payload sent to many sockets, encoded once and spread into a channel
+    # layer event. Only the JSON frame is made here; the MessagePack one is
+    # made by binary_frame() once a socket that negotiated it needs it.
+    return {'text': json.dumps(payload)}
+
+
+def binary_frame(frames):
+    # Kept in the event, which this worker's sockets share, so it is made
+    # at most once per event and worker
+    if 'bytes' not in frames:
+        frames['bytes'] = msgpack.packb(json.loads(frames['text']), use_bin_type=True)
+    return frames['bytes']
+
+
+class FrameWebsocketConsumer(AsyncWebsocketConsumer):
+    # Consumer speaking JSON text frames or, when negotiated, MessagePack
+    # binary frames. Subclasses implement receive_data() and reply through
+    # send_data() or send_frames(). Actions listed in `actions` are timed
+    # separately in the metrics, anything else counts as 'unknown'. Every
+    # action is rate limited per socket and per user.
+    binary = False
+    counted = False
+    actions = ()
+    outbound_limit = OUTBOUND_LIMIT
+    overflow_policy = OVERFLOW_SHED
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_buckets = {}
+        self.outbound = deque()
+        self.writer = None
+        self.overflowed = False
+
+    def select_subprotocol(self):
+        # First subprotocol offered by the client that we support
+        for subprotocol in self.scope.get('subprotocols', ()):
+            if subprotocol in SUBPROTOCOLS:
+                self.binary = subprotocol == MSGPACK_SUBPROTOCOL
+                return subprotocol
+        return None
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol or self.select_subprotocol())
+        self.counted = True
+        inc('chaats_active_connections', (type(self).__name__,))
+
+    async def websocket_disconnect(self, message):
+        if self.counted:
+            self.counted = False
+            inc('chaats_active_connections', (type(self).__name__,), -1)
+        self.discard_outbound()
+        await super().websocket_disconnect(message)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        observe('chaats_frame_size_bytes', (type(self).__name__, 'in'), frame_size(bytes_data if bytes_data is not None else text_data or ''))
+        try:
+            if bytes_data is not None:
+                data = msgpack.unpackb(bytes_data, raw=False)
+            else:
+                data = json.loads(text_data)
+        except (ValueError, TypeError, msgpack.UnpackException):
+            data = None
+
+        if not isinstance(data, dict):
+            await self.send_data({'error': 'Invalid frame'})
+            return
+        await self.handle_data(data)
+
+    async def handle_data(self, data):
+        action = data.get('action')
+        label = action if action in self.actions else 'unknown'
+        retry_after = await check_rate(self.rate_buckets, getattr(self, 'user_id', None), label)
+        if retry_after:
+            inc('chaats_rate_limited_total', (type(self).__name__, label))
+            await self.send_data({'action': label, 'error': 'Rate limit exceeded', 'retry_after': round(retry_after, 3)})
+            return
+        with measure(type(self).__name__, label):
+            await self.receive_data(data)
+
+    async def receive_data(self, data):
+        pass
+
+    async def send_data(self, payload):
+        await self.send_frame(encode_frame(payload, self.binary))
+
+    async def send_frames(self, frames, ephemeral=False):
+        # Sends the pre-encoded frame matching this socket's subprotocol
+        await self.send_frame(binary_frame(frames) if self.binary else frames['text'], ephemeral)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        frame = bytes_data if bytes_data is not None else text_data
+        if frame is not None:
+            observe('chaats_frame_size_bytes', (type(self).__name__, 'out'), frame_size(frame))
+        await super().send(text_data, bytes_data, close)
+
+    async def send_frame(self, frame, ephemeral=False):
+        # Frames are queued and written by one task per socket, so whoever
+        # sends to a slow reader, e.g. another user's consumer delivering a
+        # message, never waits for it
+        if self.overflowed:
+            return
+        if len(self.outbound) >= self.outbound_limit:
+            if self.overflow_policy == OVERFLOW_SHED and ephemeral:
+                inc('chaats_outbound_dropped_total', (type(self).__name__,))
+                return
+            if self.overflow_policy != OVERFLOW_SHED or not self.shed_ephemeral():
+                await self.overflow()
+                return
+
+        self.outbound.append((frame, ephemeral))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.create_task(self.write_outbound())
+            self.writer.add_done_callback(log_task_error)
+
+    def shed_ephemeral(self):
+        # Drops the oldest queued ephemeral frame, if there is one
+        for index, (_, ephemeral) in enumerate(self.outbound):
+            if ephemeral:
+                del self.outbound[index]
+                inc('chaats_outbound_dropped_total', (type(self).__name__,))
+                return True
+        return False
+
+    async def overflow(self):
+        self.overflowed = True
+        inc('chaats_outbound_dropped_total', (type(self).__name__,), len(self.outbound) + 1)
+        self.discard_outbound()
+        await super().close(code=OVERFLOW_CLOSE_CODE)
+
+    async def write_outbound(self):
+        while self.outbound:
+            frame, _ = self.outbound.popleft()
+            if isinstance(frame, bytes):
+                await self.send(bytes_data=frame)
+            else:
+                await self.send(text_data=frame)
+
+    def discard_outbound(self):
+        self.outbound.clear()
+        if self.writer is not None and not self.writer.done():
+            self.writer.cancel()
+
+    async def close(self, code=None):
+        # Frames queued before the close still go out first
+        if self.writer is not None and not self.writer.done():
+            await asyncio.wait([self.writer])
+        await super().close(code)
+
+
+def wrap_frame(stream, frame):
+    # Puts an encoded frame into a {'stream': ..., 'payload': ...} envelope
+    # by concatenation, so payloads are never decoded and encoded again
+    if isinstance(frame, bytes):
+        packer = msgpack.Packer(use_bin_type=True)
+        return packer.pack_map_header(2) + packer.pack('stream') + packer.pack(stream) + packer.pack('payload') + frame
+    return '{"stream": %s, "payload": %s}' % (json.dumps(stream), frame)
+
+
+def batch_frames(frames, binary):
+    # Joins encoded envelopes into a single {'batch': [...]} frame
+    if binary:
+        packer = msgpack.Packer(use_bin_type=True)
+        return packer.pack_map_header(1) + packer.pack('batch') + packer.pack_array_header(len(frames)) + b''.join(frames)
+    return '{"batch": [%s]}' % ', '.join(frames)
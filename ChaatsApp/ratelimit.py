@@ -0,0 +1,143 @@
+import time
+from django.conf import settings
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from .cache import LRUCache
+
+
+# Token buckets per action class: (rate per second, burst) for each socket,
+# then for each user across all of their sockets and workers. The
+# RATE_LIMITS setting replaces this table; an empty one disables limiting.
+RATE_LIMITS = {
+    'send': ((10, 30), (20, 60)),
+    'read': ((5, 20), (10, 40)),
+    'search': ((1, 5), (2, 10)),
+    'write': ((10, 30), (20, 60)),
+    'ephemeral': ((10, 30), (30, 90)),
+    'other': ((10, 30), (20, 60)),
+}
+ACTION_CLASSES = {
+    'direct_message': 'send',
+    'room_message': 'send',
+    'message_history': 'read',
+    'inbox': 'read',
+    'sync': 'read',
+    'room_history': 'read',
+    'list_users': 'read',
+    'get_profile': 'read',
+    'get_profiles': 'read',
+    'search': 'search',
+    'mark_read': 'write',
+    'ack': 'write',
+    'update_profile': 'write',
+    'create_room': 'write',
+    'join_room': 'write',
+    'invite_room': 'write',
+    'leave_room': 'write',
+    'typing': 'ephemeral',
+    'user_status': 'ephemeral',
+    'heartbeat': 'ephemeral',
+    'presence_subscribe': 'ephemeral',
+    'presence_unsubscribe': 'ephemeral',
+}
+
+# Refills and takes a token atomically using the Redis clock, so workers
+# with skewed clocks share one bucket. Returns {allowed, seconds to wait}.
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+'''
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        # Seconds until a token is available, 0 when one was taken
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RedisRateLimiter:
+    def __init__(self, url):
+        self.redis = aioredis.from_url(url)
+        self.script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def take(self, key, rate, burst):
+        try:
+            allowed, wait = await self.script(keys=[f'ratelimit:{key}'], args=[rate, burst])
+        except RedisError:
+            # Limits are a safety net; an unavailable Redis lets actions through
+            return 0
+        return 0 if allowed else float(wait)
+
+
+class LocalRateLimiter:
+    # Same buckets kept in process memory, for a single worker without Redis.
+    # An evicted bucket simply starts full again.
+    def __init__(self, max_size=100000, ttl=3600):
+        self.buckets = LRUCache(max_size, ttl)
+
+    async def take(self, key, rate, burst):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+        self.buckets.set(key, bucket)
+        return bucket.take()
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        redis_url = getattr(settings, 'REDIS_URL', None)
+        _limiter = RedisRateLimiter(redis_url) if redis_url else LocalRateLimiter()
+    return _limiter
+
+
+async def check_rate(buckets, user_id, action):
+    # Seconds until the action may run, 0 when it may run now. buckets holds
+    # the socket's own buckets; the user's are shared through the limiter.
+    action_class = ACTION_CLASSES.get(action, 'other')
+    limits = getattr(settings, 'RATE_LIMITS', RATE_LIMITS).get(action_class)
+    if limits is None:
+        return 0
+    (connection_rate, connection_burst), (user_rate, user_burst) = limits
+
+    bucket = buckets.get(action_class)
+    if bucket is None:
+        bucket = buckets[action_class] = TokenBucket(connection_rate, connection_burst)
+    wait = bucket.take()
+    if wait or user_id is None:
+        return wait
+    return await get_rate_limiter().take(f'{user_id}:{action_class}', user_rate, user_burst)
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import weakref
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from .delivery import deliver, user_group
+from .models import Conversation
+from .protocol import encode_frames
+
+
+# Acknowledgements arriving within RECEIPT_WINDOW seconds are merged per
+# (user, conversation), stored with one UPDATE and sent on as one receipt
+RECEIPT_WINDOW = 0.25
+RECEIPT_MAX_ACKS = 100
+# Ids and marks are stored as BIGINT
+RECEIPT_MAX_MARK = 2 ** 63 - 1
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiptBatcher:
+    def __init__(self, window=RECEIPT_WINDOW):
+        self.window = window
+        self.pending = {}
+        self.task = None
+
+    def acknowledge(self, user_id, conversation_id, delivered, read):
+        key = (int(user_id), int(conversation_id))
+        pending_delivered, pending_read = self.pending.get(key, (0, 0))
+        self.pending[key] = (max(pending_delivered, delivered, read), max(pending_read, read))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        # Exits once nothing is pending and is restarted by the next ack
+        while self.pending:
+            await asyncio.sleep(self.window)
+            await self.flush()
+
+    async def flush(self):
+        acks, self.pending = self.pending, {}
+        try:
+            receipts = await database_sync_to_async(Conversation.acknowledge)(acks)
+        except Exception:
+            # These acks are lost, later ones are still stored; clients send
+            # their marks again as they read on
+            logger.exception('Storing %d acknowledgements failed', len(acks))
+            return
+        channel_layer = get_channel_layer()
+        for conversation_id, user_id, other_user_id, delivered, read in receipts:
+            await deliver(channel_layer, user_group(other_user_id), {
+                'type': 'chat.receipt',
+                **encode_frames({
+                    'action': 'receipt',
+                    'conversation_id': conversation_id,
+                    'user_id': user_id,
+                    'delivered': delivered,
+                    'read': read,
+                }),
+            })
+
+
+_batchers = weakref.WeakKeyDictionary()
+
+
+def get_receipt_batcher():
+    # One batcher per event loop, i.e. per worker
+    loop = asyncio.get_running_loop()
+    if loop not in _batchers:
+        _batchers[loop] = ReceiptBatcher()
+    return _batchers[loop]
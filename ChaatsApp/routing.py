@@ -6,5 +6,6 @@ websocket_urlpatterns = [
     re_path(r'ws/chat-message/$', consumers.ChatMessage.as_asgi() ),
     re_path(r'ws/user-profile/$', consumers.UserProfileConsumer.as_asgi()),
     re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/multiplex/$', consumers.MultiplexConsumer.as_asgi()),
 ]
 
@@ -0,0 +1,121 @@
+import base64
+import binascii
+import re
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from .fast_serializers import FastSerializer
+from .models import Message
+from .serializers import MessageSerializer
+
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MAX_QUERY_LENGTH = 200
+
+# Matching messages with their rank, higher is better. The full-text index
+# is created by migration 0007 and is not part of the model. Ranks are
+# double precision, like the Python floats cursors carry them as, so the
+# rank of a cursor compares equal to the row it came from.
+MATCH_SQL = {
+    'postgresql': (
+        'SELECT m."id", m."sender_id", m."receiver_id", m."conversation_id",'
+        " ts_rank(m.\"search_vector\", query)::float8 AS \"rank\""
+        " FROM \"ChaatsApp_message\" m, websearch_to_tsquery('english', %s) query"
+        ' WHERE m."search_vector" @@ query'
+    ),
+    'sqlite': (
+        'SELECT m."id", m."sender_id", m."receiver_id", m."conversation_id",'
+        ' -bm25("message_fts") AS "rank"'
+        ' FROM "message_fts" JOIN "ChaatsApp_message" m ON m."id" = "message_fts".rowid'
+        ' WHERE "message_fts" MATCH %s'
+    ),
+}
+
+
+def encode_rank_cursor(rank, pk):
+    # Opaque cursor holding the (rank, id) position of a search result;
+    # repr() round-trips the float exactly
+    return base64.urlsafe_b64encode(f'{rank!r}|{pk}'.encode()).decode()
+
+
+def decode_rank_cursor(cursor):
+    try:
+        rank, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return float(rank), int(pk)
+    except (AttributeError, TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+
+def fts5_query(query):
+    # Every word as a quoted FTS5 string so user input is never parsed as
+    # query syntax; all words have to match
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', query))
+
+
+def matching_ids(query):
+    # Subquery of the ids of every message matching query, usable in an
+    # id__in filter, or None when the database has no full-text index
+    query = (query or '').strip()[:SEARCH_MAX_QUERY_LENGTH]
+    if connection.vendor == 'postgresql':
+        return RawSQL(
+            'SELECT "id" FROM "ChaatsApp_message" WHERE "search_vector" @@ websearch_to_tsquery(\'english\', %s)',
+            [query],
+        )
+    if connection.vendor == 'sqlite':
+        if not fts5_query(query):
+            return RawSQL('SELECT rowid FROM "message_fts" WHERE 0', [])
+        return RawSQL('SELECT rowid FROM "message_fts" WHERE "message_fts" MATCH %s', [fts5_query(query)])
+    return None
+
+
+def find_matches(user_id, query, conversation_id, position, limit):
+    # (id, rank) of up to limit messages of the user, best match first and
+    # newest first among equal ranks, after the (rank, id) position
+    match_sql = MATCH_SQL.get(connection.vendor)
+    if match_sql is None:
+        # Unindexed fallback for other databases, newest first
+        messages = Message.objects.filter(Q(sender_id=user_id) | Q(receiver_id=user_id), content__icontains=query)
+        if conversation_id is not None:
+            messages = messages.filter(conversation_id=conversation_id)
+        if position is not None:
+            messages = messages.filter(id__lt=position[1])
+        return [(pk, 0.0) for pk in messages.order_by('-id').values_list('id', flat=True)[:limit]]
+
+    if connection.vendor == 'sqlite':
+        query = fts5_query(query)
+        if not query:
+            return []
+
+    sql = f'SELECT "id", "rank" FROM ({match_sql}) hits WHERE ("sender_id" = %s OR "receiver_id" = %s)'
+    params = [query, user_id, user_id]
+    if conversation_id is not None:
+        sql += ' AND "conversation_id" = %s'
+        params.append(conversation_id)
+    if position is not None:
+        sql += ' AND ("rank" < %s OR ("rank" = %s AND "id" < %s))'
+        params += [position[0], position[0], position[1]]
+    sql += ' ORDER BY "rank" DESC, "id" DESC LIMIT %s'
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def search_messages(user_id, query, conversation_id=None, position=None, limit=SEARCH_PAGE_SIZE, fields=None):
+    # One page of the user's messages matching query, serialized like
+    # MessageSerializer plus their rank, and the cursor of the next page
+    query = (query or '').strip()[:SEARCH_MAX_QUERY_LENGTH]
+    if not query:
+        return [], None
+
+    matches = find_matches(user_id, query, conversation_id, position, limit + 1)
+    next_cursor = None
+    if len(matches) > limit:
+        matches = matches[:limit]
+        next_cursor = encode_rank_cursor(matches[-1][1], matches[-1][0])
+
+    serializer = FastSerializer(MessageSerializer, fields)
+    rows = {row[-1]: row for row in serializer.rows(Message.objects.filter(id__in=[pk for pk, _ in matches]), 'id')}
+    return [{**serializer.row_to_dict(rows[pk]), 'rank': rank} for pk, rank in matches if pk in rows], next_cursor
@@ -1,17 +1,131 @@
+import os
+import re
+from functools import partial
 from rest_framework import serializers
-from .models import CustomUser, UserProfile, Message
+from .models import CustomUser, UserProfile, Message, Conversation, Attachment
+from .attachments import ATTACHMENT_MAX_SIZE
+from .thumbnails import thumbnail_urls
+
+
+class SparseFieldsMixin:
+    # Accepts fields=(...) to serialize only a subset of Meta.fields
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class ThumbnailsField(serializers.Field):
+    # URLs of the profile picture's thumbnails by size name, or None until
+    # they are made. Read from the stored digest, so list reads can use it.
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def converter(self, request):
+        return partial(thumbnail_urls, request=request)
+
+    def to_representation(self, digest):
+        return self.converter(self.context.get('request'))(digest)
+
+
+class CustomUserSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    profile_thumbnails = ThumbnailsField(source='profile_picture_digest')
 
-class CustomUserSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
-        fields = ('id', 'username', 'email', 'first_name', 'last_name', 'profile_picture')
+        fields = ('id', 'username', 'email', 'first_name', 'last_name', 'profile_picture', 'profile_thumbnails')
+
+class UserProfileSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    # The profile exposes the details stored on its user
+    email = serializers.EmailField(source='user.email', read_only=True)
+    first_name = serializers.CharField(source='user.first_name', read_only=True)
+    last_name = serializers.CharField(source='user.last_name', read_only=True)
+    profile_picture = serializers.ImageField(source='user.profile_picture', read_only=True)
+    profile_thumbnails = ThumbnailsField(source='user.profile_picture_digest')
 
-class UserProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserProfile
-        fields = ('id', 'user', 'email', 'first_name', 'last_name', 'profile_picture')
+        fields = ('id', 'user', 'email', 'first_name', 'last_name', 'profile_picture', 'profile_thumbnails')
+
+class UserRelatedField(serializers.PrimaryKeyRelatedField):
+    # Inside a batch the users are loaded up front with one IN query and
+    # passed as context['users']; only unknown ids are looked up again,
+    # for the usual error
+    def __init__(self, **kwargs):
+        kwargs.setdefault('queryset', CustomUser.objects.all())
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        users = self.context.get('users')
+        if users is not None and not isinstance(data, bool):
+            try:
+                return users[int(data)]
+            except (KeyError, TypeError, ValueError):
+                pass
+        return super().to_internal_value(data)
+
+
+class MessageSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    sender = UserRelatedField()
+    receiver = UserRelatedField()
 
-class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = Message
-        fields = ('id', 'sender', 'receiver', 'content', 'timestamp')
+        fields = ('id', 'conversation', 'sender', 'receiver', 'content', 'timestamp')
+        read_only_fields = ('conversation',)
+
+
+class ConversationSerializer(serializers.ModelSerializer):
+    # Inbox entry as seen by the user passed in context['user_id']
+    user = serializers.SerializerMethodField()
+    last_message = serializers.CharField(source='last_message.content', default=None, read_only=True)
+    unread_count = serializers.SerializerMethodField()
+    delivered = serializers.SerializerMethodField()
+    read = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Conversation
+        fields = ('id', 'user', 'last_message_id', 'last_message', 'last_timestamp', 'unread_count', 'delivered', 'read')
+
+    def get_user(self, conversation):
+        return conversation.other_user_id(self.context['user_id'])
+
+    def get_unread_count(self, conversation):
+        return conversation.unread_for(self.context['user_id'])
+
+    # The other user's receipts, i.e. how far they got through the messages
+    def get_delivered(self, conversation):
+        return conversation.receipts_for(self.context['user_id'])[0]
+
+    def get_read(self, conversation):
+        return conversation.receipts_for(self.context['user_id'])[1]
+
+
+class AttachmentSerializer(serializers.ModelSerializer):
+    # Only the description of the file is written; the bytes are uploaded
+    # separately in chunks
+    complete = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Attachment
+        fields = ('id', 'filename', 'content_type', 'size', 'received', 'complete', 'message', 'created_at')
+        read_only_fields = ('received', 'message')
+
+    def validate_filename(self, value):
+        value = os.path.basename(value.replace('\\', '/'))
+        if not value:
+            raise serializers.ValidationError('Invalid filename')
+        return value
+
+    def validate_content_type(self, value):
+        if not re.match(r'^[\w.+-]+/[\w.+-]+$', value):
+            raise serializers.ValidationError('Invalid content type')
+        return value.lower()
+
+    def validate_size(self, value):
+        if value > ATTACHMENT_MAX_SIZE:
+            raise serializers.ValidationError(f'Attachments are limited to {ATTACHMENT_MAX_SIZE} bytes')
+        return value
@@ -0,0 +1,52 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .metrics import record_query
+from .models import CustomUser, UserProfile
+from .profile_cache import profile_cache
+from .thumbnails import schedule_thumbnails
+
+
+@receiver((post_save, post_delete), sender=UserProfile)
+def invalidate_profile(sender, instance, **kwargs):
+    # Invalidate after commit so readers cannot cache the old row again
+    profile_id = instance.id
+    transaction.on_commit(lambda: profile_cache.invalidate([profile_id]))
+
+
+@receiver((post_save, post_delete), sender=CustomUser)
+def invalidate_user_profile(sender, instance, update_fields=None, **kwargs):
+    # Cached profiles embed the details of their user
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    profile_ids = list(UserProfile.objects.filter(user_id=instance.id).values_list('id', flat=True))
+    if profile_ids:
+        transaction.on_commit(lambda: profile_cache.invalidate(profile_ids))
+
+
+@receiver(pre_save, sender=CustomUser)
+def check_profile_picture(sender, instance, update_fields=None, raw=False, **kwargs):
+    # Only saves that may set a new picture look up the stored one
+    instance._picture_changed = False
+    if raw or (update_fields is not None and 'profile_picture' not in update_fields):
+        return
+    previous = None
+    if instance.pk is not None:
+        previous = CustomUser.objects.filter(pk=instance.pk).values_list('profile_picture', flat=True).first()
+    instance._picture_changed = (instance.profile_picture.name or '') != (previous or '')
+
+
+@receiver(post_save, sender=CustomUser)
+def make_thumbnails(sender, instance, **kwargs):
+    if getattr(instance, '_picture_changed', False):
+        instance._picture_changed = False
+        user_id, name = instance.id, instance.profile_picture.name
+        transaction.on_commit(lambda: schedule_thumbnails(user_id, name))
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Count queries per action; a reconnect reuses the same wrapper object
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
@@ -0,0 +1,144 @@
+import hashlib
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import django
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+from .metrics import inc
+from .models import CustomUser
+
+
+# Square thumbnails made from each profile picture, by name and edge in
+# pixels. Clients pick the URL for the size they draw instead of
+# downloading the original.
+THUMBNAIL_SIZES = {'small': 48, 'medium': 128, 'large': 512}
+THUMBNAIL_QUALITY = 85
+# Changing the sizes or the encoding must change this, so new thumbnails
+# get new names and cached copies of the old ones are never served for them
+THUMBNAIL_VERSION = 1
+THUMBNAIL_MAX_BYTES = 10 * 1024 * 1024
+THUMBNAIL_MAX_PIXELS = 40_000_000
+THUMBNAIL_WORKERS = 2
+
+
+def thumbnail_name(digest, size):
+    # Content addressed: a name always holds the same bytes, so the files
+    # can be served with a far-future Cache-Control
+    return f'thumbnails/{digest[:2]}/{digest}_{size}.jpg'
+
+
+def thumbnail_urls(digest, request=None):
+    if not digest:
+        return None
+    urls = {}
+    for label, size in THUMBNAIL_SIZES.items():
+        url = default_storage.url(thumbnail_name(digest, size))
+        urls[label] = request.build_absolute_uri(url) if request is not None else url
+    return urls
+
+
+def render_thumbnails(data):
+    # Runs in a pool process. Returns the digest naming the thumbnails and
+    # their JPEG bytes by size; the originals' metadata is not copied.
+    digest = hashlib.sha256(b'%d:' % THUMBNAIL_VERSION + data).hexdigest()
+    with Image.open(io.BytesIO(data)) as image:
+        if image.width * image.height > THUMBNAIL_MAX_PIXELS:
+            raise ValueError('Image is too large')
+        # JPEGs can be decoded straight at a fraction of their size
+        largest = max(THUMBNAIL_SIZES.values())
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image).convert('RGB')
+
+    thumbnails = {}
+    for size in sorted(set(THUMBNAIL_SIZES.values()), reverse=True):
+        # Each size is made from the previous, larger one
+        image = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=THUMBNAIL_QUALITY, optimize=True, progressive=size > 256)
+        thumbnails[size] = output.getvalue()
+    return digest, thumbnails
+
+
+def render_stored_thumbnails(name):
+    # Runs in a pool process, which reads the picture from storage itself
+    with default_storage.open(name) as source:
+        data = source.read(THUMBNAIL_MAX_BYTES + 1)
+    if not data or len(data) > THUMBNAIL_MAX_BYTES:
+        raise ValueError('Picture is empty or too large')
+    return render_thumbnails(data)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_thumbnail_pool():
+    # Started by asgi.py, so no request waits for the workers to spawn.
+    # They are spawned rather than forked from the threaded server and set
+    # Django up before their first task.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup,
+            )
+            # Workers are only started by a first task
+            _pool.submit(int)
+    return _pool
+
+
+def schedule_thumbnails(user_id, name):
+    # Called once the new picture is committed. Only the name is handed
+    # over; reading, decoding and resizing happen in the pool.
+    if not name:
+        set_thumbnail_digest(user_id, name, '')
+        return None
+
+    future = get_thumbnail_pool().submit(render_stored_thumbnails, name)
+    future.add_done_callback(partial(thumbnails_done, user_id, name))
+    return future
+
+
+def thumbnails_done(user_id, name, future):
+    # Runs on the pool's result thread, whose connection is not reused
+    try:
+        store_thumbnails(user_id, name, future)
+    finally:
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def store_thumbnails(user_id, name, future):
+    try:
+        digest, thumbnails = future.result()
+    except Exception:
+        # Missing, undecodable or oversized; clients fall back to the original
+        inc('chaats_thumbnails_total', ('failed',))
+        set_thumbnail_digest(user_id, name, '')
+        return
+
+    for size, content in thumbnails.items():
+        path = thumbnail_name(digest, size)
+        # The same picture uploaded again, or by someone else, is stored once
+        if not default_storage.exists(path):
+            default_storage.save(path, ContentFile(content))
+    inc('chaats_thumbnails_total', ('rendered',))
+    set_thumbnail_digest(user_id, name, digest)
+
+
+def set_thumbnail_digest(user_id, name, digest):
+    # Only if the picture was not replaced meanwhile. Saving invalidates the
+    # cached profile through the post_save signal.
+    users = CustomUser.objects.select_for_update().filter(pk=user_id)
+    if name:
+        users = users.filter(profile_picture=name)
+    with transaction.atomic():
+        user = users.first()
+        if user is not None and user.profile_picture_digest != digest:
+            user.profile_picture_digest = digest
+            user.save(update_fields=['profile_picture_digest'])
@@ -1,13 +1,77 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .models import CustomUser, UserProfile, Message
-from .serializers import CustomUserSerializer, UserProfileSerializer, MessageSerializer
+from .models import CustomUser, UserProfile, Message, Conversation, Attachment
+from .serializers import CustomUserSerializer, UserProfileSerializer, MessageSerializer, ConversationSerializer, AttachmentSerializer
+from .fast_serializers import FastSerializer
+from .profile_cache import profile_cache
+from .search import search_messages, decode_rank_cursor, SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE
+from .archive import archived_row, message_archive
+from .attachments import attachment_response, create_file, parse_content_range, write_chunk
+from functools import partial
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .pagination import (
+    encode_cursor, decode_cursor, clamp_page_size, paginate_queryset,
+    INBOX_PAGE_SIZE, INBOX_MAX_PAGE_SIZE, LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE,
+)
+
+# Ids one ?ids= request may fetch and messages one batch POST may create
+BULK_MAX_IDS = 1000
+BATCH_MAX_MESSAGES = 500
+
+
+def get_sparse_fields(request, serializer_class):
+    # Fields requested with ?fields=a,b, or None for all of them
+    value = request.query_params.get('fields')
+    if not value:
+        return None
+    fields = tuple(name.strip() for name in value.split(',') if name.strip())
+    unknown = set(fields) - set(serializer_class.Meta.fields)
+    if unknown or not fields:
+        raise ValueError(f'Unknown fields: {", ".join(sorted(unknown))}')
+    return fields
+
+
+def get_bulk_ids(request):
+    # Ids requested with ?ids=1,2,3 in the order given, or None
+    value = request.query_params.get('ids')
+    if value is None:
+        return None
+    try:
+        ids = list(dict.fromkeys(int(part) for part in value.split(',') if part.strip()))
+    except ValueError:
+        raise ValueError('Invalid ids')
+    if not ids or len(ids) > BULK_MAX_IDS:
+        raise ValueError(f'Between 1 and {BULK_MAX_IDS} ids can be requested')
+    return ids
+
+
+def fetch_by_ids(serializer, queryset, ids):
+    # One IN query. Rows are returned in the order of ids; the ids that
+    # were not found are listed separately.
+    rows = {row[-1]: row for row in serializer.rows(queryset.filter(id__in=ids), 'id')}
+    found = [rows[pk] for pk in ids if pk in rows]
+    return serializer.to_representation(found), [pk for pk in ids if pk not in rows]
+
 
 class CustomUserList(APIView):
     def get(self, request):
-        custom_users = CustomUser.objects.all()
-        serializer = CustomUserSerializer(custom_users, many=True)
-        return Response({'message': 'Custom users retrieved successfully', 'data': serializer.data})
+        try:
+            serializer = FastSerializer(CustomUserSerializer, get_sparse_fields(request, CustomUserSerializer))
+            ids = get_bulk_ids(request)
+            if ids is not None:
+                data, missing = fetch_by_ids(serializer, CustomUser.objects.all(), ids)
+                return Response({'message': 'Custom users retrieved successfully', 'data': data, 'missing': missing})
+            rows = serializer.rows(CustomUser.objects.all(), 'id')
+            rows, next_cursor = paginate_queryset(
+                rows, request.query_params, None, LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE,
+                position_of=lambda row: (None, row[-1]),
+            )
+        except ValueError as exc:
+            return Response({'message': str(exc)}, status=400)
+
+        return Response({'message': 'Custom users retrieved successfully', 'data': serializer.to_representation(rows), 'next_cursor': next_cursor})
 
     def post(self, request):
         serializer = CustomUserSerializer(data=request.data)
@@ -49,9 +113,21 @@ class CustomUserDetail(APIView):
 
 class UserProfileList(APIView):
     def get(self, request):
-        user_profiles = UserProfile.objects.all()
-        serializer = UserProfileSerializer(user_profiles, many=True)
-        return Response({'message': 'User profiles retrieved successfully', 'data': serializer.data})
+        try:
+            serializer = FastSerializer(UserProfileSerializer, get_sparse_fields(request, UserProfileSerializer))
+            ids = get_bulk_ids(request)
+            if ids is not None:
+                data, missing = fetch_by_ids(serializer, UserProfile.objects.all(), ids)
+                return Response({'message': 'User profiles retrieved successfully', 'data': data, 'missing': missing})
+            rows = serializer.rows(UserProfile.objects.all(), 'id')
+            rows, next_cursor = paginate_queryset(
+                rows, request.query_params, None, LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE,
+                position_of=lambda row: (None, row[-1]),
+            )
+        except ValueError as exc:
+            return Response({'message': str(exc)}, status=400)
+
+        return Response({'message': 'User profiles retrieved successfully', 'data': serializer.to_representation(rows), 'next_cursor': next_cursor})
 
     def post(self, request):
         serializer = UserProfileSerializer(data=request.data)
@@ -64,17 +140,149 @@ class UserProfileList(APIView):
 
 class MessageList(APIView):
     def get(self, request):
+        try:
+            serializer = FastSerializer(MessageSerializer, get_sparse_fields(request, MessageSerializer))
+            ids = get_bulk_ids(request)
+            if ids is not None:
+                # Messages in the table only; archived ones are listed as missing
+                data, missing = fetch_by_ids(serializer, Message.objects.all(), ids)
+                return Response({'message': 'Messages retrieved successfully', 'data': data, 'missing': missing})
+            messages, ordering_field, archived = self.filter_messages(request.query_params)
+            rows = serializer.rows(messages, 'timestamp', 'id')
+            older = None
+            if archived is not None:
+                columns = serializer.columns + ('timestamp', 'id')
+                older = lambda position, direction, limit: [
+                    archived_row(message, columns) for message in archived(position, direction, limit)
+                ]
+            rows, next_cursor = paginate_queryset(
+                rows, request.query_params, ordering_field, LIST_PAGE_SIZE, LIST_MAX_PAGE_SIZE,
+                position_of=lambda row: (row[-2] if ordering_field else None, row[-1]),
+                older=older,
+            )
+        except ValueError as exc:
+            return Response({'message': str(exc)}, status=400)
+
+        return Response({'message': 'Messages retrieved successfully', 'data': serializer.to_representation(rows), 'next_cursor': next_cursor})
+
+    def filter_messages(self, query_params):
+        # Within one conversation rows are paged on the (conversation,
+        # timestamp, id) index and continue into the archive files; across
+        # conversations on the primary key, over the table only
         messages = Message.objects.all()
-        serializer = MessageSerializer(messages, many=True)
-        return Response({'message': 'Messages retrieved successfully', 'data': serializer.data})
+        ordering_field = None
+        conversation = None
+        bounds = {}
+
+        conversation_id = query_params.get('conversation')
+        sender_id = query_params.get('sender_id')
+        receiver_id = query_params.get('receiver_id')
+        if conversation_id:
+            if not conversation_id.isdigit():
+                raise ValueError('Invalid conversation')
+            conversation = int(conversation_id)
+            messages = messages.filter(conversation_id=conversation)
+            ordering_field = 'timestamp'
+        elif sender_id and receiver_id:
+            # History between two users reads a single conversation
+            conversation = Conversation.lookup_id(sender_id, receiver_id)
+            messages = messages.filter(conversation_id=conversation)
+            ordering_field = 'timestamp'
+
+        for param, lookup in (('since', 'timestamp__gte'), ('until', 'timestamp__lt')):
+            value = query_params.get(param)
+            if value:
+                timestamp = parse_datetime(value)
+                if timestamp is None:
+                    raise ValueError(f'Invalid {param}')
+                if timezone.is_naive(timestamp):
+                    timestamp = timezone.make_aware(timestamp)
+                messages = messages.filter(**{lookup: timestamp})
+                bounds[param] = timestamp
+
+        archived = None
+        if conversation is not None:
+            archived = partial(message_archive.read_history, conversation, **bounds)
+        return messages, ordering_field, archived
 
     def post(self, request):
+        if isinstance(request.data, list):
+            return self.create_batch(request.data)
+
         serializer = MessageSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save()
             return Response({'message': 'Message created successfully', 'data': serializer.data})
         return Response({'message': 'Message creation failed', 'errors': serializer.errors})
 
+    def create_batch(self, items):
+        # An array of messages, e.g. an offline outbox. Nothing is written
+        # unless every item is valid; errors are listed per item, in order.
+        # The messages are then inserted with one INSERT in one transaction.
+        if not items or len(items) > BATCH_MAX_MESSAGES:
+            return Response({'message': f'Between 1 and {BATCH_MAX_MESSAGES} messages can be created at once'}, status=400)
+
+        user_ids = set()
+        for item in items:
+            for key in ('sender', 'receiver'):
+                try:
+                    user_ids.add(int(item.get(key)))
+                except (AttributeError, TypeError, ValueError):
+                    pass
+        users = CustomUser.objects.in_bulk(user_ids)
+
+        serializer = MessageSerializer(data=items, many=True, context={'users': users})
+        if not serializer.is_valid():
+            return Response({'message': 'Message creation failed', 'errors': serializer.errors}, status=400)
+        with transaction.atomic():
+            messages = Message.create_batch([Message(**item) for item in serializer.validated_data])
+        return Response({'message': 'Messages created successfully', 'data': MessageSerializer(messages, many=True).data})
+
+
+
+class MessageSearch(APIView):
+    def get(self, request):
+        if not request.user.is_authenticated:
+            return Response({'message': 'Authentication required'}, status=401)
+
+        page_size = clamp_page_size(request.query_params.get('page_size'), SEARCH_PAGE_SIZE, SEARCH_MAX_PAGE_SIZE)
+        conversation_id = request.query_params.get('conversation')
+        cursor = request.query_params.get('cursor')
+        try:
+            fields = get_sparse_fields(request, MessageSerializer)
+            position = decode_rank_cursor(cursor) if cursor else None
+            if conversation_id is not None and not conversation_id.isdigit():
+                raise ValueError('Invalid conversation')
+        except ValueError as exc:
+            return Response({'message': str(exc)}, status=400)
+
+        results, next_cursor = search_messages(
+            request.user.id, request.query_params.get('q'), conversation_id, position, page_size, fields,
+        )
+        return Response({'message': 'Search results retrieved successfully', 'data': results, 'next_cursor': next_cursor})
+
+
+class InboxList(APIView):
+    def get(self, request):
+        if not request.user.is_authenticated:
+            return Response({'message': 'Authentication required'}, status=401)
+
+        page_size = clamp_page_size(request.query_params.get('page_size'), INBOX_PAGE_SIZE, INBOX_MAX_PAGE_SIZE)
+        before = request.query_params.get('before')
+        try:
+            position = decode_cursor(before) if before else None
+        except ValueError:
+            return Response({'message': 'Invalid cursor'}, status=400)
+
+        conversations = Conversation.inbox(request.user.id, position, page_size)
+        next_cursor = None
+        if len(conversations) > page_size:
+            conversations = conversations[:page_size]
+            next_cursor = encode_cursor(conversations[-1].last_timestamp, conversations[-1].id)
+
+        serializer = ConversationSerializer(conversations, many=True, context={'user_id': request.user.id})
+        return Response({'message': 'Inbox retrieved successfully', 'data': serializer.data, 'next_cursor': next_cursor})
+
 
 
 class UserProfileDetail(APIView):
@@ -85,10 +293,9 @@ class UserProfileDetail(APIView):
             return None
 
     def get(self, request, pk):
-        user_profile = self.get_object(pk)
+        user_profile = profile_cache.get(pk)
         if user_profile:
-            serializer = UserProfileSerializer(user_profile)
-            return Response({'message': 'User profile retrieved successfully', 'data': serializer.data})
+            return Response({'message': 'User profile retrieved successfully', 'data': user_profile})
         return Response({'message': 'User profile not found'}, status=404)
 
     def put(self, request, pk):
@@ -139,3 +346,79 @@ class MessageDetail(APIView):
             return Response({'message': 'Message deleted successfully'})
         return Response({'message': 'Message not found'}, status=404)
 
+
+class AttachmentList(APIView):
+    def post(self, request):
+        # Starts an upload: {'filename', 'content_type', 'size'}. The bytes
+        # follow in PUTs to AttachmentDetail.
+        if not request.user.is_authenticated:
+            return Response({'message': 'Authentication required'}, status=401)
+
+        serializer = AttachmentSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({'message': 'Attachment creation failed', 'errors': serializer.errors}, status=400)
+        attachment = serializer.save(uploader=request.user)
+        create_file(attachment.id)
+        return Response({'message': 'Attachment created successfully', 'data': AttachmentSerializer(attachment).data})
+
+
+def get_readable_attachment(request, pk):
+    # Only the uploader and, once sent, the conversation can see it
+    try:
+        attachment = Attachment.objects.select_related('conversation').get(pk=pk)
+    except Attachment.DoesNotExist:
+        return None
+    return attachment if attachment.readable_by(request.user.id) else None
+
+
+class AttachmentDetail(APIView):
+    def get(self, request, pk):
+        # Also tells an interrupted upload where to resume
+        if not request.user.is_authenticated:
+            return Response({'message': 'Authentication required'}, status=401)
+        attachment = get_readable_attachment(request, pk)
+        if attachment:
+            return Response({'message': 'Attachment retrieved successfully', 'data': AttachmentSerializer(attachment).data})
+        return Response({'message': 'Attachment not found'}, status=404)
+
+    def put(self, request, pk):
+        # One chunk as the raw body, placed by 'Content-Range: bytes
+        # start-end/size'. Chunks are sent in order; a chunk that does not
+        # start at 'received' gets a 409 carrying the offset to resume from.
+        if not request.user.is_authenticated:
+            return Response({'message': 'Authentication required'}, status=401)
+        attachment = get_readable_attachment(request, pk)
+        if attachment is None or attachment.uploader_id != request.user.id:
+            return Response({'message': 'Attachment not found'}, status=404)
+
+        try:
+            start, length = parse_content_range(request.headers.get('Content-Range'), attachment.size)
+        except ValueError as exc:
+            return Response({'message': str(exc)}, status=400)
+        if start != attachment.received:
+            return Response({'message': 'Upload offset mismatch', 'data': AttachmentSerializer(attachment).data}, status=409)
+
+        # The body is read straight from the request stream, never as a whole
+        written = write_chunk(attachment.id, request.stream, start, length) if request.stream is not None else 0
+        # Another request for the same chunk may have finished first
+        Attachment.objects.filter(pk=attachment.pk, received=start).update(received=start + written)
+        attachment.refresh_from_db()
+        if attachment.received != start + written:
+            return Response({'message': 'Upload offset mismatch', 'data': AttachmentSerializer(attachment).data}, status=409)
+        return Response({'message': 'Chunk stored successfully', 'data': AttachmentSerializer(attachment).data})
+
+
+class AttachmentContent(APIView):
+    def get(self, request, pk):
+        # The file, with Range support so downloads can resume and media
+        # can seek
+        if not request.user.is_authenticated:
+            return Response({'message': 'Authentication required'}, status=401)
+        attachment = get_readable_attachment(request, pk)
+        if attachment is None or not attachment.complete:
+            return Response({'message': 'Attachment not found'}, status=404)
+
+        try:
+            return attachment_response(attachment, request.headers.get('Range'), request.headers.get('If-Range'))
+        except ValueError as exc:
+            return Response({'message': str(exc)}, status=416, headers={'Content-Range': f'bytes */{attachment.size}'})
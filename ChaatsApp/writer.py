@@ -0,0 +1,87 @@
+import asyncio
+import weakref
+from channels.db import database_sync_to_async
+from django.db import DatabaseError
+from .models import Message
+
+
+# Messages are queued per worker and written in batches of up to
+# WRITE_BATCH_SIZE rows, or whatever arrived within WRITE_BATCH_WINDOW
+# seconds of the first queued message
+WRITE_QUEUE_SIZE = 1000
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_WINDOW = 0.005
+
+
+class MessageWriteError(Exception):
+    pass
+
+
+class MessageWriter:
+    def __init__(self, queue_size=WRITE_QUEUE_SIZE, batch_size=WRITE_BATCH_SIZE, batch_window=WRITE_BATCH_WINDOW):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.task = None
+
+    async def submit(self, message):
+        # Resolves with the saved message once its batch has committed.
+        # While the queue is full this waits, so the calling consumer stops
+        # reading frames from its socket until the writer catches up.
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((message, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return await future
+
+    async def run(self):
+        # Exits once the queue is drained and is restarted by the next submit
+        loop = asyncio.get_running_loop()
+        while not self.queue.empty():
+            batch = [self.queue.get_nowait()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self.flush(batch)
+
+    async def flush(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            await database_sync_to_async(Message.create_batch)(messages)
+        except (DatabaseError, ValueError, TypeError):
+            # One bad row fails the whole INSERT, so retry the rows one at a
+            # time and only fail the ones that are actually invalid
+            if len(batch) > 1:
+                for item in batch:
+                    await self.flush([item])
+                return
+            _, future = batch[0]
+            if not future.done():
+                future.set_exception(MessageWriteError('Message could not be saved'))
+            return
+        except Exception as exc:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+
+        for message, future in batch:
+            if not future.done():
+                future.set_result(message)
+
+
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    # One writer per event loop, i.e. per worker
+    loop = asyncio.get_running_loop()
+    if loop not in _writers:
+        _writers[loop] = MessageWriter()
+    return _writers[loop]
@@ -1,15 +1,23 @@
 import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 # from daphne import get_asgi_application as daphne_asgi_application  
-from ChaatsApp.routing import websocket_urlpatterns
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ChaatsProject.settings')
 
+# Django has to be set up before the consumers and their models are imported
+django_asgi_application = get_asgi_application()
+
+from ChaatsApp.middleware import JWTAuthMiddleware
+from ChaatsApp.routing import websocket_urlpatterns
+from ChaatsApp.thumbnails import get_thumbnail_pool
+
+# Thumbnail workers are started with the server rather than by the first upload
+get_thumbnail_pool()
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
+    "http": django_asgi_application,
+    "websocket": JWTAuthMiddleware(
         URLRouter(
             websocket_urlpatterns
         )
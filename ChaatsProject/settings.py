@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ChaatsApp.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -132,6 +133,17 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Uploaded profile pictures and their thumbnails. Thumbnail names change
+# with their content, so the web server can cache thumbnails/ forever.
+MEDIA_URL = 'media/'
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+
+# Message attachments, uploaded in chunks and served by the attachment views
+ATTACHMENT_DIR = os.getenv('ATTACHMENT_DIR', BASE_DIR / 'attachments')
+
+# Monthly archive files of old messages, see the archive_messages command
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR', BASE_DIR / 'message_archive')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -160,6 +172,12 @@ AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
 )
 
+# Tokens, sessions and the WebSocket scope all carry ChaatsApp users, the
+# same ids messages and conversations point at. Databases created before
+# this was set are converted by migration 0015; see there for what else to
+# do when upgrading.
+AUTH_USER_MODEL = 'ChaatsApp.CustomUser'
+
 
 # Load environment variables
 REDIS_URL = os.getenv("REDIS_URL")
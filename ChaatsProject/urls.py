@@ -1,3 +1,4 @@
+from django.contrib import admin
 from django.urls import path
 from ChaatsApp.views import (
     CustomUserList,
@@ -6,14 +7,27 @@ from ChaatsApp.views import (
     UserProfileDetail,
     MessageList,
     MessageDetail,
+    InboxList,
+    MessageSearch,
+    AttachmentList,
+    AttachmentDetail,
+    AttachmentContent,
 )
+from ChaatsApp.metrics import metrics_view
 
 urlpatterns = [
+    path('admin/', admin.site.urls),
     path('custom-users/', CustomUserList.as_view(), name='customuser-list'),
     path('custom-users/<int:pk>/', CustomUserDetail.as_view(), name='customuser-detail'),
     path('user-profiles/', UserProfileList.as_view(), name='userprofile-list'),
     path('user-profiles/<int:pk>/', UserProfileDetail.as_view(), name='userprofile-detail'),
     path('messages/', MessageList.as_view(), name='message-list'),
+    path('messages/search/', MessageSearch.as_view(), name='message-search'),
     path('messages/<int:pk>/', MessageDetail.as_view(), name='message-detail'),
+    path('inbox/', InboxList.as_view(), name='inbox'),
+    path('attachments/', AttachmentList.as_view(), name='attachment-list'),
+    path('attachments/<int:pk>/', AttachmentDetail.as_view(), name='attachment-detail'),
+    path('attachments/<int:pk>/content/', AttachmentContent.as_view(), name='attachment-content'),
+    path('metrics', metrics_view, name='metrics'),
     
 ]